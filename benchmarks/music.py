@@ -0,0 +1,150 @@
+"""Load tests the AppleScript callers against the Music stand-in, with Music's costs modelled.
+
+Run from the root of the repository::
+
+    python -m benchmarks.music -n 1000 -n 5000 --latency 0.02 --scan-cost 0.000002
+
+A fake library of synthetic tracks is written for every size, and loaded with `load-itunes`
+both in bulk and track by track. The tracks are then relocated with `apply-updates`, both in
+batches and one at a time. Every command waits for the configured latency, and then holds the
+library for the scan cost of every track it reads, the way Music answers one command at a time
+and reads every track up to the one a ``whose`` clause finds.
+
+Commands are answered in-process by default. ``--transport subprocess`` starts a fake
+``osascript`` for every command, and ``--transport persistent`` keeps one running.
+"""
+import contextlib
+import csv
+import logging
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+from music_upgrader import applescript as apl
+from music_upgrader.fake_music import (
+    FAKE_LATENCY_ENV,
+    FAKE_LIBRARY_ENV,
+    FAKE_SCAN_COST_ENV,
+    FakeMusic,
+    FakeMusicTransport,
+    write_library,
+)
+from music_upgrader.processors import ApplyUpgrade, LoadLatestLibrary
+from music_upgrader.synthetic import _track_names
+
+FAKE_OSASCRIPT = [sys.executable, "-m", "music_upgrader.fake_music"]
+
+DEFAULT_SIZES = (1_000, 5_000)
+
+
+def write_fake_library(path: Path, track_count: int):
+    tracks = []
+    for index in range(track_count):
+        names = _track_names(index, tracks_per_album=10, albums_per_artist=4)
+        tracks.append(
+            {
+                "persistent_id": f"{index:016X}",
+                **names,
+                "last_played": "",
+                "play_count": index % 7,
+                "location": f"/Music/{names['track_artist']}/{names['album']}/{index}.mp3",
+                "modification_date": "Monday, January 1, 2024 at 10:00:00 AM",
+            }
+        )
+    write_library(tracks, path)
+
+
+def _transport(kind: str, library_path: Path, latency: float, scan_cost: float):
+    if kind == "inprocess":
+        music = FakeMusic.from_file(library_path, latency=latency, scan_cost=scan_cost)
+        return FakeMusicTransport(music)
+    os.environ.update(
+        {
+            FAKE_LIBRARY_ENV: str(library_path),
+            FAKE_LATENCY_ENV: str(latency),
+            FAKE_SCAN_COST_ENV: str(scan_cost),
+        }
+    )
+    if kind == "persistent":
+        return apl.PersistentTransport([*FAKE_OSASCRIPT, "-l"])
+    return apl.SubprocessTransport(FAKE_OSASCRIPT)
+
+
+def _write_upgrades(path: Path, items: list[tuple]):
+    with path.open("w") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(("persistent_id", "location", "new_file"))
+        for item in items:
+            writer.writerow((item[0], item[-1], str(Path(item[-1]).with_suffix(".m4a"))))
+
+
+def benchmark(root: Path, track_count: int, fmt: str, transport: str, latency, scan_cost):
+    library_path = root / f"music.{fmt}"
+    write_fake_library(library_path, track_count)
+    apl.set_transport(_transport(transport, library_path, latency, scan_cost))
+    timings = []
+
+    def _timed(stage, run):
+        started = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            result = run()
+        timings.append({"stage": stage, "seconds": time.perf_counter() - started})
+        return result
+
+    try:
+        for bulk in (True, False):
+            data_path = root / f"libraryFiles_{bulk}.csv"
+            loader = LoadLatestLibrary(Path("unused"), data_path, bulk=bulk)
+            loader.output_dir = root / "out"
+            items = _timed("load bulk" if bulk else "load per-track", loader.run)
+        upgrades = root / "copy_results.csv"
+        _write_upgrades(upgrades, items)
+        for batch_size in (50, None):
+            apply = ApplyUpgrade(upgrades, batch_size=batch_size)
+            apply.output_dir = root / "out"
+            _timed("apply batched" if batch_size else "apply per-track", apply.run)
+    finally:
+        apl.set_transport(None)
+    return [{"tracks": track_count, **timing} for timing in timings]
+
+
+@click.command()
+@click.option(
+    "-n",
+    "--tracks",
+    "sizes",
+    type=click.IntRange(min=1),
+    multiple=True,
+    help="Library sizes to load test. Defaults to 1k and 5k tracks",
+)
+@click.option(
+    "--format", "fmt", type=click.Choice(["json", "db"]), default="db", help="Fake library file"
+)
+@click.option(
+    "--transport",
+    type=click.Choice(["inprocess", "subprocess", "persistent"]),
+    default="inprocess",
+)
+@click.option("--latency", type=float, default=0.0, help="Seconds added to every command")
+@click.option(
+    "--scan-cost", type=float, default=0.0, help="Seconds added for every track a command reads"
+)
+def main(sizes, fmt, transport, latency, scan_cost):
+    # Tracks missing from the library are expected, and logged for every row
+    logging.disable(logging.ERROR)
+    click.echo(f"{'stage':<18}{'tracks':>10}{'seconds':>12}{'rows/s':>12}")
+    for size in sizes or DEFAULT_SIZES:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for timing in benchmark(Path(temp_dir), size, fmt, transport, latency, scan_cost):
+                rate = size / timing["seconds"] if timing["seconds"] else 0
+                click.echo(
+                    f"{timing['stage']:<18}{size:>10}{timing['seconds']:>12.2f}{rate:>12.0f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Measures the memory held by the rows of a library data file, as dicts and as track records.
+
+Run from the root of the repository::
+
+    python -m benchmarks.records -n 100000
+
+A library data file of synthetic tracks is written, without any audio files, and read back
+once as the dicts `csv.DictReader` produces and once as `TrackRecord`s. For each, the rows are
+also copied with an added column, the way every stage copies the rows it processes.
+"""
+import csv
+import gc
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+import click
+
+from music_upgrader.processors import iter_csv
+from music_upgrader.records import CSV_HEADER
+from music_upgrader.synthetic import _track_names
+
+
+def write_library(path: Path, track_count: int):
+    with path.open("w") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=CSV_HEADER)
+        writer.writeheader()
+        for index in range(track_count):
+            names = _track_names(index, tracks_per_album=10, albums_per_artist=4)
+            writer.writerow(
+                {
+                    "persistent_id": f"{index:016X}",
+                    **names,
+                    "last_played": "",
+                    "play_count": index % 7,
+                    "location": f"/Music/{names['track_artist']}/{names['album']}/{index}.mp3",
+                }
+            )
+
+
+def _read_dicts(path: Path) -> list:
+    with path.open() as csv_file:
+        return list(csv.DictReader(csv_file))
+
+
+def _read_records(path: Path) -> list:
+    return list(iter_csv(path))
+
+
+def measure(read, path: Path) -> tuple[int, int]:
+    """Bytes held by the rows read, then by them and a copy of each with an added column"""
+    gc.collect()
+    tracemalloc.start()
+    rows = read(path)
+    read_bytes = tracemalloc.get_traced_memory()[0]
+    copies = []
+    for row in rows:
+        row_cpy = row.copy()
+        row_cpy["upgrade_reason"] = "NOT_FOUND"
+        copies.append(row_cpy)
+    copied_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return read_bytes, copied_bytes
+
+
+@click.command()
+@click.option("-n", "--tracks", type=click.IntRange(min=1), default=100_000)
+def main(tracks):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = Path(temp_dir) / "libraryFiles.csv"
+        write_library(path, tracks)
+        click.echo(f"{'rows':<10}{'read B/row':>14}{'copied B/row':>14}")
+        for name, read in (("dict", _read_dicts), ("record", _read_records)):
+            read_bytes, copied_bytes = measure(read, path)
+            click.echo(f"{name:<10}{read_bytes / tracks:>14.0f}{copied_bytes / tracks:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
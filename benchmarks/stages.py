@@ -0,0 +1,133 @@
+"""Times each upgrade stage against synthetic libraries of increasing size.
+
+Run from the root of the repository::
+
+    python -m benchmarks.stages -n 1000 -n 10000 -n 100000 --json results.json
+
+Every size gets a freshly generated library. The stages are chained the same way they are
+when run by hand: the upgrade checks feed the conversion, whose results feed the copy, whose
+results are applied to a fake Music library through a persistent fake ``osascript``.
+"""
+import contextlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+from music_upgrader import applescript as apl
+from music_upgrader import synthetic
+from music_upgrader.db import ApiDataService, CliDataService
+from music_upgrader.fake_music import FAKE_LIBRARY_ENV, write_library
+from music_upgrader.probes import ProbeCache
+from music_upgrader.processors import ApplyUpgrade, ConvertFiles, CopyFiles, UpgradeCheck
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+
+
+def _run_stage(process, output_dir: Path) -> Path:
+    """Run a stage, silencing its per-row output, and return the file holding its results."""
+    process.output_dir = output_dir
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        process.run()
+    results = sorted(output_dir.glob("*.csv"), key=lambda pp: pp.stat().st_mtime_ns)
+    return results[-1] if results else None
+
+
+def benchmark(
+    root: Path, track_count: int, workers: int, batch_size: int, verify_tags=False
+) -> list[dict]:
+    started = time.perf_counter()
+    library = synthetic.generate(root, track_count)
+    library.register()
+    seconds = time.perf_counter() - started
+    timings = [{"stage": "generate", "seconds": seconds, "rows": track_count}]
+
+    def _timed(stage, process, input_rows):
+        started = time.perf_counter()
+        output = _run_stage(process, root / "out" / stage)
+        seconds = time.perf_counter() - started
+        timings.append({"stage": stage, "seconds": seconds, "rows": input_rows})
+        return output
+
+    probe_cache = ProbeCache(root / "probe_cache.db")
+    check = UpgradeCheck(
+        library.library_csv,
+        ApiDataService(library.name),
+        enable_file_comparison=verify_tags,
+        workers=workers,
+        probe_cache=probe_cache,
+    )
+    _timed("check-upgrade", check, track_count)
+    probe_cache.close()
+    (upgrades,) = (root / "out" / "check-upgrade").glob("upgrade_checks_*.csv")
+    upgrade_rows = sum(1 for _ in upgrades.open()) - 1
+
+    service = CliDataService(library.name)
+    convert = ConvertFiles(
+        upgrades, service, workers=workers, batch_by="album", batch_size=batch_size
+    )
+    converted = _timed("convert-files", convert, upgrade_rows)
+    copied = _timed("copy-files", CopyFiles(converted, service, workers=workers), upgrade_rows)
+
+    # Relocated tracks are saved back to the library, which SQLite does without rewriting it
+    music_library = root / "music.db"
+    write_library(json.loads(library.music_library.read_text()), music_library)
+    os.environ[FAKE_LIBRARY_ENV] = str(music_library)
+    apl.set_transport(
+        apl.PersistentTransport([sys.executable, "-m", "music_upgrader.fake_music", "-l"])
+    )
+    try:
+        _timed("apply-updates", ApplyUpgrade(copied, batch_size=batch_size), upgrade_rows)
+    finally:
+        apl.set_transport(None)
+    return [{"tracks": track_count, **timing} for timing in timings]
+
+
+@click.command()
+@click.option(
+    "-n",
+    "--tracks",
+    "sizes",
+    type=click.IntRange(min=1),
+    multiple=True,
+    help="Library sizes to benchmark. Defaults to 1k, 10k and 100k tracks",
+)
+@click.option("-w", "--workers", type=click.IntRange(min=1), default=4)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=50,
+    help="Files per beet convert call and tracks per AppleScript call",
+)
+@click.option(
+    "--root",
+    type=click.Path(file_okay=False, path_type=Path),
+    help="Where to generate the libraries. Defaults to a temporary directory that is removed",
+)
+@click.option("--verify-tags", is_flag=True, help="Verify the tags in check-upgrade")
+@click.option("--json", "json_path", type=click.Path(dir_okay=False, path_type=Path))
+def main(sizes, workers, batch_size, root, verify_tags, json_path):
+    # Tracks that are not found are expected, and logged for every row
+    logging.disable(logging.ERROR)
+    results = []
+    click.echo(f"{'stage':<16}{'tracks':>10}{'seconds':>12}{'rows/s':>12}")
+    for size in sizes or DEFAULT_SIZES:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            size_root = (root or Path(temp_dir)) / f"library_{size}"
+            for timing in benchmark(size_root, size, workers, batch_size, verify_tags):
+                rate = timing.get("rows", 0) / timing["seconds"] if timing["seconds"] else 0
+                click.echo(
+                    f"{timing['stage']:<16}{size:>10}{timing['seconds']:>12.2f}{rate:>12.0f}"
+                )
+                results.append(timing)
+    if json_path:
+        json_path.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
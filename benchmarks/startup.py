@@ -0,0 +1,75 @@
+"""Times how long the command line takes to start.
+
+Run from the root of the repository::
+
+    python -m benchmarks.startup --runs 20 --max-ms 150
+
+Each run starts a fresh interpreter, so nothing is shared between runs. Besides the timings, the
+heavy dependencies imported just to show the help are listed, since those are what make startup
+slow. With ``--max-ms``, the benchmark fails when the median time to show the help is higher.
+"""
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import click
+
+HEAVY_MODULES = ("beets", "mutagen", "yaml", "dateutil", "rich", "music_upgrader.processors")
+"""Modules that showing the help should not need"""
+
+SHOW_HELP = "from music_upgrader.main import cli; cli(['--help'], standalone_mode=False)"
+
+REPORT_IMPORTS = f"""
+import contextlib, io, json, sys
+with contextlib.redirect_stdout(io.StringIO()):
+    {SHOW_HELP}
+print(json.dumps(sorted(mm for mm in {HEAVY_MODULES!r} if mm in sys.modules)))
+"""
+
+
+def _time_command(code: str, runs: int) -> list[float]:
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def heavy_imports() -> list[str]:
+    """The heavy modules imported when showing the help"""
+    resp = subprocess.run(
+        [sys.executable, "-c", REPORT_IMPORTS], check=True, capture_output=True, text=True
+    )
+    return json.loads(resp.stdout.splitlines()[-1])
+
+
+@click.command()
+@click.option("--runs", type=click.IntRange(min=1), default=10)
+@click.option(
+    "--max-ms",
+    type=click.FloatRange(min=0),
+    help="Fail if the median time to show the help is higher than this",
+)
+@click.option("--json", "json_path", type=click.Path(dir_okay=False, path_type=Path))
+def main(runs, max_ms, json_path):
+    results = {
+        "interpreter": statistics.median(_time_command("pass", runs)) * 1000,
+        "import": statistics.median(_time_command("import music_upgrader.main", runs)) * 1000,
+        "help": statistics.median(_time_command(SHOW_HELP, runs)) * 1000,
+    }
+    for name, milliseconds in results.items():
+        click.echo(f"{name:<16}{milliseconds:>10.1f} ms")
+    imported = heavy_imports()
+    click.echo(f"Heavy modules imported for --help: {', '.join(imported) or 'none'}")
+    if json_path:
+        json_path.write_text(json.dumps({**results, "heavy_imports": imported}, indent=2))
+    if max_ms is not None and results["help"] > max_ms:
+        raise click.ClickException(f"--help took {results['help']:.1f} ms, over {max_ms} ms")
+
+
+if __name__ == "__main__":
+    main()
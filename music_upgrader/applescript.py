@@ -1,5 +1,27 @@
+import atexit
+import logging
+import os
+import select
+import shlex
 import subprocess
+import threading
+import time
 from pathlib import Path
+from typing import Optional, Protocol
+
+from .metrics import timed
+from .runner import get_runner
+
+OSASCRIPT = shlex.split(os.environ.get("MUSIC_UPGRADER_OSASCRIPT", "osascript"))
+"""Command used to run AppleScript. Set MUSIC_UPGRADER_OSASCRIPT to use a stand-in"""
+
+TRANSPORT_ENV = "MUSIC_UPGRADER_APPLESCRIPT_TRANSPORT"
+"""How commands are sent to AppleScript: 'subprocess' (the default) or 'persistent'"""
+
+HOST_SCRIPT = (Path(__file__).parent.parent / "scripts" / "applescript_host.js").resolve()
+"""JXA script that keeps running and executes the AppleScript it receives over stdin"""
+
+LOG = logging.getLogger(__name__)
 
 LOAD_ALL_PLAY_COUNTS = (
     'tell application "Music" to get {persistent ID, played count} of every track in playlist 1'
@@ -9,6 +31,61 @@ LOAD_ALL_IDS = 'tell application "Music" to get persistent ID of every track in
 
 LOAD_ALL_FILE_IDS = 'tell application "Music" to get persistent ID of every file track in playlist 1'
 
+FIELD_SEPARATOR = "\x1f"
+"""Separates the values of a single property when loading properties in bulk"""
+
+RECORD_SEPARATOR = "\x1e"
+"""Separates the property lists when loading properties in bulk"""
+
+FILE_TRACK_PROPERTIES = (
+    "persistent ID",
+    "track number",
+    "name",
+    "artist",
+    "album",
+    "album artist",
+    "year",
+    "played date",
+    "played count",
+    "location",
+)
+"""Properties loaded for every file track. The order matches the library CSV header"""
+
+LOAD_ALL_FILE_TRACK_PROPERTIES = """
+    tell application "Music"
+        set props to {{{properties}}} of every file track of library playlist 1
+    end tell
+    set astid to AppleScript's text item delimiters
+    set cols to {{}}
+    set AppleScript's text item delimiters to character id 31
+    repeat with ii from 1 to count of props
+        set col to item ii of props
+        if ii is {location_column} then
+            set paths to {{}}
+            repeat with loc in col
+                if contents of loc is missing value then
+                    set end of paths to ""
+                else
+                    set end of paths to POSIX path of (contents of loc)
+                end if
+            end repeat
+            set col to paths
+        end if
+        set end of cols to col as text
+    end repeat
+    set AppleScript's text item delimiters to character id 30
+    set out to cols as text
+    set AppleScript's text item delimiters to astid
+    return out
+"""
+"""Get a list of properties for every file track in a single call.
+
+Each property list is joined by FIELD_SEPARATOR and the lists themselves are joined by
+RECORD_SEPARATOR, so that names containing commas survive the trip back to Python. The
+locations in the list at ``location_column``, counting from 1, are turned into POSIX paths by
+Music, which knows the volume each file is on. Use 0 when no location is loaded.
+"""
+
 SELECT_TRACK_BY_ID = """
     tell application "Music"
         set lib to library playlist 1
@@ -48,6 +125,43 @@ SET_TRACK_FILE_LOCATION = """
 """
 """NOTE: The location must be an HFS path string"""
 
+TRACK_MOVED_ERROR = "Track moved since the library was read"
+"""Reported by SET_TRACK_FILE_LOCATIONS for a track no longer at the position it was given"""
+
+SET_TRACK_FILE_LOCATIONS = """
+    set updates to {updates}
+    set results to {{}}
+    tell application "Music" to set lib to library playlist 1
+    repeat with upd in updates
+        set pid to item 2 of upd as text
+        try
+            set newLoc to alias (item 3 of upd as text)
+            tell application "Music"
+                set t to file track (item 1 of upd) of lib
+                if persistent ID of t is not pid then error "{moved}"
+                set location of t to newLoc
+            end tell
+            set end of results to pid & tab & "OK"
+        on error errMsg
+            set end of results to pid & tab & "ERR" & tab & errMsg
+        end try
+    end repeat
+    set astid to AppleScript's text item delimiters
+    set AppleScript's text item delimiters to linefeed
+    set out to results as text
+    set AppleScript's text item delimiters to astid
+    return out
+"""
+"""Set the location of several tracks, given a list of {position, persistent ID, HFS path}.
+
+Each track is picked by its position among the file tracks, so Music does not have to search
+the library for it. The positions come from a single fetch of every persistent ID, and are only
+valid as long as the library does not change in between. The persistent ID of the track found
+is checked, and a track that is no longer at its position is reported as TRACK_MOVED_ERROR.
+Returns a line per track, with the persistent ID, a tab and either OK or ERR, followed by
+another tab and the error message.
+"""
+
 SET_TRACK_PLAYED_COUNT = """
     tell application "Music" to tell t
         set played count to {}
@@ -61,25 +175,169 @@ SET_TRACK_YEAR = """
 """
 
 
-def run(command: str) -> str:
+def encode_request(command: str) -> bytes:
+    """Frame a command as `<length>\\n<command>`, where the length is in bytes"""
+    payload = command.encode("utf-8")
+    return f"{len(payload)}\n".encode() + payload
+
+
+def encode_response(ok: bool, output: str) -> bytes:
+    """Frame a response as `<OK|ERR> <length>\\n<output>`, where the length is in bytes"""
+    payload = output.encode("utf-8")
+    return f"{'OK' if ok else 'ERR'} {len(payload)}\n".encode() + payload
+
+
+class Transport(Protocol):
+    def execute(self, command: str, timeout: Optional[float] = None) -> tuple[str, str]:
+        """Execute a command, returning what was written to stdout and stderr"""
+        ...
+
+    def close(self):
+        ...
+
+
+class SubprocessTransport:
+    """Starts a new `osascript` process for every command.
+
+    The processes are started by the command runner, which limits how many run at once, kills
+    those running past their timeout and retries the errors of a busy or restarting Music.app.
+    """
+
+    def __init__(self, argv: Optional[list[str]] = None):
+        self.argv = argv
+
+    def execute(self, command: str, timeout: Optional[float] = None) -> tuple[str, str]:
+        resp = get_runner().run("osascript", [*(self.argv or OSASCRIPT), "-e", command], timeout)
+        return resp.stdout.decode(), resp.stderr.decode("utf-8")
+
+    def close(self):
+        pass
+
+
+class PersistentTransport:
+    """Keeps a single interpreter process running and sends it every command over a pipe.
+
+    By default, the interpreter is `osascript` running the JXA host script, which compiles and
+    executes each request. A request that does not get a response within the timeout kills the
+    process. The process is started again on the next call, and also restarted when it is found
+    to have died before a request could be sent. Without a timeout of its own, the timeout of the
+    runner's ``osascript`` backend is used, as it is for `SubprocessTransport`.
+    """
+
+    def __init__(self, argv: Optional[list[str]] = None, timeout: Optional[float] = None):
+        self.argv = argv or [*OSASCRIPT, "-l", "JavaScript", str(HOST_SCRIPT)]
+        self.timeout = timeout
+        self.starts = 0
+        self._proc: Optional[subprocess.Popen] = None
+        self._buffer = b""
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _ensure_started(self) -> subprocess.Popen:
+        if self._proc is not None and self._proc.poll() is not None:
+            LOG.warning("AppleScript host exited with %s. Restarting", self._proc.returncode)
+            self._stop()
+        if self._proc is None:
+            self._proc = subprocess.Popen(
+                self.argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0
+            )
+            self._buffer = b""
+            self.starts += 1
+        return self._proc
+
+    def _stop(self):
+        if self._proc is not None:
+            if self._proc.poll() is None:
+                self._proc.kill()
+            self._proc.wait()
+            self._proc = None
+
+    def _read(self, size: int, deadline: Optional[float], timeout: Optional[float]) -> bytes:
+        """Read from the host until the buffer holds `size` bytes, or a line if size is None"""
+        fd = self._proc.stdout.fileno()
+        while (b"\n" not in self._buffer) if size is None else (len(self._buffer) < size):
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise subprocess.TimeoutExpired(self.argv, timeout)
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise subprocess.SubprocessError("AppleScript host exited without responding")
+            self._buffer += chunk
+        if size is None:
+            size = self._buffer.index(b"\n") + 1
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def execute(self, command: str, timeout: Optional[float] = None) -> tuple[str, str]:
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            timeout = get_runner().backends["osascript"].timeout
+        with self._lock:
+            proc = self._ensure_started()
+            try:
+                proc.stdin.write(encode_request(command))
+            except BrokenPipeError:
+                # Nothing was sent, so it is safe to try again with a new process
+                self._stop()
+                proc = self._ensure_started()
+                proc.stdin.write(encode_request(command))
+
+            deadline = None if timeout is None else time.monotonic() + timeout
+            try:
+                status, length = self._read(None, deadline, timeout).decode().split()
+                output = self._read(int(length), deadline, timeout).decode("utf-8")
+            except subprocess.SubprocessError:
+                self._stop()
+                raise
+        if status == "OK":
+            # Match the trailing newline osascript prints
+            return f"{output}\n", ""
+        return "", f"{output}\n"
+
+    def close(self):
+        with self._lock:
+            self._stop()
+
+
+_transport: Optional[Transport] = None
+
+
+def get_transport() -> Transport:
+    global _transport
+    if _transport is None:
+        if os.environ.get(TRANSPORT_ENV) == "persistent":
+            _transport = PersistentTransport()
+        else:
+            _transport = SubprocessTransport()
+    return _transport
+
+
+def set_transport(transport: Optional[Transport]):
+    """Replace the transport used by `run`. None goes back to the default"""
+    global _transport
+    if _transport is not None:
+        _transport.close()
+    _transport = transport
+
+
+@timed("applescript")
+def run(command: str, timeout: Optional[float] = None) -> str:
     # TODO - make a debug
     # print("Executing command:\n {}".format(command))
-    resp = subprocess.run(
-        ["osascript", "-e", command],
-        capture_output=True,
-    )
-    if resp.stderr:
-        print(resp.stderr.decode("utf-8"))
-    return resp.stdout.decode()
+    stdout, stderr = get_transport().execute(command, timeout)
+    if stderr:
+        print(stderr)
+    return stdout
 
 
 def run_script(script_path: Path):
     # TODO - make a debug
     # print("Executing script:\n {}".format(script_path))
-    resp = subprocess.run(
-        ["osascript", str(script_path)],
-        stdout=subprocess.DEVNULL,
-    )
+    resp = get_runner().run("osascript", [*OSASCRIPT, str(script_path)])
     if resp.returncode != 0:
         print(f"Unable to run AppleScript at {script_path}")  # TODO - add logging
         print(resp)
@@ -87,6 +345,12 @@ def run_script(script_path: Path):
     return True
 
 
+def quote(text: str) -> str:
+    """Quote a value as an AppleScript string literal"""
+    escaped = text.replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{escaped}"'
+
+
 def hfs_path_to_posix_path(hfs_path: str) -> str:
     # TODO - double check usage. The new 'load' logic uses POSIX from the beginning
     #        for the Apple Music file location
@@ -0,0 +1,240 @@
+"""Cache of the ALAC files converted from FLAC, keyed by the audio they contain.
+
+A FLAC file is identified by the MD5 of its decoded audio, stored in its STREAMINFO block by
+the encoder, or by a hash of its audio frames when the encoder left that empty. Tags are not
+part of the key, so retagging a FLAC file in beets does not invalidate its conversion. The key
+also covers the ``convert`` settings from the beets config, since those decide what the output
+looks like.
+
+Cached files are kept in a directory alongside a small SQLite index recording their size and
+when they were last used. Once the cache grows past its size limit, the least recently used
+files are removed.
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import mutagen
+from mutagen.flac import FLAC
+
+from .locations import CONVERT_CACHE_MAX_BYTES as DEFAULT_MAX_BYTES
+from .staging import FileStager
+
+LOG = logging.getLogger(__name__)
+
+TAGS_TO_SYNC = (
+    "title",
+    "artist",
+    "album",
+    "albumartist",
+    "tracknumber",
+    "discnumber",
+    "genre",
+    "date",
+)
+"""Tags copied from the FLAC file to a cached conversion, when they differ"""
+
+NUMBER_TAGS = {
+    "tracknumber": ("tracktotal", "totaltracks"),
+    "discnumber": ("disctotal", "totaldiscs"),
+}
+"""Tags holding a number and its total. FLAC keeps the total in a tag of its own, while MP4
+files keep both together as "number/total"."""
+
+
+def _audio_frames_digest(path: Path) -> str:
+    with path.open("rb") as flac_file:
+        header = flac_file.read(10)
+        if header[:3] == b"ID3":
+            size = 0
+            for byte in header[6:10]:
+                size = (size << 7) | (byte & 0x7F)
+            flac_file.seek(10 + size)
+        else:
+            flac_file.seek(0)
+        if flac_file.read(4) != b"fLaC":
+            raise ValueError(f"Not a FLAC file: {path}")
+        is_last = False
+        while not is_last:
+            block_header = flac_file.read(4)
+            is_last = bool(block_header[0] & 0x80)
+            flac_file.seek(int.from_bytes(block_header[1:4], "big"), 1)
+        return hashlib.file_digest(flac_file, "sha256").hexdigest()
+
+
+def audio_fingerprint(path: Path | str) -> str:
+    """Identify the audio of a FLAC file, ignoring its tags"""
+    path = Path(path)
+    md5 = FLAC(path).info.md5_signature
+    if md5:
+        return f"md5:{md5:032x}"
+    return f"sha256:{_audio_frames_digest(path)}"
+
+
+def _number_and_total(tags, tag) -> tuple[str, str]:
+    number, _, total = ((tags.get(tag) or [""])[0]).partition("/")
+    for total_tag in NUMBER_TAGS[tag]:
+        total = total or ((tags.get(total_tag) or [""])[0])
+    return number.strip().lstrip("0"), total.strip().lstrip("0")
+
+
+def sync_tags(source: Path | str, target: Path | str) -> list[str]:
+    """Copy the tags of the source file that differ in the target file.
+
+    Returns:
+        list[str]: The tags that were updated.
+    """
+    source_audio = mutagen.File(source, easy=True)
+    target_audio = mutagen.File(target, easy=True)
+    if target_audio.tags is None:
+        target_audio.add_tags()
+    changed = []
+    for tag in TAGS_TO_SYNC:
+        if tag in NUMBER_TAGS:
+            number, total = _number_and_total(source_audio.tags or {}, tag)
+            current = _number_and_total(target_audio.tags, tag)
+            # Keep the total of the target when the source does not have one
+            total = total or current[1]
+            if number and (number, total) != current:
+                target_audio[tag] = f"{number}/{total}" if total else number
+                changed.append(tag)
+            continue
+        value = (source_audio.tags or {}).get(tag)
+        if value and target_audio.tags.get(tag) != value:
+            target_audio[tag] = value
+            changed.append(tag)
+    if changed:
+        target_audio.save()
+    return changed
+
+
+class ConversionCache:
+    """Content-addressed store of converted files, with least recently used eviction.
+
+    Safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        directory: Path | str,
+        max_bytes=DEFAULT_MAX_BYTES,
+        stager: Optional[FileStager] = None,
+    ):
+        self.directory = Path(directory).expanduser()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        # Never hard link, staged files have their tags edited afterwards
+        self.stager = FileStager(budget=stager.budget) if stager else FileStager()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.directory / "index.db", check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL,
+                    source TEXT
+                )"""
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS entries_by_use ON entries (last_used)"
+            )
+
+    @staticmethod
+    def key_for(source: Path | str, settings: Optional[dict] = None) -> str:
+        """The cache key of a FLAC file converted with the given settings"""
+        digest = hashlib.sha256(audio_fingerprint(source).encode("utf-8"))
+        digest.update(json.dumps(settings or {}, sort_keys=True, default=str).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.m4a"
+
+    def fetch(self, key: str, target: Path | str) -> bool:
+        """Copy a cached conversion to the target location, if there is one.
+
+        Returns:
+            bool: Whether the conversion was cached.
+        """
+        cached = self._path(key)
+        with self._lock, self._conn:
+            found = self._conn.execute(
+                "UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key)
+            ).rowcount
+            if not found or not cached.exists():
+                self.misses += 1
+                return False
+            self.hits += 1
+        Path(target).parent.mkdir(parents=True, exist_ok=True)
+        self.stager.copy(cached, Path(target))
+        return True
+
+    def store(self, key: str, converted: Path | str, source: Optional[Path | str] = None):
+        """Add a converted file to the cache, evicting old entries if it grows too big."""
+        cached = self._path(key)
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        self.stager.copy(Path(converted), cached)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, size, last_used, source) "
+                "VALUES (?, ?, ?, ?)",
+                (key, cached.stat().st_size, time.time(), str(source) if source else None),
+            )
+        self.prune()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size, oldest = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(last_used) FROM entries"
+            ).fetchone()
+        return {
+            "entries": entries,
+            "size": size,
+            "max_size": self.max_bytes,
+            "oldest_use": oldest,
+        }
+
+    def prune(self, max_bytes: Optional[int] = None) -> tuple[int, int]:
+        """Remove the least recently used files until the cache fits in `max_bytes`.
+
+        Args:
+            max_bytes: The size to shrink the cache to. Defaults to the cache's size limit.
+
+        Returns:
+            tuple[int, int]: The number of files removed and the bytes freed.
+        """
+        limit = self.max_bytes if max_bytes is None else max_bytes
+        removed = []
+        with self._lock, self._conn:
+            (total,) = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+            if total <= limit:
+                return 0, 0
+            for key, size in self._conn.execute(
+                "SELECT key, size FROM entries ORDER BY last_used"
+            ).fetchall():
+                if total <= limit:
+                    break
+                removed.append((key, size))
+                total -= size
+            self._conn.executemany(
+                "DELETE FROM entries WHERE key = ?", ((kk,) for kk, _ in removed)
+            )
+        for key, _ in removed:
+            self._path(key).unlink(missing_ok=True)
+        freed = sum(size for _, size in removed)
+        LOG.info("Evicted %s cached conversions, freeing %s bytes", len(removed), freed)
+        return len(removed), freed
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
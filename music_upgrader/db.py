@@ -1,23 +1,86 @@
+import logging
+import os
 import re
+import sqlite3
 import string
-import subprocess
+import threading
+import unicodedata
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from difflib import SequenceMatcher
+from itertools import chain
+from pathlib import Path
 
 from beets.dbcore import AndQuery
 from beets.dbcore.query import RegexpQuery
 from beets.library import Item, Library
+from inflection import transliterate
 
 from music_upgrader import settings
+from music_upgrader.metrics import span, timed
+from music_upgrader.runner import get_runner
 
 # ‐
 REGEX_REPL = re.compile("[%s]" % re.escape(string.punctuation))
 
-DBS, CMDS = settings.load()
+LOG = logging.getLogger(__name__)
 
 CONFIG_LOC_INDEX = -1
 
+NUMBER_WORDS = ("one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten")
+ORDINAL_WORDS = (
+    "first", "second", "third", "fourth", "fifth",
+    "sixth", "seventh", "eighth", "ninth", "tenth",
+)
+ORDINAL_SUFFIXES = ("1st", "2nd", "3rd", "4th", "5th", "6th", "7th", "8th", "9th", "10th")
+ROMAN_NUMERALS = ("i", "ii", "iii", "iv", "v", "vi", "vii", "viii", "ix", "x")
+
+TOKEN_SYNONYMS = {
+    "pt": "part",
+    "pts": "parts",
+    "vol": "volume",
+    "n": "and",
+    "feat": "featuring",
+    "ft": "featuring",
+    **{word: str(ii) for ii, word in enumerate(NUMBER_WORDS, start=1)},
+    **{word: str(ii) for ii, word in enumerate(ORDINAL_WORDS, start=1)},
+    **{word: str(ii) for ii, word in enumerate(ORDINAL_SUFFIXES, start=1)},
+}
+"""Words folded into a single spelling before titles are compared"""
+
+NUMBERED_WORDS = ("part", "volume", "chapter", "book", "act")
+"""Words that, when followed by a roman numeral, have the numeral folded into a number"""
+
+KEY_STORE_VERSION = 2
+"""Bumped whenever `normalize` folds values differently or the keys are stored differently, so
+that the stored keys are rebuilt"""
+
+ITEM_SOURCE = (
+    "COALESCE(items.artist, '') || char(31) || COALESCE(items.album, '') || char(31) "
+    "|| COALESCE(items.title, '')"
+)
+"""The values of a beets item that its normalized keys are made from, as a single SQL value"""
+
+
+def __getattr__(name):
+    """Load the library settings the first time `DBS` or `CMDS` is used"""
+    if name == "DBS":
+        return settings.load()[0]
+    if name == "CMDS":
+        return settings.load()[1]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 def get_library(db_name):
-    return Library(**DBS[db_name])
+    dbs, _ = settings.load()
+    options = dict(dbs[db_name])
+    path_formats = options.pop("path_formats", None)
+    # Newer beets versions read the path formats from the beets config rather than accepting them
+    library = Library(**options)
+    if path_formats:
+        library.path_formats = path_formats
+    return library
 
 def regexify(token):
     f = REGEX_REPL.sub(".?", token)
@@ -25,14 +88,280 @@ def regexify(token):
     return f"[{s.upper()}{s.lower()}]{f[1:]}"
 
 
+def normalize(token):
+    """Fold a value the same way `regexify` loosens it, but into a key that can be compared.
+
+    Punctuation, including the non-standard apostrophes and dashes beets likes to use, is
+    dropped and the case is ignored. `regexify` lets a punctuation mark match a space as well,
+    so "Rock-n-Roll" finds "Rock n Roll" and "AC/DC" finds "AC DC". Whitespace is dropped too,
+    so that those end up with the same key.
+    """
+    folded = REGEX_REPL.sub("", str(token or ""))
+    folded = "".join(cc for cc in folded if not unicodedata.category(cc).startswith("P"))
+    return "".join(folded.lower().split())
+
+
+def match_key(track_name, track_artist, track_album):
+    return normalize(track_artist), normalize(track_album), normalize(track_name)
+
+
+class MatchIndex:
+    """In-memory lookup of beets items by their normalized artist, album and title.
+
+    Built once from every item in a library, so that each lookup is a dictionary access
+    rather than a query that has to scan the items table.
+    """
+
+    def __init__(self, items):
+        self._items = defaultdict(list)
+        for item in items:
+            self._items[match_key(item["title"], item["artist"], item["album"])].append(item)
+
+    def __len__(self):
+        return len(self._items)
+
+    def find_track(self, track_name, track_artist, track_album):
+        return self._items.get(match_key(track_name, track_artist, track_album), [])
+
+
+def find_album_track(items, track_name) -> list:
+    """Pick a track out of the items of its album, the way `find_track` would query for it.
+
+    Titles containing the requested one are found first, ignoring case, as the plain query
+    finds them. Only if there are none are the titles that are the same once normalized used,
+    as the regex query would find them.
+    """
+    title = str(track_name).lower()
+    if found := [item for item in items if title in str(item["title"]).lower()]:
+        return found
+    title = normalize(track_name)
+    return [item for item in items if normalize(item["title"]) == title]
+
+
+def fuzzy_tokens(token) -> tuple[str, ...]:
+    """Split a value into folded words for fuzzy comparison.
+
+    Unlike `normalize`, punctuation separates words, so "Rock-n-Roll" and "Rock 'N Roll" end up
+    the same. Accents are transliterated, and abbreviations, ordinals and numbers are folded
+    into a single spelling, e.g. "Pt. II", "Part Two" and "Part 2" are all "part 2".
+    """
+    text = str(token or "").replace("&", " and ")
+    text = "".join(" " if unicodedata.category(cc).startswith("P") else cc for cc in text)
+    text = REGEX_REPL.sub(" ", transliterate(text).lower())
+    tokens = []
+    for word in text.split():
+        if tokens and tokens[-1] in NUMBERED_WORDS and word in ROMAN_NUMERALS:
+            word = str(ROMAN_NUMERALS.index(word) + 1)
+        tokens.append(TOKEN_SYNONYMS.get(word, word))
+    return tuple(tokens)
+
+
+def similarity(tokens, other_tokens) -> float:
+    """Score how alike two sets of fuzzy tokens are, from 0.0 to 1.0.
+
+    Words are compared both in order and sorted, so that reordered titles still score well.
+    Titles with different numbers, e.g. "Part 1" and "Part 2", are rarely the same track, so
+    their score is halved.
+    """
+    in_order = SequenceMatcher(None, " ".join(tokens), " ".join(other_tokens)).ratio()
+    if in_order == 1.0:
+        return in_order
+    by_word = SequenceMatcher(
+        None, " ".join(sorted(tokens)), " ".join(sorted(other_tokens))
+    ).ratio()
+    score = max(in_order, by_word)
+    if {tt for tt in tokens if tt.isdigit()} != {tt for tt in other_tokens if tt.isdigit()}:
+        score /= 2
+    return score
+
+
+@dataclass(frozen=True)
+class FuzzyMatch:
+    item: Item
+    score: float
+    """How alike the titles are, from 0.0 to 1.0"""
+
+
+class FuzzyMatcher:
+    """Finds beets items whose titles are close to, but not the same as, the requested title.
+
+    Items are blocked by their folded artist and album, so a title is only scored against the
+    tracks of the same album rather than against the whole library.
+    """
+
+    def __init__(self, items, minimum_score=0.6):
+        self.minimum_score = minimum_score
+        """Candidates scoring below this are not worth reporting"""
+        self._blocks = defaultdict(list)
+        for item in items:
+            key = self.block_key(item["artist"], item["album"])
+            self._blocks[key].append((fuzzy_tokens(item["title"]), item))
+
+    @staticmethod
+    def block_key(track_artist, track_album):
+        # Spacing is ignored, so that "L.D. 50" and "LD 50" share a block
+        return "".join(fuzzy_tokens(track_artist)), "".join(fuzzy_tokens(track_album))
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def find_track(self, track_name, track_artist, track_album) -> list[FuzzyMatch]:
+        """Get the candidates for a track, best match first"""
+        tokens = fuzzy_tokens(track_name)
+        matches = [
+            FuzzyMatch(item, score)
+            for candidate_tokens, item in self._blocks.get(
+                self.block_key(track_artist, track_album), []
+            )
+            if (score := similarity(tokens, candidate_tokens)) >= self.minimum_score
+        ]
+        return sorted(matches, key=lambda mm: mm.score, reverse=True)
+
+
+class NormalizedKeyStore:
+    """Sidecar SQLite table of the normalized artist, album and title of every beets item.
+
+    Regex queries are evaluated by beets in Python for every item. Looking the normalized
+    values up in an indexed table instead is a B-tree search. Only the regex track lookup uses
+    the table, the album queries match substrings and are left to beets.
+
+    The table is refreshed from the items that were added or modified since the last refresh,
+    using the ``added`` and ``mtime`` columns of the beets library. Edits made to the beets
+    database alone, e.g. ``beet modify -W``, change neither, so a full refresh compares every
+    item with the artist, album and title its keys were made from instead.
+    """
+
+    def __init__(self, db_path, library_path):
+        self.db_path = Path(db_path).expanduser()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.library_path = os.fsdecode(library_path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            (version,) = self._conn.execute("PRAGMA user_version").fetchone()
+            if version != KEY_STORE_VERSION:
+                self._conn.execute("DROP TABLE IF EXISTS keys")
+                self._conn.execute("DROP TABLE IF EXISTS state")
+                self._conn.execute(f"PRAGMA user_version = {KEY_STORE_VERSION}")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS keys (
+                    item_id INTEGER PRIMARY KEY,
+                    artist TEXT NOT NULL,
+                    album TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    source TEXT NOT NULL
+                )"""
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS keys_by_track ON keys (artist, album, title)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value REAL NOT NULL)"
+            )
+
+    def refresh(self, full=False) -> int:
+        """Bring the keys up to date with the beets library.
+
+        Args:
+            full: Compare every item with the values its keys were made from, rather than only
+                looking at those added or modified since the last refresh. Also drops the keys
+                of removed items, which are otherwise left in place and skipped by lookups.
+
+        Returns:
+            int: The number of items whose keys were updated.
+        """
+        with self._lock, self._conn:
+            (watermark,) = self._conn.execute(
+                "SELECT COALESCE(MAX(value), 0) FROM state WHERE name = 'watermark'"
+            ).fetchone()
+            self._conn.execute("ATTACH DATABASE ? AS beets", (self.library_path,))
+            try:
+                # Items stamped at the watermark may have been stored after the last refresh,
+                # so they are compared again
+                recent = "" if full else "(items.mtime >= ? OR items.added >= ?) AND "
+                changed = self._conn.execute(
+                    "SELECT items.id, items.artist, items.album, items.title, "
+                    f"{ITEM_SOURCE}, MAX(items.mtime, items.added) "
+                    "FROM beets.items LEFT JOIN keys ON keys.item_id = items.id "
+                    f"WHERE {recent}(keys.item_id IS NULL OR keys.source != {ITEM_SOURCE})",
+                    () if full else (watermark, watermark),
+                ).fetchall()
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO keys (item_id, artist, album, title, source) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (
+                        (item_id, *match_key(title, artist, album), source)
+                        for item_id, artist, album, title, source, _ in changed
+                    ),
+                )
+                removed = 0
+                if full:
+                    removed = self._conn.execute(
+                        "DELETE FROM keys WHERE item_id NOT IN (SELECT id FROM beets.items)"
+                    ).rowcount
+                if changed:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO state (name, value) VALUES ('watermark', ?)",
+                        (max(watermark, *(row[-1] for row in changed)),),
+                    )
+                self._conn.commit()
+            finally:
+                # A database cannot be detached while a transaction is using it
+                self._conn.rollback()
+                self._conn.execute("DETACH DATABASE beets")
+        LOG.info("Refreshed %s normalized keys, removed %s", len(changed), removed)
+        return len(changed)
+
+    @timed("key_store_lookup")
+    def find_ids(self, track_artist, track_album, track_name) -> list[int]:
+        """Get the IDs of the items with the same normalized values, oldest first"""
+        query = (
+            "SELECT item_id FROM keys WHERE artist = ? AND album = ? AND title = ? "
+            "ORDER BY item_id"
+        )
+        with self._lock:
+            return [
+                item_id
+                for (item_id,) in self._conn.execute(
+                    query, match_key(track_name, track_artist, track_album)
+                )
+            ]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
 class ApiDataService:
-    def __init__(self, database_name):
+    def __init__(self, database_name, key_store_path=None, rebuild_keys=False):
+        """
+        Args:
+            database_name: The name of the beets library in the configuration.
+            key_store_path: Where to keep the `NormalizedKeyStore` of the library. Without
+                one, regex lookups are evaluated by beets.
+            rebuild_keys: Compare every item with its keys, rather than only refreshing those
+                added or modified since the last run.
+        """
+        self.name = database_name
         self.library = get_library(database_name)
+        self.key_store = None
+        if key_store_path:
+            self.key_store = NormalizedKeyStore(key_store_path, self.library.path)
+            self.key_store.refresh(full=rebuild_keys)
 
+    @timed("beets_query")
     def _execute_query(self, query):
         return self.library.items(query)
 
+    @timed("beets_query")
+    def _get_items(self, item_ids):
+        return [item for item_id in item_ids if (item := self.library.get_item(item_id))]
+
     def find_track(self, track_name, track_artist, track_album, use_regex=False):
+        if use_regex and self.key_store:
+            item_ids = self.key_store.find_ids(track_artist, track_album, track_name)
+            return self._get_items(item_ids)
         if use_regex:
             q = AndQuery(
                 subqueries=(
@@ -66,6 +395,87 @@ class ApiDataService:
     def load_all(self):
         return self._execute_query(None)
 
+    def build_match_index(self):
+        return MatchIndex(self.load_all())
+
+    def build_fuzzy_matcher(self):
+        return FuzzyMatcher(self.load_all())
+
+
+class LibrarySet:
+    """Searches several beets libraries at once, as if they were a single library.
+
+    Every library is queried at the same time, so a lookup takes as long as the slowest library
+    rather than all of them added up. The match index and fuzzy matcher cover the items of every
+    library, which keeps matching a track a single lookup however many libraries there are.
+    """
+
+    def __init__(self, services: dict[str, ApiDataService]):
+        self.services = services
+        self._names = {id(service.library): name for name, service in services.items()}
+        self._pool = ThreadPoolExecutor(
+            max_workers=max(len(services), 1), thread_name_prefix="library"
+        )
+
+    @classmethod
+    def open(cls, names, key_store_location=None, rebuild_keys=False) -> "LibrarySet":
+        """Open the named libraries concurrently.
+
+        Args:
+            names: The names of the beets libraries in the configuration.
+            key_store_location: Where to keep each library's `NormalizedKeyStore`, formatted
+                with the library name. Without one, regex lookups are evaluated by beets.
+            rebuild_keys: Compare every item of each library with its keys.
+        """
+
+        def _open(name):
+            key_store_path = key_store_location.format(name) if key_store_location else None
+            return ApiDataService(name, key_store_path, rebuild_keys)
+
+        with ThreadPoolExecutor(max_workers=max(len(names), 1)) as pool:
+            return cls(dict(zip(names, pool.map(_open, names))))
+
+    @property
+    def names(self) -> list[str]:
+        return list(self.services)
+
+    def library_of(self, item) -> str:
+        """The name of the library an item was found in"""
+        return self._names[id(item._db)]
+
+    def _from_all(self, method, *args, **kwargs) -> list:
+        def _call(service):
+            return list(getattr(service, method)(*args, **kwargs))
+
+        futures = [self._pool.submit(_call, service) for service in self.services.values()]
+        return list(chain.from_iterable(ff.result() for ff in futures))
+
+    def find_track(self, track_name, track_artist, track_album, use_regex=False):
+        return self._from_all(
+            "find_track", track_name, track_artist, track_album, use_regex=use_regex
+        )
+
+    def find_all_album_tracks(self, track_artist, track_album):
+        return self._from_all("find_all_album_tracks", track_artist, track_album)
+
+    def find_album(self, artist, album_name):
+        return self._from_all("find_album", artist, album_name)
+
+    def load_all(self):
+        return self._from_all("load_all")
+
+    def build_match_index(self):
+        return MatchIndex(self.load_all())
+
+    def build_fuzzy_matcher(self):
+        return FuzzyMatcher(self.load_all())
+
+    def close(self):
+        self._pool.shutdown()
+        for service in self.services.values():
+            if service.key_store:
+                service.key_store.close()
+
 
 class CliDataService:
     """A CLI-based version of interacting with the beets database.
@@ -76,7 +486,9 @@ class CliDataService:
     """
 
     def __init__(self, database_name):
-        self.exec = CMDS[database_name]["exec"]
+        self.name = database_name
+        _, cmds = settings.load()
+        self.exec = cmds[database_name]["exec"]
         self.config_loc = self.exec[CONFIG_LOC_INDEX]
 
     def _execute_query(self, cmd, query=None, fmt=None):
@@ -87,10 +499,8 @@ class CliDataService:
         else:
             args = [*self.exec, cmd]
 
-        resp = subprocess.run(
-            args,
-            capture_output=True,
-        )
+        with span(f"beet_{cmd}"):
+            resp = get_runner().run("beet", args)
         if resp.stderr:
             print(resp.stderr.decode("utf-8"))
         return resp.stdout.decode()
@@ -150,6 +560,22 @@ class CliDataService:
         resp = self._execute_convert([f"path:{current_beet_path}"])
         return resp.splitlines()
 
+    def convert_paths(self, beet_paths, threads=None):
+        """Convert several files with a single `beet convert` call.
+
+        Each file gets its own path query and the queries are OR'd together with a comma, so
+        that beets is only started once for the whole batch.
+        """
+        query = []
+        for beet_path in beet_paths:
+            if query:
+                query.append(",")
+            query.append(f"path:{beet_path}")
+        if threads:
+            query = ["-t", str(threads), *query]
+        resp = self._execute_convert(query)
+        return resp.splitlines()
+
 
 if __name__ == "__main__":
     test_db_service = False
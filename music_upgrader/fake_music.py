@@ -0,0 +1,486 @@
+"""A stand-in for Music.app that answers the AppleScript commands sent by this package.
+
+This allows the loaders, `ApplyUpgrade` and the `tracks` helpers to be tested, benchmarked and
+profiled on machines without Music, e.g. Linux. It can be used as an ``osascript`` replacement
+by setting the following environment variables::
+
+    MUSIC_UPGRADER_OSASCRIPT="python -m music_upgrader.fake_music"
+    MUSIC_UPGRADER_FAKE_LIBRARY=/path/to/library.json
+
+The library file is either a JSON list of tracks, each using the library CSV column names as
+keys, or a SQLite database (``.db``, ``.sqlite`` or ``.sqlite3``) with a ``tracks`` table of the
+same columns. Changes made by the commands are saved back to the file, so that every
+``osascript`` process sees the changes of those before it. A SQLite library only rewrites the
+changed rows.
+
+Every template in `applescript` is understood, as is ``scripts/load_all.applescript`` when it
+is passed as a script file. When started the way `applescript.PersistentTransport` starts its
+host, with ``-l JavaScript``, the fake keeps running and answers framed requests over
+stdin/stdout instead. `FakeMusicTransport` skips the process altogether.
+
+Music answers one command at a time, and a ``whose`` clause reads every track until it finds
+a match. The fake can be made to cost the same, with a fixed latency for every call, and a cost
+for every track a command reads while holding the library::
+
+    MUSIC_UPGRADER_FAKE_LATENCY=0.05
+    MUSIC_UPGRADER_FAKE_SCAN_COST=0.000002
+"""
+import contextlib
+import csv
+import fcntl
+import io
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+from . import applescript as apl
+
+FAKE_LIBRARY_ENV = "MUSIC_UPGRADER_FAKE_LIBRARY"
+"""Environment variable holding the location of the fake library file"""
+
+FAKE_LATENCY_ENV = "MUSIC_UPGRADER_FAKE_LATENCY"
+"""Environment variable holding the seconds added to every command"""
+
+FAKE_SCAN_COST_ENV = "MUSIC_UPGRADER_FAKE_SCAN_COST"
+"""Environment variable holding the seconds added for every track a command reads"""
+
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+"""Suffixes of library files kept in SQLite rather than JSON"""
+
+PROPERTY_FIELDS = {
+    "persistent ID": "persistent_id",
+    "track number": "track_number",
+    "name": "track_name",
+    "artist": "track_artist",
+    "album": "album",
+    "album artist": "album_artist",
+    "year": "track_year",
+    "played date": "last_played",
+    "played count": "play_count",
+    "location": "location",
+    "modification date": "modification_date",
+    "cloud status": "cloud_status",
+}
+"""Maps the AppleScript property names to the keys used by the fake library"""
+
+TRACK_BY_ID_RE = re.compile(r'first track whose persistent ID is "([^"]*)"')
+TRACK_BY_FIELDS_RE = re.compile(
+    r'first track whose artist is "(.*)" and name is "(.*)" and album is "(.*)"$', re.MULTILINE
+)
+BULK_PROPERTIES_RE = re.compile(r"set props to \{(.+?)\} of every file track")
+GET_FIELD_RE = re.compile(r"return (.+?) as text")
+SET_LOCATION_RE = re.compile(r'^\s*set newLoc to alias "(.*)"$', re.MULTILINE)
+SET_FIELD_RE = re.compile(r"^\s*set (year|played count) to (.*)$", re.MULTILINE)
+SET_LOCATIONS_RE = re.compile(r"^\s*set updates to (\{.*\})$", re.MULTILINE)
+LOCATED_UPDATE_RE = re.compile(r'\{(\d+), "((?:[^"\\]|\\.)*)", "((?:[^"\\]|\\.)*)"\}')
+CSV_HEADERS_RE = re.compile(r"^set csvHeaders to \{(.*)\}$", re.MULTILINE)
+DATA_FILE_RE = re.compile(
+    r'^set dataFile to \(\(path to home folder\) as text\) & "(.*)"$', re.MULTILINE
+)
+
+
+def _unquote(text: str) -> str:
+    return re.sub(r"\\(.)", r"\1", text)
+
+
+class ScriptError(Exception):
+    """Mimics an AppleScript execution error"""
+
+    def __init__(self, message, code=-2700):
+        super().__init__(message)
+        self.code = code
+
+    def __str__(self):
+        return f"execution error: {self.args[0]} ({self.code})"
+
+
+class JsonLibraryFile:
+    """A fake library kept in a JSON file, which is rewritten whenever a track changes"""
+
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+
+    def load(self) -> list[dict]:
+        return json.loads(self.path.read_text())
+
+    def write(self, tracks: list[dict]):
+        temp_path = self.path.with_name(f".{self.path.name}.tmp")
+        temp_path.write_text(json.dumps(tracks))
+        temp_path.replace(self.path)
+
+    def save(self, tracks: list[dict], changed: list[dict], fields: tuple[str, ...]):
+        self.write(tracks)
+
+
+class SqliteLibraryFile:
+    """A fake library kept in the ``tracks`` table of a SQLite database.
+
+    Only the changed columns of the changed tracks are written back.
+    """
+
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def load(self) -> list[dict]:
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            return [dict(row) for row in conn.execute("SELECT * FROM tracks ORDER BY rowid")]
+
+    def write(self, tracks: list[dict]):
+        columns = list(dict.fromkeys(["persistent_id", *(key for tt in tracks for key in tt)]))
+        names = ", ".join(f'"{column}"' for column in columns)
+        with self._connect() as conn:
+            conn.execute("DROP TABLE IF EXISTS tracks")
+            conn.execute(f"CREATE TABLE tracks ({names}, PRIMARY KEY (persistent_id))")
+            conn.executemany(
+                f"INSERT INTO tracks ({names}) VALUES ({', '.join('?' * len(columns))})",
+                ([track.get(column) for column in columns] for track in tracks),
+            )
+
+    def save(self, tracks: list[dict], changed: list[dict], fields: tuple[str, ...]):
+        assignments = ", ".join(f'"{field}" = ?' for field in fields)
+        values = [
+            [*(track.get(field) for field in fields), track["persistent_id"]]
+            for track in changed
+        ]
+        with self._connect() as conn:
+            conn.executemany(f"UPDATE tracks SET {assignments} WHERE persistent_id = ?", values)
+
+
+def open_library_file(path: Path | str) -> JsonLibraryFile | SqliteLibraryFile:
+    """Open a fake library file, choosing the format from its suffix"""
+    if Path(path).suffix in SQLITE_SUFFIXES:
+        return SqliteLibraryFile(path)
+    return JsonLibraryFile(path)
+
+
+def write_library(tracks: list[dict], path: Path | str):
+    """Write the tracks to a fake library file, in the format chosen by its suffix"""
+    open_library_file(path).write(tracks)
+
+
+class FakeMusic:
+    """A fake Music library, answering commands one at a time.
+
+    Args:
+        tracks: The tracks of the library, using the library CSV column names as keys.
+        library_file: Where the tracks are kept. The tracks are read again when the file was
+            changed by another process, and changes are saved to it. The file is locked while
+            a command runs, so commands from several processes are answered one at a time.
+        latency: Seconds added to every command, e.g. to start ``osascript`` and send the
+            Apple Event. Commands wait for it concurrently.
+        scan_cost: Seconds added for every track a command reads, while the library is held.
+    """
+
+    def __init__(
+        self,
+        tracks: list[dict],
+        library_file: Optional[JsonLibraryFile | SqliteLibraryFile] = None,
+        latency: float = 0.0,
+        scan_cost: float = 0.0,
+    ):
+        self.tracks = tracks
+        self.library_file = library_file
+        self.latency = latency
+        self.scan_cost = scan_cost
+        self.calls = 0
+        """Commands executed"""
+        self.tracks_read = 0
+        """Tracks read by every command executed, as counted by the cost model"""
+        self._lock = threading.Lock()
+        self._read = 0
+        self._positions: dict[str, int] = {}
+        self._version = self._file_version()
+
+    @classmethod
+    def from_file(cls, library_path: Path | str, **kwargs):
+        library_file = open_library_file(library_path)
+        return cls(library_file.load(), library_file, **kwargs)
+
+    @classmethod
+    def from_environment(cls):
+        """Open the library named by the environment, with the configured costs"""
+        return cls.from_file(
+            os.environ[FAKE_LIBRARY_ENV],
+            latency=float(os.environ.get(FAKE_LATENCY_ENV) or 0),
+            scan_cost=float(os.environ.get(FAKE_SCAN_COST_ENV) or 0),
+        )
+
+    def _file_version(self) -> Optional[tuple[int, int]]:
+        if self.library_file is None:
+            return None
+        stat = self.library_file.path.stat()
+        return stat.st_mtime_ns, stat.st_size
+
+    @contextlib.contextmanager
+    def _hold_library(self) -> Iterator[None]:
+        """Take the library for a command, reading it again if another process changed it"""
+        with self._lock:
+            if self.library_file is None:
+                yield
+                return
+            # The library file itself is replaced when saved, so another file is locked
+            lock_path = self.library_file.path.with_name(f"{self.library_file.path.name}.lock")
+            with lock_path.open("a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                if (version := self._file_version()) != self._version:
+                    self.tracks = self.library_file.load()
+                    self._version = version
+                yield
+
+    def _save(self, changed: list[dict], *fields: str):
+        if self.library_file is not None and changed:
+            self.library_file.save(self.tracks, changed, fields)
+            self._version = self._file_version()
+
+    def _scan(self, count: int):
+        """Count the tracks read by the command"""
+        self._read += count
+
+    def _position(self, persistent_id: str) -> Optional[int]:
+        """Where the track is in the library. The tracks can be changed by the caller, so the
+        positions are checked and worked out again when they are out of date"""
+        position = self._positions.get(persistent_id)
+        if position is None or position >= len(self.tracks) or (
+            self.tracks[position]["persistent_id"] != persistent_id
+        ):
+            self._positions = {tt["persistent_id"]: ii for ii, tt in enumerate(self.tracks)}
+            position = self._positions.get(persistent_id)
+        return position
+
+    def _find_by_id(self, persistent_id: str) -> dict:
+        position = self._position(persistent_id)
+        # A whose clause reads the tracks up to the first match
+        self._scan(len(self.tracks) if position is None else position + 1)
+        if position is None:
+            raise ScriptError(
+                f'Music got an error: Can’t get track with persistent ID "{persistent_id}"',
+                -1728,
+            )
+        return self.tracks[position]
+
+    def _find_by_fields(self, track_artist: str, track_name: str, track_album: str) -> dict:
+        # Text comparisons ignore case in AppleScript
+        wanted = (track_artist.casefold(), track_name.casefold(), track_album.casefold())
+        for position, track in enumerate(self.tracks):
+            fields = (track.get("track_artist"), track.get("track_name"), track.get("album"))
+            if tuple(str(ff or "").casefold() for ff in fields) == wanted:
+                self._scan(position + 1)
+                return track
+        self._scan(len(self.tracks))
+        raise ScriptError("Music got an error: Can’t get track 1 whose …", -1728)
+
+    @staticmethod
+    def _as_text(track: dict, prop: str, posix_location=False) -> str:
+        value = track.get(PROPERTY_FIELDS[prop])
+        if value is None or value == "":
+            return "missing value"
+        if prop == "location" and not posix_location:
+            return apl.posix_path_to_hfs_path(value)
+        return str(value)
+
+    def _load_properties(self, properties: list[str]) -> str:
+        unknown = [pp for pp in properties if pp not in PROPERTY_FIELDS]
+        if unknown:
+            raise ScriptError(f"Unknown properties: {', '.join(unknown)}")
+        self._scan(len(self.tracks) * len(properties))
+        return apl.RECORD_SEPARATOR.join(
+            apl.FIELD_SEPARATOR.join(self._bulk_text(track, prop) for track in self.tracks)
+            for prop in properties
+        )
+
+    def _bulk_text(self, track: dict, prop: str) -> str:
+        # The bulk load asks for the POSIX path of every location
+        if prop == "location":
+            location = self._as_text(track, prop, posix_location=True)
+            return "" if location == "missing value" else location
+        return self._as_text(track, prop)
+
+    def _track_info(self, track: dict) -> str:
+        info = [self._as_text(track, ff) for ff in apl.FILE_TRACK_PROPERTIES[1:-1]]
+        location = self._as_text(track, "location", posix_location=True)
+        info.append("" if location == "missing value" else location)
+        return "\n".join(info)
+
+    def _set_locations(self, updates: str) -> str:
+        results = []
+        changed = []
+        located = LOCATED_UPDATE_RE.findall(updates)
+        # Each track is read by its position, to check its persistent ID, then set
+        self._scan(len(located))
+        for position, track_id, hfs_path in located:
+            track_id = _unquote(track_id)
+            position = int(position) - 1
+            if position >= len(self.tracks) or self.tracks[position]["persistent_id"] != track_id:
+                results.append(f"{track_id}\tERR\t{apl.TRACK_MOVED_ERROR}")
+                continue
+            track = self.tracks[position]
+            track["location"] = apl.hfs_path_to_posix_path(_unquote(hfs_path))
+            changed.append(track)
+            results.append(f"{track_id}\tOK")
+        self._save(changed, "location")
+        return "\n".join(results)
+
+    def _set_field(self, track: dict, prop: str, value: str) -> str:
+        try:
+            number = int(value.strip())
+        except ValueError:
+            message = f"Can’t make {value.strip()} into type integer."
+            raise ScriptError(message, -1700) from None
+        track[PROPERTY_FIELDS[prop]] = number
+        self._save([track], PROPERTY_FIELDS[prop])
+        return ""
+
+    def _execute_on_track(self, track: dict, command: str) -> str:
+        """Execute what a command does with the track it selected"""
+        if apl.GET_TRACK_INFO in command:
+            return self._track_info(track)
+        if match := SET_LOCATION_RE.search(command):
+            track["location"] = apl.hfs_path_to_posix_path(match.group(1))
+            self._save([track], "location")
+            return ""
+        if match := SET_FIELD_RE.search(command):
+            return self._set_field(track, *match.groups())
+        if (match := GET_FIELD_RE.search(command)) and match.group(1) in PROPERTY_FIELDS:
+            return self._as_text(track, match.group(1))
+        raise ScriptError("The fake Music library does not understand this command")
+
+    def _execute(self, command: str) -> str:
+        stripped = command.strip()
+        if stripped in (apl.LOAD_ALL_FILE_IDS, apl.LOAD_ALL_IDS):
+            self._scan(len(self.tracks))
+            return ", ".join(track["persistent_id"] for track in self.tracks)
+        if stripped == apl.LOAD_ALL_PLAY_COUNTS:
+            # osascript flattens the two lists into one
+            self._scan(2 * len(self.tracks))
+            ids = (track["persistent_id"] for track in self.tracks)
+            counts = (self._as_text(track, "played count") for track in self.tracks)
+            return ", ".join((*ids, *counts))
+        if match := SET_LOCATIONS_RE.search(command):
+            return self._set_locations(match.group(1))
+        if match := BULK_PROPERTIES_RE.search(command):
+            return self._load_properties([pp.strip() for pp in match.group(1).split(",")])
+        if match := TRACK_BY_ID_RE.search(command):
+            return self._execute_on_track(self._find_by_id(match.group(1)), command)
+        if match := TRACK_BY_FIELDS_RE.search(command):
+            return self._execute_on_track(self._find_by_fields(*match.groups()), command)
+        raise ScriptError("The fake Music library does not understand this command")
+
+    def _answer(self, work, *args) -> str:
+        """Do the work of a command, charging for it as configured"""
+        if self.latency:
+            time.sleep(self.latency)
+        with self._hold_library():
+            self._read = 0
+            try:
+                return work(*args)
+            finally:
+                self.calls += 1
+                self.tracks_read += self._read
+                if self.scan_cost:
+                    time.sleep(self.scan_cost * self._read)
+
+    def execute(self, command: str) -> str:
+        """Execute a command, returning what ``osascript`` would print without the newline."""
+        return self._answer(self._execute, command)
+
+    def _library_csv(self, headers: list[str]) -> str:
+        """The library as ``scripts/load_all.applescript`` writes it, quoting included"""
+        by_field = {field: prop for prop, field in PROPERTY_FIELDS.items()}
+        self._scan(len(self.tracks) * len(headers))
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator="\n")
+        writer.writerow(headers)
+        for track in self.tracks:
+            # A location as text is an HFS path
+            writer.writerow([self._as_text(track, by_field[header]) for header in headers])
+        return output.getvalue().rstrip("\n")
+
+    def run_script(self, script: str) -> str:
+        """Run ``scripts/load_all.applescript``, writing the library CSV to the home folder"""
+        headers, data_file = CSV_HEADERS_RE.search(script), DATA_FILE_RE.search(script)
+        if not (headers and data_file):
+            raise ScriptError("The fake Music library only runs scripts/load_all.applescript")
+        headers = [header.strip().strip('"') for header in headers.group(1).split(",")]
+        path = Path.home().joinpath(*data_file.group(1).split(":"))
+        text = self._answer(self._library_csv, headers)
+        # Like the script, nothing is written when the folder does not exist
+        if path.parent.is_dir():
+            path.write_text(text)
+        return ""
+
+
+class FakeMusicTransport:
+    """Executes commands against a fake library in-process, in place of `osascript`"""
+
+    def __init__(self, music: FakeMusic):
+        self.music = music
+
+    def execute(self, command: str, timeout=None) -> tuple[str, str]:
+        try:
+            return f"{self.music.execute(command)}\n", ""
+        except ScriptError as e:
+            return "", f"{e}\n"
+
+    def close(self):
+        pass
+
+
+def serve(music: FakeMusic, stdin=None, stdout=None):
+    """Answer framed requests until stdin is closed, like the JXA host script does"""
+    stdin = stdin or sys.stdin.buffer
+    stdout = stdout or sys.stdout.buffer
+    while header := stdin.readline():
+        command = stdin.read(int(header)).decode("utf-8")
+        try:
+            response = apl.encode_response(True, music.execute(command))
+        except ScriptError as e:
+            response = apl.encode_response(False, str(e))
+        stdout.write(response)
+        stdout.flush()
+
+
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else argv
+    if not os.environ.get(FAKE_LIBRARY_ENV):
+        print(f"{FAKE_LIBRARY_ENV} must be set", file=sys.stderr)
+        return 1
+    if "-l" in args:
+        serve(FakeMusic.from_environment())
+        return 0
+    commands = [args[ii + 1] for ii, arg in enumerate(args[:-1]) if arg == "-e"]
+    try:
+        if commands:
+            print(FakeMusic.from_environment().execute("\n".join(commands)))
+        elif len(args) == 1:
+            script = Path(args[0]).read_text(encoding="utf-8", errors="replace")
+            print(FakeMusic.from_environment().run_script(script))
+        else:
+            print(
+                "Only -e commands and script files are supported by the fake Music library",
+                file=sys.stderr,
+            )
+            return 1
+    except ScriptError as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
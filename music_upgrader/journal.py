@@ -0,0 +1,123 @@
+"""Write-ahead journal of the rows processed by each stage.
+
+Before a row's side effects happen (files moved, tracks relocated), the stage records what it
+intends to do. Once the row is processed, its result is recorded too. Every change is committed
+straight away, so after a crash or Ctrl-C the journal says which rows finished, with their
+results, and which were left half done along with what they were doing at the time.
+
+The journal is an SQLite database in WAL mode, shared by every stage. Each stage only sees the
+entries of its own run, identified by the stage and the data file it processes.
+"""
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+STARTED = "started"
+DONE = "done"
+
+
+@dataclass(frozen=True)
+class JournalEntry:
+    state: str
+    intent: dict
+    result: Optional[dict]
+
+
+class Journal:
+    """Records the intent and outcome of each row of a stage's run.
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, path: Path | str, stage: str, source: Path | str):
+        self.path = Path(path).expanduser()
+        self.stage = stage
+        self.source = str(source)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # A commit in WAL mode survives the process being killed, which is the point here
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS rows (
+                    stage TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    row_index INTEGER NOT NULL,
+                    state TEXT NOT NULL,
+                    intent TEXT NOT NULL,
+                    result TEXT,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (stage, source, row_index)
+                )"""
+            )
+
+    def begin(self, row_index: int, intent: Optional[dict] = None):
+        """Record that a row is about to be processed, before any of its side effects"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?, ?, NULL, ?)",
+                (
+                    self.stage,
+                    self.source,
+                    row_index,
+                    STARTED,
+                    json.dumps(intent or {}, default=str),
+                    time.time(),
+                ),
+            )
+
+    def complete(self, row_index: int, result: dict):
+        """Record the result of a row"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO rows VALUES (?, ?, ?, ?, '{}', ?, ?) "
+                "ON CONFLICT (stage, source, row_index) "
+                "DO UPDATE SET state = excluded.state, result = excluded.result, "
+                "updated = excluded.updated",
+                (
+                    self.stage,
+                    self.source,
+                    row_index,
+                    DONE,
+                    json.dumps(dict(result), default=str),
+                    time.time(),
+                ),
+            )
+
+    def entry(self, row_index: int) -> Optional[JournalEntry]:
+        with self._lock:
+            found = self._conn.execute(
+                "SELECT state, intent, result FROM rows "
+                "WHERE stage = ? AND source = ? AND row_index = ?",
+                (self.stage, self.source, row_index),
+            ).fetchone()
+        if found is None:
+            return None
+        state, intent, result = found
+        return JournalEntry(state, json.loads(intent), json.loads(result) if result else None)
+
+    def unfinished(self) -> int:
+        """The number of rows that were started but never finished"""
+        with self._lock:
+            (count,) = self._conn.execute(
+                "SELECT COUNT(*) FROM rows WHERE stage = ? AND source = ? AND state = ?",
+                (self.stage, self.source, STARTED),
+            ).fetchone()
+        return count
+
+    def reset(self):
+        """Forget every row of this run"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM rows WHERE stage = ? AND source = ?", (self.stage, self.source)
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
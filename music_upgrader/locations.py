@@ -0,0 +1,26 @@
+"""Where the data files used for processing are kept.
+
+Kept apart from the processors, so that the command line can show them without importing beets.
+"""
+from pathlib import Path
+
+ROOT_LOCATION = "~/Code/Data/Music/Upgrader"
+"""Root location of the data files used for processing"""
+
+MODULE_PATH = (Path(__file__) / "..").resolve()
+"""The root path of the module"""
+
+PROBE_CACHE_LOCATION = f"{ROOT_LOCATION}/probe_cache.db"
+"""Location of the cached audio file details"""
+
+CONVERT_CACHE_LOCATION = f"{ROOT_LOCATION}/convert_cache"
+"""Location of the cached ALAC conversions"""
+
+CONVERT_CACHE_MAX_BYTES = 10 << 30
+"""Default size limit of the cached ALAC conversions"""
+
+KEY_STORE_LOCATION = f"{ROOT_LOCATION}/{{}}_keys.db"
+"""Location of the normalized keys of a beets library, formatted with the library name"""
+
+WORKING_DB_LOCATION = f"{ROOT_LOCATION}/working.db"
+"""Location of the working database, used instead of the CSV files with --working-db"""
@@ -1,23 +1,71 @@
+from datetime import datetime
 from pathlib import Path
 
 import click
 
-from .db import ApiDataService, CliDataService, CMDS
-from .processors import (
+from . import settings
+from .locations import (
+    CONVERT_CACHE_LOCATION,
+    CONVERT_CACHE_MAX_BYTES,
+    KEY_STORE_LOCATION,
     MODULE_PATH,
+    PROBE_CACHE_LOCATION,
     ROOT_LOCATION,
-    ApplyUpgrade,
-    ConvertFiles,
-    CopyFiles,
-    LoadLatestLibrary,
-    UpgradeCheck,
+    WORKING_DB_LOCATION,
 )
+from .metrics import METRICS_DIRECTORY, format_comparison, load_runs
 
 # from . import __version__
 
+# The processors, and beets and mutagen along with them, are only imported by the commands that
+# use them, so that `--help` and mistyped commands return straight away.
+
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
 
+MEGABYTE = 1 << 20
+
+workers_option = click.option(
+    "-w",
+    "--workers",
+    help="The number of rows to process at the same time",
+    type=click.IntRange(min=1),
+    default=1,
+)
+
+io_budget_option = click.option(
+    "--io-budget",
+    type=click.IntRange(min=1),
+    default=1024,
+    help="The most megabytes of files being copied at the same time",
+)
+
+resume_option = click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue an interrupted run, skipping the rows that were already processed",
+)
+
+redo_option = click.option(
+    "--redo",
+    is_flag=True,
+    help="With --working-db, process every row the step can, not only those waiting for it",
+)
+
+STAGE_NAMES = ("load", "check", "convert", "copy", "apply")
+"""Steps of the working database, matching music_upgrader.working_db.STAGES"""
+
+
+def open_working_db(ctx):
+    """The working database, if --working-db was given. Closed once the command finishes"""
+    if not ctx.obj.get("WORKING_DB"):
+        return None
+    from .working_db import WorkingDatabase
+
+    working_db = WorkingDatabase(WORKING_DB_LOCATION)
+    ctx.call_on_close(working_db.close)
+    return working_db
+
 
 @click.group(help="Tool to manage stuff", context_settings=CONTEXT_SETTINGS)
 # @click.version_option(__version__)
@@ -25,22 +73,56 @@ CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
     "-d",
     "--database",
     help="The database to use for upgrade checks",
-    type=click.Choice(CMDS.keys()),
+    type=click.Choice(settings.library_names()),
     default="physical",
 )
+@click.option(
+    "--persistent-applescript",
+    is_flag=True,
+    help="Send every AppleScript command to a single, long-running osascript process",
+)
+@click.option(
+    "--working-db",
+    is_flag=True,
+    help=f"Read and save the rows of every step in {WORKING_DB_LOCATION} instead of CSV files. "
+    "Each step then processes the rows waiting for it, and -f is ignored",
+)
 @click.pass_context
-def cli(ctx, database):
+def cli(ctx, database, persistent_applescript, working_db):
+    from .runner import cancel_on_interrupt
+
     ctx.ensure_object(dict)
     ctx.obj["DB_NAME"] = database
+    ctx.obj["WORKING_DB"] = working_db
+    # Ctrl-C kills the running osascript and beet processes instead of waiting for them
+    ctx.with_resource(cancel_on_interrupt())
+    if persistent_applescript:
+        from . import applescript as apl
+
+        apl.set_transport(apl.PersistentTransport())
 
 
 @cli.command(name="load-itunes")
+@click.option(
+    "--bulk/--per-track",
+    default=True,
+    help="Load all tracks with a single AppleScript call, or select each track individually",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only fetch the details of tracks that were added or modified since the last load",
+)
 @click.pass_context
-def load(ctx):
+def load(ctx, bulk, incremental):
+    from .processors import LoadLatestLibrary
+
     click.echo("Loading latest library data...")
     sp = MODULE_PATH / ".." / "scripts" / "load_all.applescript"
     dp = Path(f"{ROOT_LOCATION}/libraryFiles.csv").expanduser()
-    l = LoadLatestLibrary(sp, dp)
+    l = LoadLatestLibrary(
+        sp, dp, bulk=bulk, incremental=incremental, working_db=open_working_db(ctx)
+    )
     l.run()
 
 
@@ -52,46 +134,341 @@ def load(ctx):
     help=f"The library file name to process. Must be stored in {ROOT_LOCATION}",
     default="libraryFiles.csv"
 )
+@click.option(
+    "--index/--no-index",
+    default=True,
+    help="Match tracks against an in-memory index of the library instead of querying per track",
+)
+@click.option(
+    "--by-album",
+    is_flag=True,
+    help="Instead of the index, query the tracks of each album once and match the titles in "
+    "memory. Tracks that are not matched are still queried one at a time",
+)
+@click.option(
+    "--probe-cache/--no-probe-cache",
+    default=True,
+    help=f"Cache the details read from audio files in {PROBE_CACHE_LOCATION}",
+)
+@click.option(
+    "--verify-tags",
+    is_flag=True,
+    help="Only upgrade files whose title, album and artist tags match the beets file. Those "
+    "that do not are reported as DO_NOT_MATCH",
+)
+@click.option(
+    "--key-store/--no-key-store",
+    default=True,
+    help="Answer the regex track lookups from an indexed table of normalized keys kept next to "
+    "the data. Album lookups are still queried from beets",
+)
+@click.option(
+    "--rebuild-keys",
+    is_flag=True,
+    help="Compare every beets item with its normalized keys, rather than only those added or "
+    "modified since the last run. Needed after editing the beets database alone, e.g. with "
+    "beet modify -W",
+)
+@click.option(
+    "--fuzzy-threshold",
+    type=click.FloatRange(0.0, 1.0),
+    help="Compare the titles of tracks that were not found with those on the same album. "
+    "Matches scoring at least this are used, lower scores are reported for review",
+)
+@click.option(
+    "--all-libraries",
+    is_flag=True,
+    help="Search every configured library at once, instead of the one picked with --database. "
+    "The best file found is used, and its library recorded in b_library",
+)
+@workers_option
+@resume_option
+@redo_option
 @click.pass_context
-def check(ctx, _file):
+def check(
+    ctx,
+    _file,
+    index,
+    by_album,
+    probe_cache,
+    verify_tags,
+    key_store,
+    rebuild_keys,
+    fuzzy_threshold,
+    all_libraries,
+    workers,
+    resume,
+    redo,
+):
     """Check for files in the iTunes library that can be upgraded from files managed by beets."""
+    from .db import ApiDataService, LibrarySet
+    from .probes import ProbeCache
+    from .processors import UpgradeCheck
+
     click.echo("Checking upgrade ...")
     db_name = ctx.obj["DB_NAME"]
     p = Path(f"{ROOT_LOCATION}/{_file}").expanduser()
-    u = UpgradeCheck(p, ApiDataService(db_name))
-    u.run()
+    cache = ProbeCache(PROBE_CACHE_LOCATION) if probe_cache else None
+    if all_libraries:
+        db = LibrarySet.open(
+            settings.library_names(), KEY_STORE_LOCATION if key_store else None, rebuild_keys
+        )
+    else:
+        db = ApiDataService(
+            db_name, KEY_STORE_LOCATION.format(db_name) if key_store else None, rebuild_keys
+        )
+    u = UpgradeCheck(
+        p,
+        db,
+        enable_file_comparison=verify_tags,
+        use_index=index and not by_album,
+        workers=workers,
+        probe_cache=cache,
+        fuzzy_threshold=fuzzy_threshold,
+        by_album=by_album,
+    )
+    if working_db := open_working_db(ctx):
+        u.use_working_db(working_db, redo=redo)
+    u.run(resume=resume)
 
 
 @cli.command(name="copy-files")
 @click.option("-f", "--file", "_file", help="The file to process")
+@workers_option
+@io_budget_option
+@resume_option
+@redo_option
 @click.pass_context
-def copy_files(ctx, _file):
+def copy_files(ctx, _file, workers, io_budget, resume, redo):
     """Copy converted files to the appropriate location in your iTunes library."""
+    from .db import CliDataService
+    from .processors import CopyFiles
+    from .staging import FileStager, IOBudget
+
     click.echo("Copying files ...")
     db_name = ctx.obj["DB_NAME"]
     p = Path(f"{ROOT_LOCATION}/{_file}").expanduser()
-    u = CopyFiles(p, CliDataService(db_name))
-    u.run()
+    stager = FileStager(budget=IOBudget(io_budget * MEGABYTE))
+    u = CopyFiles(p, CliDataService(db_name), workers=workers, stager=stager)
+    if working_db := open_working_db(ctx):
+        u.use_working_db(working_db, redo=redo)
+    u.run(resume=resume)
 
 
 @cli.command(name="convert-files")
 @click.option("-f", "--file", "_file", help="The file to process")
+@workers_option
+@click.option(
+    "--batch",
+    "batch_by",
+    type=click.Choice(["album", "chunk"]),
+    help="Convert FLAC files in batches, grouped by album or in fixed-size chunks",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=20,
+    help="The most files converted by a single beet convert call",
+)
+@click.option(
+    "--convert-threads",
+    type=click.IntRange(min=1),
+    help="The number of threads beet convert uses for each batch",
+)
+@click.option(
+    "--link",
+    is_flag=True,
+    help="Hard link files that do not need converting into staging, when on the same volume. "
+    "Files are still copied before their tags are updated",
+)
+@click.option(
+    "--cache/--no-cache",
+    default=True,
+    help=f"Reuse earlier conversions of the same audio, kept in {CONVERT_CACHE_LOCATION}",
+)
+@click.option(
+    "--cache-size",
+    type=click.IntRange(min=0),
+    default=CONVERT_CACHE_MAX_BYTES // MEGABYTE,
+    help="The most megabytes of conversions to keep in the cache",
+)
+@io_budget_option
+@resume_option
+@redo_option
 @click.pass_context
-def convert_files(ctx, _file):
+def convert_files(
+    ctx,
+    _file,
+    workers,
+    batch_by,
+    batch_size,
+    convert_threads,
+    link,
+    cache,
+    cache_size,
+    io_budget,
+    resume,
+    redo,
+):
     """Round up higher quality files to the staging area, converting any FLAC to ALAC along the way."""
+    from .convert_cache import ConversionCache
+    from .db import CliDataService
+    from .processors import ConvertFiles
+    from .staging import FileStager, IOBudget
+
     click.echo("Converting files ...")
     db_name = ctx.obj["DB_NAME"]
     p = Path(f"{ROOT_LOCATION}/{_file}").expanduser()
-    u = ConvertFiles(p, CliDataService(db_name))
-    u.run()
+    stager = FileStager(link=link, budget=IOBudget(io_budget * MEGABYTE))
+    convert_cache = None
+    if cache:
+        convert_cache = ConversionCache(
+            CONVERT_CACHE_LOCATION, max_bytes=cache_size * MEGABYTE, stager=stager
+        )
+    u = ConvertFiles(
+        p,
+        CliDataService(db_name),
+        workers=workers,
+        batch_by=batch_by,
+        batch_size=batch_size,
+        convert_threads=convert_threads,
+        stager=stager,
+        convert_cache=convert_cache,
+    )
+    if working_db := open_working_db(ctx):
+        u.use_working_db(working_db, redo=redo)
+    u.run(resume=resume)
+    if convert_cache:
+        click.echo(f"Conversions reused from the cache: {convert_cache.hits}")
+        convert_cache.close()
+
+
+@cli.command(name="stats")
+@click.option("-s", "--stage", help="Only show runs of this stage, e.g. CopyFiles")
+@click.option(
+    "-n",
+    "--runs",
+    type=click.IntRange(min=1),
+    default=5,
+    help="The number of recent runs to show for each stage",
+)
+def stats(stage, runs):
+    """Compare the timings of recent runs of each stage."""
+    directory = Path(ROOT_LOCATION).expanduser() / METRICS_DIRECTORY
+    stages = load_runs(directory, stage=stage, limit=runs)
+    if not stages:
+        click.echo(f"No metrics found in {directory}")
+        return
+    for name, stage_runs in stages.items():
+        click.echo(click.style(name, bold=True))
+        click.echo(format_comparison(stage_runs))
+        click.echo()
+
+
+@cli.group(name="cache")
+def cache_group():
+    """Inspect and prune the cache of converted files."""
+
+
+@cache_group.command(name="info")
+def cache_info():
+    """Show how much the conversion cache holds."""
+    from .convert_cache import ConversionCache
+
+    cache = ConversionCache(CONVERT_CACHE_LOCATION)
+    stats = cache.stats()
+    cache.close()
+    click.echo(f"Location: {cache.directory}")
+    click.echo(f"Entries: {stats['entries']}")
+    click.echo(f"Size: {stats['size'] / MEGABYTE:.1f} MB")
+    if stats["oldest_use"]:
+        oldest = datetime.fromtimestamp(stats["oldest_use"]).isoformat(" ", "seconds")
+        click.echo(f"Least recently used: {oldest}")
+
+
+@cache_group.command(name="prune")
+@click.option(
+    "--max-size",
+    type=click.IntRange(min=0),
+    default=CONVERT_CACHE_MAX_BYTES // MEGABYTE,
+    help="Remove the least recently used conversions until the cache is at most this many MB",
+)
+@click.option("--all", "clear", is_flag=True, help="Remove every cached conversion")
+def cache_prune(max_size, clear):
+    """Remove the least recently used conversions from the cache."""
+    from .convert_cache import ConversionCache
+
+    cache = ConversionCache(CONVERT_CACHE_LOCATION)
+    removed, freed = cache.prune(0 if clear else max_size * MEGABYTE)
+    cache.close()
+    click.echo(f"Removed {removed} cached conversions, freeing {freed / MEGABYTE:.1f} MB")
+
+
+@cli.group(name="working-db")
+def working_db_group():
+    """Inspect the working database, and move rows between it and CSV files."""
+
+
+@working_db_group.command(name="status")
+def working_db_status():
+    """Show how many rows are waiting for each step."""
+    from .working_db import WorkingDatabase
+
+    working_db = WorkingDatabase(WORKING_DB_LOCATION)
+    click.echo(f"Location: {working_db.path}")
+    for stage in STAGE_NAMES[1:]:
+        click.echo(f"{stage:<10}{working_db.count_pending(stage):>10} waiting")
+    working_db.close()
+
+
+@working_db_group.command(name="export")
+@click.argument("stage", type=click.Choice(STAGE_NAMES))
+@click.argument("path", type=click.Path(dir_okay=False, path_type=Path))
+@click.option("--upgrades-only", is_flag=True, help="Only the tracks that can be upgraded")
+def working_db_export(stage, path, upgrades_only):
+    """Write the rows a step processed to a CSV file, with the columns the step writes."""
+    from .working_db import WorkingDatabase
+
+    working_db = WorkingDatabase(WORKING_DB_LOCATION)
+    count = working_db.export_csv(path, stage, upgrades_only=upgrades_only)
+    working_db.close()
+    click.echo(f"Exported {count} rows to {path}")
+
+
+@working_db_group.command(name="import")
+@click.argument("stage", type=click.Choice(STAGE_NAMES))
+@click.argument("path", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+def working_db_import(stage, path):
+    """Update the rows of a step from a CSV file, e.g. one exported and edited by hand.
+
+    Only the columns in the file are updated. Importing an earlier step's CSV file, e.g. a
+    libraryFiles.csv for the load step, starts the working database from it.
+    """
+    from .working_db import WorkingDatabase
+
+    working_db = WorkingDatabase(WORKING_DB_LOCATION)
+    count = working_db.import_csv(path, stage)
+    working_db.close()
+    click.echo(f"Imported {count} rows from {path}")
 
 
 @cli.command(name="apply-updates")
 @click.option("-f", "--file", "_file", help="The file to process")
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    help="Relocate this many tracks with each AppleScript call, rather than one at a time",
+)
+@resume_option
+@redo_option
 @click.pass_context
-def replace_files(ctx, _file):
+def replace_files(ctx, _file, batch_size, resume, redo):
     """Interface with iTunes and replace the file references with your new copies."""
+    from .processors import ApplyUpgrade
+
     click.echo("Replacing files ...")
     p = Path(f"{ROOT_LOCATION}/{_file}").expanduser()
-    a = ApplyUpgrade(p)
-    a.run()
+    a = ApplyUpgrade(p, batch_size=batch_size)
+    if working_db := open_working_db(ctx):
+        a.use_working_db(working_db, redo=redo)
+    a.run(resume=resume)
@@ -0,0 +1,236 @@
+"""Timing of the slow boundaries crossed while processing rows.
+
+Calls that leave Python, or read audio files, are wrapped in named spans: AppleScript commands,
+beets queries, ``beet`` commands, mutagen probes and file copies. While a stage runs, the time
+spent in each span is recorded in the active `Metrics`. When no metrics are active, a span costs
+a single global lookup.
+
+At the end of a run the stage writes a summary next to its results, as JSON and in the
+Prometheus textfile format, and ``mup stats`` compares the most recent runs.
+"""
+import functools
+import json
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+QUANTILES = (0.5, 0.95, 0.99)
+"""Quantiles reported for each span"""
+
+SAMPLE_SIZE = 1024
+"""Most durations kept for each span to estimate its quantiles from"""
+
+METRICS_DIRECTORY = "metrics"
+"""Directory of the output directory holding the metrics of each run"""
+
+
+class SpanStats:
+    """Count and total time of a span, with a uniform sample of its durations.
+
+    The sample is a reservoir of at most `SAMPLE_SIZE` durations, so the memory held for a span
+    does not grow with the length of the run. Quantiles are exact until the reservoir fills.
+    """
+
+    __slots__ = ("count", "total", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.samples: list[float] = []
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if len(self.samples) < SAMPLE_SIZE:
+            self.samples.append(seconds)
+        elif (slot := random.randrange(self.count)) < SAMPLE_SIZE:
+            self.samples[slot] = seconds
+
+    def summary(self) -> dict:
+        ordered = sorted(self.samples)
+        summary = {"count": self.count, "total": self.total}
+        for quantile in QUANTILES:
+            summary[f"p{round(quantile * 100)}"] = percentile(ordered, quantile)
+        return summary
+
+
+class Metrics:
+    """The time spent in each span during a run of a stage. Safe to share between threads."""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.started = datetime.now(timezone.utc)
+        self.rows = 0
+        self.spans: dict[str, SpanStats] = defaultdict(SpanStats)
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self.spans[name].add(seconds)
+
+    def summary(self) -> dict:
+        seconds = time.perf_counter() - self._start
+        with self._lock:
+            spans = {name: stats.summary() for name, stats in self.spans.items()}
+        return {
+            "stage": self.stage,
+            "started": self.started.isoformat(),
+            "seconds": seconds,
+            "rows": self.rows,
+            "rows_per_second": self.rows / seconds if seconds else 0.0,
+            "spans": spans,
+        }
+
+
+_active: Optional[Metrics] = None
+
+
+def set_metrics(metrics: Optional[Metrics]):
+    """Record spans in `metrics` from now on. None stops recording"""
+    global _active
+    _active = metrics
+
+
+def get_metrics() -> Optional[Metrics]:
+    return _active
+
+
+class span:
+    """Time a block of code as the named span, if metrics are being recorded"""
+
+    __slots__ = ("name", "metrics", "started")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.metrics = _active
+        if self.metrics is not None:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.metrics is not None:
+            self.metrics.record(self.name, time.perf_counter() - self.started)
+
+
+def timed(name: str):
+    """Decorator timing every call of a function as the named span"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            metrics = _active
+            if metrics is None:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.record(name, time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+def percentile(ordered: list[float], quantile: float) -> float:
+    """The nearest-rank percentile of sorted values"""
+    if not ordered:
+        return 0.0
+    return ordered[max(math.ceil(quantile * len(ordered)) - 1, 0)]
+
+
+def summarize(durations: list[float]) -> dict:
+    stats = SpanStats()
+    for seconds in durations:
+        stats.add(seconds)
+    return stats.summary()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def to_prometheus(summary: dict) -> str:
+    """Format a run summary for the Prometheus node exporter's textfile collector"""
+    stage = summary["stage"]
+    lines = [
+        "# HELP mup_span_seconds Time spent in each span of a stage",
+        "# TYPE mup_span_seconds summary",
+    ]
+    for name, stats in sorted(summary["spans"].items()):
+        for quantile in QUANTILES:
+            value = stats[f"p{round(quantile * 100)}"]
+            lines.append(
+                f"mup_span_seconds{_labels(stage=stage, span=name, quantile=quantile)} {value}"
+            )
+        lines.append(f"mup_span_seconds_sum{_labels(stage=stage, span=name)} {stats['total']}")
+        lines.append(f"mup_span_seconds_count{_labels(stage=stage, span=name)} {stats['count']}")
+    for metric, kind, key, help_text in (
+        ("mup_run_seconds", "gauge", "seconds", "Duration of the last run of a stage"),
+        ("mup_run_rows", "gauge", "rows", "Rows processed by the last run of a stage"),
+        ("mup_run_rows_per_second", "gauge", "rows_per_second", "Throughput of the last run"),
+    ):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        lines.append(f"{metric}{_labels(stage=stage)} {summary[key]}")
+    return "\n".join(lines) + "\n"
+
+
+def write_summary(summary: dict, directory: Path, name: str) -> Path:
+    """Write a run summary as `name`.json and `name`.prom, returning the JSON file"""
+    directory.mkdir(parents=True, exist_ok=True)
+    json_path = directory / f"{name}.json"
+    json_path.write_text(json.dumps(summary, indent=2))
+    (directory / f"{name}.prom").write_text(to_prometheus(summary))
+    return json_path
+
+
+def load_runs(directory: Path, stage: Optional[str] = None, limit=5) -> dict[str, list[dict]]:
+    """The most recent run summaries of each stage, oldest first"""
+    runs = defaultdict(list)
+    for path in directory.glob("*.json"):
+        summary = json.loads(path.read_text())
+        if stage is None or summary["stage"] == stage:
+            runs[summary["stage"]].append(summary)
+    return {
+        name: sorted(summaries, key=lambda ss: ss["started"])[-limit:]
+        for name, summaries in sorted(runs.items())
+    }
+
+
+def format_comparison(runs: list[dict]) -> str:
+    """Tabulate the runs of a stage, then the spans of the latest run against the one before"""
+    lines = [f"{'started':<22}{'rows':>10}{'seconds':>12}{'rows/s':>12}"]
+    for run in runs:
+        started = datetime.fromisoformat(run["started"]).astimezone().strftime("%Y-%m-%d %H:%M:%S")
+        lines.append(
+            f"{started:<22}{run['rows']:>10}{run['seconds']:>12.2f}{run['rows_per_second']:>12.1f}"
+        )
+    latest = runs[-1]["spans"]
+    previous = runs[-2]["spans"] if len(runs) > 1 else {}
+    lines.append("")
+    lines.append(
+        f"{'span':<22}{'count':>10}{'total s':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        f"{'vs prev':>10}"
+    )
+    for name, stats in sorted(latest.items(), key=lambda item: -item[1]["total"]):
+        change = ""
+        if (before := previous.get(name)) and before["total"]:
+            change = f"{(stats['total'] / before['total'] - 1) * 100:+.0f}%"
+        lines.append(
+            f"{name:<22}{stats['count']:>10}{stats['total']:>12.2f}{stats['p50'] * 1000:>10.1f}"
+            f"{stats['p95'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}{change:>10}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,175 @@
+"""Audio file details read with mutagen, cached in a sidecar SQLite database.
+
+Every comparison between an iTunes file and a beets file needs the format, quality and tags of
+both files. Reading those means parsing MP3 frames and FLAC/MP4 atoms, so the results are kept
+in a cache keyed by the file's path, size and modification time. A file is only read again once
+it has changed.
+"""
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import astuple, dataclass, fields
+from pathlib import Path
+from typing import Iterable, Optional
+
+import mutagen
+from mutagen.flac import FLAC
+from mutagen.mp3 import MP3
+from mutagen.mp4 import MP4
+
+from .metrics import timed
+
+LOG = logging.getLogger(__name__)
+
+TAG_FIELDS = ("title", "album", "artist")
+"""Tags stored alongside the audio details"""
+
+
+@dataclass(frozen=True)
+class AudioProbe:
+    path: str
+    size: int
+    mtime_ns: int
+    format: str
+    """The container, e.g. MP3, FLAC or MP4. Empty if mutagen did not recognize the file"""
+    codec: str
+    bitrate: int
+    sample_rate: int
+    bits_per_sample: int
+    length: float
+    title: Optional[str] = None
+    album: Optional[str] = None
+    artist: Optional[str] = None
+
+
+PROBE_COLUMNS = tuple(ff.name for ff in fields(AudioProbe))
+
+
+def _format_and_codec(audio) -> tuple[str, str]:
+    if isinstance(audio, MP3):
+        return "MP3", "mp3"
+    if isinstance(audio, FLAC):
+        return "FLAC", "flac"
+    if isinstance(audio, MP4):
+        return "MP4", audio.info.codec.lower()
+    if audio is None:
+        return "", ""
+    return type(audio).__name__, ""
+
+
+@timed("probe")
+def probe_file(path: Path | str, stat=None) -> AudioProbe:
+    """Read the audio details and tags of a file, opening it only once."""
+    stat = stat or Path(path).stat()
+    audio = mutagen.File(path, easy=True)
+    audio_format, codec = _format_and_codec(audio)
+    info = getattr(audio, "info", None)
+    tags = {}
+    for tag in TAG_FIELDS:
+        try:
+            tags[tag] = audio[tag][0]
+        except (KeyError, IndexError, TypeError):
+            tags[tag] = None
+    return AudioProbe(
+        path=str(path),
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        format=audio_format,
+        codec=codec,
+        bitrate=getattr(info, "bitrate", 0) or 0,
+        sample_rate=getattr(info, "sample_rate", 0) or 0,
+        bits_per_sample=getattr(info, "bits_per_sample", 0) or 0,
+        length=getattr(info, "length", 0.0) or 0.0,
+        **tags,
+    )
+
+
+class ProbeCache:
+    """Sidecar SQLite cache of `AudioProbe` values.
+
+    Safe to share between threads. Files are only read when they are missing from the cache or
+    their size or modification time has changed.
+    """
+
+    def __init__(self, db_path: Path | str):
+        self.db_path = Path(db_path).expanduser()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS probes (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    format TEXT,
+                    codec TEXT,
+                    bitrate INTEGER,
+                    sample_rate INTEGER,
+                    bits_per_sample INTEGER,
+                    length REAL,
+                    title TEXT,
+                    album TEXT,
+                    artist TEXT
+                )"""
+            )
+        self.hits = 0
+        self.misses = 0
+        """Number of files that had to be read"""
+
+    def _lookup(self, path: str, stat) -> Optional[AudioProbe]:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(PROBE_COLUMNS)} FROM probes WHERE path = ?", (path,)
+            ).fetchone()
+            if row and row[1] == stat.st_size and row[2] == stat.st_mtime_ns:
+                self.hits += 1
+                return AudioProbe(*row)
+        return None
+
+    def _store(self, probe: AudioProbe):
+        columns = ", ".join(PROBE_COLUMNS)
+        placeholders = ", ".join("?" for _ in PROBE_COLUMNS)
+        with self._lock, self._conn:
+            self.misses += 1
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO probes ({columns}) VALUES ({placeholders})",
+                astuple(probe),
+            )
+
+    def get(self, path: Path | str) -> AudioProbe:
+        """Get the details of a file, reading it only if the cached copy is missing or stale."""
+        path = str(path)
+        stat = Path(path).stat()
+        if probe := self._lookup(path, stat):
+            return probe
+        probe = probe_file(path, stat)
+        self._store(probe)
+        return probe
+
+    def warm(self, paths: Iterable[Path | str], workers=8) -> int:
+        """Probe any of the given files that are not cached yet, using a pool of threads.
+
+        Returns:
+            int: The number of files that were read.
+        """
+        misses = self.misses
+        unique_paths = {str(pp) for pp in paths if pp}
+
+        def _get(path):
+            try:
+                self.get(path)
+            except (OSError, mutagen.MutagenError):
+                LOG.warning("Could not probe %s", path)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_get, unique_paths))
+        read = self.misses - misses
+        LOG.debug("Warmed probe cache for %s files, %s read", len(unique_paths), read)
+        return read
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,28 +1,44 @@
 import concurrent.futures
 import csv
+import json
 import logging
 import subprocess
+import threading
+from collections import OrderedDict, defaultdict, deque
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timezone
-from itertools import groupby
+from itertools import islice
 from pathlib import Path
 from typing import Final, Optional
 
 import beets.dbcore.query
 import mutagen
 import yaml
-from dateutil.parser import ParserError, parse
 from rich.progress import Progress
 
 from . import applescript as apl
-from . import tracks
-from .db import ApiDataService, CliDataService
-
-ROOT_LOCATION = "~/Code/Data/Music/Upgrader"
-"""Root location of the data files used for processing"""
-
-MODULE_PATH = (Path(__file__) / "..").resolve()
-"""The root path of the module"""
+from . import quality, tracks
+from .convert_cache import ConversionCache, sync_tags
+from .db import (
+    ApiDataService,
+    CliDataService,
+    FuzzyMatch,
+    FuzzyMatcher,
+    LibrarySet,
+    MatchIndex,
+    find_album_track,
+)
+from .journal import Journal
+from .locations import ROOT_LOCATION
+from .metrics import METRICS_DIRECTORY, Metrics, set_metrics, span, write_summary
+from .probes import ProbeCache, probe_file
+from .records import CSV_HEADER, TrackRecord, intern_values, parse_played_date
+from .runner import get_runner
+from .staging import FileStager
+from .working_db import WorkingDatabase
+
+JOURNAL_FILE_NAME = "journal.db"
+"""Name of the journal of processed rows, kept in the output directory"""
 
 DATE_FORMAT_FOR_FILES = "%Y%m%dT%H%M%SZ"
 """Date format to use when saving files"""
@@ -30,24 +46,37 @@ DATE_FORMAT_FOR_FILES = "%Y%m%dT%H%M%SZ"
 SPACING = " " * len("Checking...")
 """Spacing used to format output"""
 
-CSV_HEADER = ("persistent_id", "track_number", "track_name", "track_artist", "album", "album_artist", "track_year", "last_played", "play_count", "location")
+PROBE_WARM_CHUNK = 256
+"""Rows whose files are probed ahead of them at a time, when warming the probe cache"""
 
-def read_csv(file_path: Path):
-    data = []
+ALBUM_CACHE_SIZE = 64
+"""Albums whose tracks are kept when matching by album. The rows are sorted by album, so this
+only needs to cover the albums the workers are on at once"""
+
+
+def iter_csv(file_path: Path):
+    """Read the rows of a CSV file one at a time, as track records"""
     if not file_path.exists():
         print("FILE NOT FOUND")
-        return data
+        return
 
     with file_path.open("r") as csv_file:
         reader = csv.DictReader(csv_file)
-        for row in reader:
+        for row in map(TrackRecord, reader):
             if "last_played" in row:
-                try:
-                    row["last_played"] = parse(row["last_played"])
-                except ParserError:
-                    row["last_played"] = None
-            data.append(row)
-    return data
+                row["last_played"] = parse_played_date(row["last_played"])
+            yield row
+
+
+def read_csv(file_path: Path):
+    return list(iter_csv(file_path))
+
+
+def count_csv_rows(file_path: Path) -> int:
+    if not file_path.exists():
+        return 0
+    with file_path.open("r") as csv_file:
+        return max(sum(1 for _ in csv.reader(csv_file)) - 1, 0)
 
 
 def write_csv(data, file_path: Path):
@@ -57,21 +86,82 @@ def write_csv(data, file_path: Path):
         writer.writerows(data)
 
 
+class CsvAppender:
+    """Appends rows to a CSV file as soon as they are processed.
+
+    The file is only created once the first row is written. When appending to an existing file,
+    its header is reused.
+    """
+
+    def __init__(self, file_path: Path):
+        self.file_path = file_path
+        self.rows = 0
+        self._file = None
+        self._writer = None
+
+    def write(self, row: dict):
+        if self._writer is None:
+            fieldnames = None
+            if self.file_path.exists():
+                with self.file_path.open("r") as csv_file:
+                    fieldnames = next(csv.reader(csv_file), None)
+            self._file = self.file_path.open("a")
+            self._writer = csv.DictWriter(self._file, fieldnames=fieldnames or row.keys())
+            if not fieldnames:
+                self._writer.writeheader()
+        self._writer.writerow(row)
+        self._file.flush()
+        self.rows += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def write_run_metrics(metrics: Metrics, data_path: Path, output_dir: Path):
+    """Write the summary of a run to the metrics directory, where `mup stats` reads it"""
+    summary = metrics.summary()
+    name = f"{data_path.stem}_{metrics.stage}_{metrics.started.strftime(DATE_FORMAT_FOR_FILES)}"
+    path = write_summary(summary, output_dir / METRICS_DIRECTORY, name)
+    logging.getLogger(__name__).info(
+        "Processed %s rows in %.1fs (%.1f rows/s). Metrics written to %s",
+        summary["rows"],
+        summary["seconds"],
+        summary["rows_per_second"],
+        path,
+    )
+
+
 class LoadLatestLibrary:
-    def __init__(self, script_path: Path, data_path: Path):
+    DELTA_PROPERTIES = ("persistent ID", "modification date", "played date", "played count")
+    """Properties fetched for every track when only loading what changed"""
+
+    FULL_RELOAD_RATIO = 0.25
+    """Reload everything in bulk when more than this share of the library changed"""
+
+    def __init__(
+        self,
+        script_path: Path,
+        data_path: Path,
+        bulk=True,
+        incremental=False,
+        working_db: Optional[WorkingDatabase] = None,
+    ):
         self.script_path = script_path
-        self.data_path = data_path
+        self.data_path = working_db.path if working_db else data_path
+        self.bulk = bulk
+        self.incremental = incremental
+        self.working_db = working_db
+        """Load the library into this database, instead of the data file"""
+        self.snapshot_path = data_path.with_name(f"{data_path.stem}_snapshot.json")
+        """Modification dates of the tracks in the data file, used for incremental loads"""
+        self.output_dir = Path(ROOT_LOCATION).expanduser()
+        self.logger = logging.getLogger(__name__)
 
-    def run(self):
-        if self.data_path.exists():
-            print("Backing up previous data file...")
-            now = datetime.now(timezone.utc)
-            self.data_path.rename(
-                self.data_path.with_stem(
-                    f"{self.data_path.stem}_{now.strftime(DATE_FORMAT_FOR_FILES)}"
-                )
-            )
-        ids = tracks.load_all_ids()
+    def _load_per_track(self, ids=None):
+        """Load the library by selecting each track by its persistent ID. Slow for larger libraries."""
+        if ids is None:
+            ids = tracks.load_all_ids()
         num_ids = len(ids)
         with Progress() as progress:
 
@@ -82,19 +172,129 @@ class LoadLatestLibrary:
                 return track_id, *track_info.splitlines()
 
             main_task = progress.add_task("Collecting Library Details...", total=num_ids)
-            with ThreadPoolExecutor(max_workers=8) as pool:
-                items = sorted(pool.map(_get_track_info, ids), key=lambda x: (x[3], x[4], int(x[1])))
+            # The runner limits how many osascript processes run, so a thread waits on each one
+            workers = get_runner().backends["osascript"].concurrency
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                return list(pool.map(_get_track_info, ids))
+
+    def _load_full(self):
+        """Load every track, along with the modification dates for the next incremental load"""
+        if self.bulk:
+            loaded = tracks.load_all_bulk((*apl.FILE_TRACK_PROPERTIES, "modification date"))
+            return [item[:-1] for item in loaded], {item[0]: item[-1] for item in loaded}
+        loaded = self._load_per_track()
+        modified = {item[0]: item[1] for item in tracks.load_all_bulk(self.DELTA_PROPERTIES)}
+        return loaded, modified
+
+    def _read_previous(self):
+        """Read the previous data file and snapshot, or None if either is missing"""
+        if not (self.data_path.exists() and self.snapshot_path.exists()):
+            return None
+        if self.working_db is not None:
+            previous = self.working_db.library()
+            return (previous, json.loads(self.snapshot_path.read_text())) if previous else None
+        with self.data_path.open() as csv_file:
+            reader = csv.reader(csv_file)
+            if tuple(next(reader, ())) != CSV_HEADER:
+                return None
+            previous = {row[0]: intern_values(tuple(row)) for row in reader}
+        return previous, json.loads(self.snapshot_path.read_text())
+
+    def _load_changes(self, previous, previous_modified):
+        """Fetch full details only for the tracks that are new or were modified since last time.
+
+        Play counts and dates are refreshed for every track, since playing a track does not
+        change its modification date. Tracks that are no longer in the library are dropped.
+        """
+        current = tracks.load_all_bulk(self.DELTA_PROPERTIES)
+        modified = {track_id: mod_date for track_id, mod_date, _, _ in current}
+        changed = [
+            track_id
+            for track_id, mod_date in modified.items()
+            if track_id not in previous or previous_modified.get(track_id) != mod_date
+        ]
+        self.logger.info(
+            "%s tracks in library, %s new or changed, %s removed",
+            len(current),
+            len(changed),
+            len(previous.keys() - modified.keys()),
+        )
+        if len(changed) > len(current) * self.FULL_RELOAD_RATIO:
+            self.logger.info("Too many changes, reloading the full library")
+            return self._load_full()
+
+        fetched = {item[0]: item for item in self._load_per_track(changed)} if changed else {}
+        items = []
+        for track_id, _, played_date, played_count in current:
+            if track_id in fetched:
+                items.append(fetched[track_id])
+            else:
+                # Replace the last_played and play_count columns
+                item = previous[track_id]
+                items.append((*item[:7], played_date, played_count, *item[9:]))
+        return items, modified
 
-        with self.data_path.open("w") as csv_file:
-            writer = csv.writer(csv_file)
-            writer.writerow(CSV_HEADER)
-            writer.writerows(items)
+    def run(self):
+        metrics = Metrics(type(self).__name__)
+        set_metrics(metrics)
+        try:
+            items = self._load()
+            metrics.rows = len(items)
+        finally:
+            set_metrics(None)
+            write_run_metrics(metrics, self.data_path, self.output_dir)
         return items
 
+    def _load(self):
+        previous = self._read_previous() if self.incremental else None
+        if self.data_path.exists() and self.working_db is None:
+            print("Backing up previous data file...")
+            now = datetime.now(timezone.utc)
+            self.data_path.rename(
+                self.data_path.with_stem(
+                    f"{self.data_path.stem}_{now.strftime(DATE_FORMAT_FOR_FILES)}"
+                )
+            )
+        if previous:
+            loaded, modified = self._load_changes(*previous)
+        else:
+            if self.incremental:
+                self.logger.info("No previous snapshot found, loading the full library")
+            loaded, modified = self._load_full()
+        items = sorted(map(intern_values, loaded), key=lambda x: (x[3], x[4], int(x[1])))
+
+        if self.working_db is not None:
+            self.working_db.load_library(items)
+        else:
+            with self.data_path.open("w") as csv_file:
+                writer = csv.writer(csv_file)
+                writer.writerow(CSV_HEADER)
+                writer.writerows(items)
+        self.snapshot_path.write_text(json.dumps(modified))
+        return items
+
+
+def _row_index(csv_row) -> Optional[int]:
+    """Position of a row in the data file, if it is known"""
+    return getattr(csv_row, "index", None)
+
 
 class BaseProcess:
-    def __init__(self, data_file):
+    STAGE: Optional[str] = None
+    """Name of the stage in the working database"""
+
+    def __init__(self, data_file, workers=1):
         self.data_path = Path(data_file)
+        self.workers = workers
+        self.output_dir = Path(ROOT_LOCATION).expanduser()
+        self.working_db: Optional[WorkingDatabase] = None
+        """Rows are read from and saved to this database instead of CSV files, when set"""
+        self.redo = False
+        """Process every row the stage can in the working database, not only pending ones"""
+        self._path_locks = defaultdict(threading.Lock)
+        self._path_locks_guard = threading.Lock()
+        self.journal: Optional[Journal] = None
+        """Records the progress of each row while the process is run"""
         # TODO - set up logger to be on the class name
         # TODO TODO - configure
         self.logger = logging.getLogger(__name__)
@@ -102,52 +302,322 @@ class BaseProcess:
     def process_row(self, csv_row):
         raise NotImplementedError
 
-    def process_csv(self):
+    def intent_for(self, csv_row) -> dict:
+        """What processing a row is about to do, recorded in the journal before it is done"""
+        return {}
 
-        data = read_csv(self.data_path)
-        self.logger.info("Read data file: %s", self.data_path)
-        results = []
-        for row in data:
-            processed = self.process_row(row)
-            results.append(processed)
-        return results
+    def recover(self, csv_row, intent: dict) -> Optional[dict]:
+        """Deal with a row that an interrupted run left half done.
+
+        Args:
+            csv_row: The row.
+            intent: What the interrupted run recorded it was about to do.
+
+        Returns:
+            Optional[dict]: The processed row, if it could be finished. None to process the row
+                again, after rolling back anything that would get in the way.
+        """
+        return None
+
+    def replay(self, csv_row) -> Optional[dict]:
+        """The result of a row an earlier run processed, finishing it if it was left half done."""
+        if self.journal is None or _row_index(csv_row) is None:
+            return None
+        entry = self.journal.entry(csv_row.index)
+        if entry is None:
+            return None
+        if entry.result is not None:
+            return entry.result
+        self.logger.warning("Row %s was left half done. Recovering", csv_row.index + 1)
+        result = self.recover(csv_row, entry.intent)
+        if result is not None:
+            self.journal.complete(csv_row.index, result)
+        return result
+
+    def begin_row(self, csv_row):
+        if self.journal is not None and _row_index(csv_row) is not None:
+            self.journal.begin(csv_row.index, self.intent_for(csv_row))
+
+    def complete_row(self, csv_row, processed):
+        if self.journal is not None and _row_index(csv_row) is not None:
+            self.journal.complete(csv_row.index, processed)
+
+    def _process_journaled(self, csv_row):
+        if (processed := self.replay(csv_row)) is not None:
+            return processed
+        self.begin_row(csv_row)
+        with span("row"):
+            processed = self.process_row(csv_row)
+        self.complete_row(csv_row, processed)
+        return processed
+
+    def lock_for(self, path) -> threading.Lock:
+        """Get the lock guarding a file, so that rows sharing a file are not processed at once."""
+        with self._path_locks_guard:
+            return self._path_locks[str(path)]
+
+    def iter_results(self, rows):
+        """Process rows as they are read, yielding the results in the same order as the rows.
+
+        With more than one worker, rows are processed by a pool of threads. Only a few rows per
+        worker are in flight at any time, so memory use does not grow with the size of the file.
+        """
+        if self.workers <= 1:
+            for row in rows:
+                yield self._process_journaled(row)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque()
+            for row in rows:
+                pending.append(pool.submit(self._process_journaled, row))
+                if len(pending) >= self.workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def process_rows(self, data):
+        """Process each row, using a pool of threads if more than one worker was requested."""
+        return list(self.iter_results(data))
+
+    def prepare(self, rows):
+        """Called with the rows about to be processed, before any of them are processed."""
+
+    def results(self, rows):
+        """Produce the processed rows, in order"""
+        return self.iter_results(rows)
 
-    def process_csv_v2(self):
-        data = read_csv(self.data_path)
+    def process_csv(self):
+        self.prepare(iter_csv(self.data_path))
         self.logger.info("Read data file: %s", self.data_path)
-        with ThreadPoolExecutor(max_workers=8) as pool:
-            results = sorted(pool.map(self.process_row, data), key=lambda x: (x[3], x[4], int(x[1])))
-        return results
+        return list(self.results(iter_csv(self.data_path)))
+
+    def output_files(self, timestamp: str) -> dict[str, Path]:
+        """The files results are written to, by name"""
+        file_name = f"{self.data_path.stem}_results_{timestamp}.csv"
+        return {"results": self.output_dir / file_name}
+
+    def output_for(self, processed) -> str:
+        """The name of the output file a processed row belongs in"""
+        return "results"
+
+    @property
+    def checkpoint_path(self) -> Path:
+        return self.output_dir / f".{self.data_path.stem}_{type(self).__name__}.checkpoint.json"
+
+    def _start(self, resume) -> tuple[dict[str, Path], int]:
+        """Pick the output files and the number of rows to skip, recording them in a checkpoint"""
+        stat = self.data_path.stat()
+        source = {
+            "data_file": str(self.data_path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+        if resume:
+            if self.checkpoint_path.exists():
+                checkpoint = json.loads(self.checkpoint_path.read_text())
+                if checkpoint["source"] != source:
+                    raise ValueError(f"{self.data_path} changed since the last run. Cannot resume")
+                outputs = {name: Path(path) for name, path in checkpoint["outputs"].items()}
+                done = sum(count_csv_rows(path) for path in outputs.values())
+                self.logger.info("Resuming. Skipping %s rows that were already processed", done)
+                return outputs, done
+            self.logger.info("Nothing to resume. Starting from the beginning")
 
-    def run(self):
-        # with Progress() as progress:
-        #     pass
-        processed = self.process_csv()
         now = datetime.now(timezone.utc)
-        file_name = f"{self.data_path.stem}_results_{now.strftime(DATE_FORMAT_FOR_FILES)}.csv"
-        out_location = Path(f"{ROOT_LOCATION}/{file_name}").expanduser()
-        write_csv(processed, out_location)
-        self.logger.info("Wrote results to %s", out_location)
+        outputs = self.output_files(now.strftime(DATE_FORMAT_FOR_FILES))
+        self.checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+        self.checkpoint_path.write_text(
+            json.dumps({"source": source, "outputs": {kk: str(vv) for kk, vv in outputs.items()}})
+        )
+        return outputs, 0
+
+    def _start_journal(self, resume):
+        self.journal = Journal(
+            self.output_dir / JOURNAL_FILE_NAME, type(self).__name__, self.data_path.resolve()
+        )
+        if not resume:
+            if unfinished := self.journal.unfinished():
+                self.logger.warning(
+                    "Discarding %s rows an earlier run left half done. "
+                    "Use --resume to recover them",
+                    unfinished,
+                )
+            self.journal.reset()
 
+    def use_working_db(self, working_db: WorkingDatabase, redo=False):
+        """Read the rows waiting for this stage from a working database, and save them to it.
 
-class UpgradeCheck(BaseProcess):
+        Args:
+            working_db: The database
+            redo: Process every row the stage can, even those it already processed
+        """
+        self.working_db = working_db
+        self.redo = redo
+        self.data_path = working_db.path
+
+    def read_rows(self, skip=0):
+        """The rows to process, after the first `skip`"""
+        if self.working_db is not None:
+            return self.working_db.pending(self.STAGE, redo=self.redo)
+        return self._numbered_rows(skip)
+
+    def _numbered_rows(self, skip: int):
+        """Read the rows of the data file after the first `skip`, recording their positions"""
+        for index, row in enumerate(islice(iter_csv(self.data_path), skip, None), start=skip):
+            row.index = index
+            yield row
+
+    def run(self, resume=False):
+        """Process the data file, appending each result to the output files as it is produced.
+
+        A checkpoint is kept until every row is processed, so that an interrupted run can be
+        resumed by skipping the rows that already made it into the output files. Each row is
+        also journaled, so rows that finished without making it into the output files are not
+        processed again, and rows that were interrupted part way are finished or rolled back.
+
+        With a working database, the rows waiting for the stage are read from it and each result
+        is saved back to it instead. Rows saved there are no longer waiting, so no checkpoint is
+        needed.
+        """
+        if not self.data_path.exists():
+            print("FILE NOT FOUND")
+            return
+        outputs, done = self._start(resume) if self.working_db is None else ({}, 0)
+        self._start_journal(resume)
+        writers = {name: CsvAppender(path) for name, path in outputs.items()}
+        metrics = Metrics(type(self).__name__)
+        set_metrics(metrics)
+        try:
+            with span("prepare"):
+                self.prepare(self.read_rows(done))
+            for processed in self.results(self.read_rows(done)):
+                if self.working_db is not None:
+                    self.working_db.save(self.STAGE, processed)
+                else:
+                    writers[self.output_for(processed)].write(processed)
+                metrics.rows += 1
+            if self.working_db is not None:
+                # Saved before the journal is cleared, so no result is lost in between
+                self.working_db.commit()
+            self.journal.reset()
+        finally:
+            if self.working_db is not None:
+                self.working_db.commit()
+            set_metrics(None)
+            for writer in writers.values():
+                writer.close()
+            self.journal.close()
+            self.journal = None
+            write_run_metrics(metrics, self.data_path, self.output_dir)
+        self.checkpoint_path.unlink(missing_ok=True)
+        for writer in writers.values():
+            if writer.rows:
+                self.logger.info("Wrote %s results to %s", writer.rows, writer.file_path)
 
-    def __init__(self, data_file, db: ApiDataService, enable_file_comparison=False):
-        super().__init__(data_file)
+
+class UpgradeCheck(BaseProcess):
+    STAGE = "check"
+
+    def __init__(
+        self,
+        data_file,
+        db: ApiDataService | LibrarySet,
+        enable_file_comparison=False,
+        use_index=True,
+        workers=1,
+        probe_cache: Optional[ProbeCache] = None,
+        fuzzy_threshold: Optional[float] = None,
+        by_album=False,
+    ):
+        super().__init__(data_file, workers=workers)
         self.db = db
+        self.multi_library = isinstance(db, LibrarySet)
+        """Whether several libraries are searched, in which case the best candidate is used"""
         self.should_compare_files = enable_file_comparison
+        self.use_index = use_index
+        self.probe_cache = probe_cache
+        self.fuzzy_threshold = fuzzy_threshold
+        """Fuzzy matches scoring at least this are used as if the track was found. None disables
+        fuzzy matching, otherwise lower scoring matches are reported for review"""
+        self._match_index: Optional[MatchIndex] = None
+        self._match_index_lock = threading.Lock()
+        self._fuzzy_matcher: Optional[FuzzyMatcher] = None
+        self.by_album = by_album
+        """Without the index, query the tracks of each album once and match the titles in
+        memory, rather than querying for every track"""
+        self._albums: OrderedDict[tuple, concurrent.futures.Future] = OrderedDict()
         self.logger.info("Initialized. Will compare files? - %s", enable_file_comparison)
 
+    @property
+    def match_index(self) -> MatchIndex:
+        """The normalized match index for the library, built on first use"""
+        with self._match_index_lock:
+            if self._match_index is None:
+                self.logger.info("Building match index...")
+                self._match_index = self.db.build_match_index()
+                self.logger.info("Match index built with %s keys", len(self._match_index))
+        return self._match_index
+
+    @property
+    def fuzzy_matcher(self) -> FuzzyMatcher:
+        """The fuzzy title matcher for the library, built on first use"""
+        with self._match_index_lock:
+            if self._fuzzy_matcher is None:
+                self.logger.info("Building fuzzy matcher...")
+                self._fuzzy_matcher = self.db.build_fuzzy_matcher()
+                self.logger.info("Fuzzy matcher built with %s albums", len(self._fuzzy_matcher))
+        return self._fuzzy_matcher
+
+    def album_tracks(self, track_artist, track_album) -> list:
+        """The beets items of an album, queried once for all of the album's rows"""
+        key = (track_artist, track_album)
+        with self._match_index_lock:
+            album = self._albums.get(key)
+            is_new = album is None
+            if is_new:
+                album = self._albums[key] = concurrent.futures.Future()
+                if len(self._albums) > ALBUM_CACHE_SIZE:
+                    self._albums.popitem(last=False)
+            else:
+                self._albums.move_to_end(key)
+        if is_new:
+            # Other workers on the same album wait for this query rather than repeating it
+            try:
+                album.set_result(self._query_album(track_artist, track_album))
+            except BaseException as e:
+                album.set_exception(e)
+        return album.result()
+
+    def _query_album(self, track_artist, track_album) -> list:
+        self.logger.info("Querying API for the album '%s' by %s", track_album, track_artist)
+        try:
+            return list(self.db.find_all_album_tracks(track_artist, track_album))
+        except beets.dbcore.query.InvalidQueryError:
+            self.logger.exception("Invalid query provided to beets API.")
+            return []
+
     def process_row(self, csv_row):
         row_cpy = csv_row.copy()
         track_artist = csv_row["track_artist"]
         track_title = csv_row["track_name"]
         track_album = csv_row["album"]
         self.logger.info("Processing: '%s' by %s from the album '%s'", track_title, track_artist, track_album)
-        if result := self.check_for_track(track_title, track_artist, track_album):
-            found = result.get()
+        result = self.check_for_track(track_title, track_artist, track_album)
+        fuzzy_match = None
+        if not result and self.fuzzy_threshold is not None:
+            fuzzy_match = self.find_fuzzy_match(track_title, track_artist, track_album)
+            if fuzzy_match and fuzzy_match.score >= self.fuzzy_threshold:
+                result = [fuzzy_match.item]
+        found = None
+        ranked = []
+        if result:
+            ranked = self.rank_candidates(result)
+            found = ranked[0][0]
             new_file = found["path"].decode("utf-8")
-            upgrade_reason = self.determine_upgrade_status(csv_row["location"], new_file, self.should_compare_files)
+            upgrade_reason = self.determine_upgrade_status(
+                csv_row["location"], new_file, self.should_compare_files, self.probe_cache
+            )
             can_upgrade = upgrade_reason in ["BETTER_QUALITY"]
             if can_upgrade:
                 self.logger.info("\tthis track will be upgraded due to: %s", upgrade_reason)
@@ -158,35 +628,104 @@ class UpgradeCheck(BaseProcess):
                 row_cpy["year_action"] = "itunes_year"
             else:
                 self.logger.info("\tthis track will not be upgraded. Reason: %s", upgrade_reason)
+        elif fuzzy_match:
+            upgrade_reason = "FUZZY_MATCH"
+            can_upgrade = False
+            self.logger.info("\tthis track has a possible match that needs review")
         else:
             upgrade_reason = "NOT_FOUND"
             can_upgrade = False
             self.logger.info("\tthis track was not found in the database")
+        if self.fuzzy_threshold is not None:
+            # Every row gets the columns, since they make up the header of the output files
+            row_cpy["match_score"] = round(fuzzy_match.score, 3) if fuzzy_match else ""
+            row_cpy["match_title"] = fuzzy_match.item["title"] if fuzzy_match else ""
+        if self.multi_library:
+            found = found or (fuzzy_match.item if fuzzy_match else None)
+            row_cpy["b_library"] = self.db.library_of(found) if found else ""
+        best = ranked[0][1] if ranked else None
+        runner_up = ranked[1][1] if len(ranked) > 1 else None
+        row_cpy["b_score"] = best.score if best else ""
+        row_cpy["runner_up_file"] = runner_up.path if runner_up else ""
+        row_cpy["runner_up_score"] = runner_up.score if runner_up else ""
         row_cpy["upgrade_reason"] = upgrade_reason
         row_cpy["can_upgrade"] = can_upgrade
         return row_cpy
 
+    def rank_candidates(self, candidates) -> list[tuple[dict, Optional[quality.QualityScore]]]:
+        """Score every match found, best first. The first match found wins a tie.
+
+        Matches whose file cannot be read are left out, unless none of them can be read, in
+        which case the first match is kept without a score.
+        """
+        by_path = {}
+        for candidate in candidates:
+            by_path.setdefault(candidate["path"].decode("utf-8"), candidate)
+        ranked = [(by_path[ss.path], ss) for ss in quality.rank(by_path, self.probe_cache)]
+        if len(ranked) > 1:
+            best, score = ranked[0]
+            where = f" in the {self.db.library_of(best)} library" if self.multi_library else ""
+            self.logger.info(
+                "\tbest of %s candidates scores %s%s", len(ranked), score.score, where
+            )
+        return ranked or [(candidates[0], None)]
+
+    def find_fuzzy_match(self, track_title, track_artist, track_album) -> Optional[FuzzyMatch]:
+        """Find the closest title on the same album, for tracks the queries could not find"""
+        if matches := self.fuzzy_matcher.find_track(track_title, track_artist, track_album):
+            best = matches[0]
+            self.logger.info(
+                "\tclosest match is '%s' with a score of %.3f", best.item["title"], best.score
+            )
+            return best
+        return None
+
     @staticmethod
-    def determine_upgrade_status(current_track_location, proposed_track, should_compare_file_tags) -> str:
+    def determine_upgrade_status(
+        current_track_location,
+        proposed_track,
+        should_compare_file_tags,
+        probe_cache: Optional[ProbeCache] = None,
+    ) -> str:
+        """Compare the current file with the proposed one.
+
+        Each file is probed once, and the same details are used to compare both their tags and
+        their quality, so verifying the tags costs little more than not verifying them.
+        """
 
-        def _is_upgradable(_curr, _new):
-            if tracks.is_upgradable(_curr, _new):
-                return "BETTER_QUALITY"
-            else:
-                return "SAME_QUALITY"
+        def _probe(path):
+            return probe_cache.get(path) if probe_cache is not None else probe_file(path)
 
-        if should_compare_file_tags:
-            if tracks.is_same_track(current_track_location, proposed_track):
-                return _is_upgradable(current_track_location, proposed_track)
-            else:
-                return "DO_NOT_MATCH"
-        else:
-            return _is_upgradable(current_track_location, proposed_track)
+        current, proposed = _probe(current_track_location), _probe(proposed_track)
+        if should_compare_file_tags and not tracks.tags_match(current, proposed):
+            return "DO_NOT_MATCH"
+        if quality.is_better(quality.score_probe(proposed), quality.score_probe(current)):
+            return "BETTER_QUALITY"
+        return "SAME_QUALITY"
 
     def check_for_track(self, track_title, track_artist, track_album):
         """Look for the file within the selected beets library"""
+        query_modes = (False, True)
+        if self.use_index:
+            if result := self.match_index.find_track(track_title, track_artist, track_album):
+                self.logger.debug("Found match in index")
+                return result
+            # The index folds punctuation and spacing the way the regex query loosens them, so
+            # it already covers what that query would find. The plain query is a substring
+            # match, so it is still worth trying.
+            query_modes = (False,)
+        elif self.by_album:
+            if result := find_album_track(
+                self.album_tracks(track_artist, track_album), track_title
+            ):
+                self.logger.debug("Found match in the album's tracks")
+                return result
+            # The album's tracks come from the plain query, so only the regex query can find
+            # more
+            query_modes = (True,)
+
         result = None
-        for use_regex in False, True:
+        for use_regex in query_modes:
             try:
                 self.logger.info("Querying API. Using Regex? %s", use_regex)
                 result = self.db.find_track(
@@ -205,44 +744,61 @@ class UpgradeCheck(BaseProcess):
         return result
 
     def process_csv(self):
-
-        data = read_csv(self.data_path)
-
         for_upgrade = []
         no_upgrade = []
-        for row in data:
-            processed = self.process_row(row)
+        for processed in super().process_csv():
             if processed["can_upgrade"]:
                 for_upgrade.append(processed)
             else:
                 no_upgrade.append(processed)
         return for_upgrade, no_upgrade
 
-    def process_csv_v2(self):
-        data = read_csv(self.data_path)
-        self.logger.info("Read data file: %s", self.data_path)
-        with ThreadPoolExecutor(max_workers=8) as pool:
-            results = sorted(pool.map(self.process_row, data), key=lambda x: (x[3], x[4], int(x[1])))
+    def results(self, rows):
+        if self.probe_cache is not None:
+            rows = self._warmed(rows)
+        return super().results(rows)
+
+    def _warmed(self, rows):
+        """Pass the rows through, with the files of the next chunk of rows probed while the
+        current chunk is processed. Only two chunks of rows are held at once."""
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="warm") as warmer:
+            chunk = list(islice(rows, PROBE_WARM_CHUNK))
+            warming = warmer.submit(self.warm_probe_cache, chunk)
+            while chunk:
+                warming.result()
+                next_chunk = list(islice(rows, PROBE_WARM_CHUNK))
+                if next_chunk:
+                    warming = warmer.submit(self.warm_probe_cache, next_chunk)
+                yield from chunk
+                chunk = next_chunk
+
+    def warm_probe_cache(self, data):
+        """Read the details of every file the rows will compare, in parallel.
+
+        Only the index is used to find the beets files, so rows that only match through a beets
+        query are probed when they are processed. Every candidate is probed, as all of them are
+        scored to pick the best.
+        """
 
-        grouped = groupby(results, key=lambda x: x["can_upgrade"])
-        return results
+        def _paths():
+            for row in data:
+                yield row["location"]
+                if self.use_index:
+                    found = self.match_index.find_track(
+                        row["track_name"], row["track_artist"], row["album"]
+                    )
+                    yield from (ff["path"].decode("utf-8") for ff in found)
 
-    def run(self):
-        # with Progress() as progress:
-        #     pass
-        processed, no_upgrade = self.process_csv()
-        now = datetime.now(timezone.utc)
-        out_location = Path(
-            f"{ROOT_LOCATION}/upgrade_checks_{now.strftime(DATE_FORMAT_FOR_FILES)}.csv"
-        ).expanduser()
-        write_csv(processed, out_location)
-        self.logger.info("Saving: %s", out_location)
-        noup_location = Path(
-            f"{ROOT_LOCATION}/no_upgrade_{now.strftime(DATE_FORMAT_FOR_FILES)}.csv"
-        ).expanduser()
-        if no_upgrade:
-            write_csv(no_upgrade, noup_location)
-            self.logger.info("Saving: %s", noup_location)
+        self.probe_cache.warm(_paths(), workers=max(self.workers, 8))
+
+    def output_files(self, timestamp: str) -> dict[str, Path]:
+        return {
+            "upgrade": self.output_dir / f"upgrade_checks_{timestamp}.csv",
+            "no_upgrade": self.output_dir / f"no_upgrade_{timestamp}.csv",
+        }
+
+    def output_for(self, processed) -> str:
+        return "upgrade" if processed["can_upgrade"] else "no_upgrade"
 
 
 class CopyFiles(BaseProcess):
@@ -254,9 +810,41 @@ class CopyFiles(BaseProcess):
     This simply copies the files over. It does not call any AppleScript!
     """
 
-    def __init__(self, data_file, service: CliDataService):
-        super().__init__(data_file)
+    STAGE = "copy"
+
+    def __init__(
+        self, data_file, service: CliDataService, workers=1, stager: Optional[FileStager] = None
+    ):
+        super().__init__(data_file, workers=workers)
         self.service = service
+        self.stager = stager or FileStager()
+
+    @staticmethod
+    def target_for(csv_row) -> Path:
+        """Where the new file of a row is placed, next to the file it replaces"""
+        return Path(csv_row["location"]).parent / Path(csv_row["new_file"]).name
+
+    def intent_for(self, csv_row) -> dict:
+        target_path = self.target_for(csv_row)
+        return {
+            "source": csv_row["new_file"],
+            "target": str(target_path),
+            "backup": str(target_path.with_suffix(".bak")) if target_path.exists() else None,
+        }
+
+    def recover(self, csv_row, intent: dict) -> Optional[dict]:
+        """Finish a row whose file was moved, or put back a target that was only backed up."""
+        source, target = Path(intent["source"]), Path(intent["target"])
+        backup = Path(intent["backup"]) if intent["backup"] else None
+        if target.exists() and (backup is None or backup.exists()):
+            # Moves between filesystems copy the file before removing the source
+            source.unlink(missing_ok=True)
+            self.logger.info("\tFile move to %s had completed", target)
+            return {**csv_row, "new_file": str(target), "target_existed": backup is not None}
+        if backup is not None and backup.exists():
+            backup.rename(target)
+            self.logger.info("\tRestored the backup of %s", target)
+        return None
 
     def process_row(self, csv_row):
         """Process a row for copying the intended new file to the music library location.
@@ -269,19 +857,19 @@ class CopyFiles(BaseProcess):
 
         original_track_path = Path(csv_row["location"])
         self.logger.info("Replacing '%s' with '%s'", original_track_path, file_to_copy)
-        original_parent = original_track_path.parent
-        target_path = original_parent / file_to_copy.name
+        target_path = self.target_for(csv_row)
         self.logger.info("\tTarget path: %s", target_path)
         target_exists = False
         if target_path.is_dir():
             raise ValueError("\tTarget should not be a directory!")
-        if target_path.exists():
-            target_exists = True
-            backup_target = target_path.with_suffix(".bak")
-            target_path.rename(backup_target)
-            self.logger.info("\tBacking up previous file found at target")
-        file_to_copy.rename(target_path)
-        self.logger.info("\tFile move complete")
+        with self.lock_for(target_path):
+            if target_path.exists():
+                target_exists = True
+                backup_target = target_path.with_suffix(".bak")
+                target_path.rename(backup_target)
+                self.logger.info("\tBacking up previous file found at target")
+            method = self.stager.move(file_to_copy, target_path)
+        self.logger.info("\tFile move complete using %s", method)
 
         row_cpy["new_file"] = str(target_path)
         row_cpy["target_existed"] = target_exists
@@ -299,39 +887,181 @@ class ConvertFiles(BaseProcess):
     This simply copies the files over. It does not call any AppleScript!
     """
 
-    def __init__(self, data_file, service: CliDataService):
-        super().__init__(data_file)
+    STAGE = "convert"
+
+    def __init__(
+        self,
+        data_file,
+        service: CliDataService,
+        workers=1,
+        batch_by: Optional[str] = None,
+        batch_size=20,
+        convert_threads: Optional[int] = None,
+        stager: Optional[FileStager] = None,
+        convert_cache: Optional[ConversionCache] = None,
+    ):
+        super().__init__(data_file, workers=workers)
         self.service = service
-        with Path(self.service.config_loc).expanduser().open() as config_file:
-            self.output_location = Path(
-                yaml.load(config_file, Loader=yaml.SafeLoader)["convert"]["dest"]
-            ).expanduser()
+        self.stager = stager or FileStager()
+        self.batch_by = batch_by
+        """How FLAC files are grouped for conversion: 'album', 'chunk' or None for one at a time"""
+        self.batch_size = batch_size
+        self.convert_threads = convert_threads
+        self.convert_cache = convert_cache
+        self._converted = set()
+        self._cached = set()
+        """FLAC files whose conversion came from the cache"""
+        self._cache_keys = {}
+        self._services = {}
+        self._library_of = {}
+        """The library each FLAC file came from, when the upgrade checks searched several"""
+        self._convert_configs = {}
+        self._services_lock = threading.Lock()
+        self.output_location, self.convert_settings = self.convert_config(service)
         # assert self.output_location.exists()
         self.logger.info("ConvertFiles initialized. Outputting files to %s", self.output_location)
 
+    def convert_config(self, service: CliDataService) -> tuple[Path, dict]:
+        """Where a library's beets places converted files, and the settings it converts with"""
+        with self._services_lock:
+            if service.config_loc not in self._convert_configs:
+                with Path(service.config_loc).expanduser().open() as config_file:
+                    convert_config = yaml.load(config_file, Loader=yaml.SafeLoader)["convert"]
+                self._convert_configs[service.config_loc] = (
+                    Path(convert_config["dest"]).expanduser(),
+                    # The settings that decide what a converted file looks like
+                    {kk: vv for kk, vv in convert_config.items() if kk != "dest"},
+                )
+            return self._convert_configs[service.config_loc]
+
+    def service_for(self, flac_file: Path | str) -> CliDataService:
+        """The beets command line of the library a FLAC file came from"""
+        library = self._library_of.get(str(flac_file))
+        if not library or library == getattr(self.service, "name", None):
+            return self.service
+        with self._services_lock:
+            if library not in self._services:
+                self._services[library] = CliDataService(library)
+            return self._services[library]
+
+    def batch_files(self, data) -> list[list[str]]:
+        """Group the FLAC files of the given rows into batches of at most `batch_size` files.
+
+        When batching by album, files from the same directory are kept together. Files from
+        different libraries are never in the same batch.
+        """
+        new_files = {}
+        for row in data:
+            new_files[row["new_file"]] = row.get("b_library") or None
+            if row.get("b_library"):
+                self._library_of[row["new_file"]] = row["b_library"]
+        flac_files = [ff for ff in new_files if Path(ff).suffix.lower() == ".flac"]
+        groups = defaultdict(list)
+        for flac_file in flac_files:
+            album = Path(flac_file).parent if self.batch_by == "album" else None
+            groups[new_files[flac_file], album].append(flac_file)
+        groups = list(groups.values())
+        return [
+            group[ii:ii + self.batch_size]
+            for group in groups
+            for ii in range(0, len(group), self.batch_size)
+        ]
+
+    def converted_path(self, flac_file: Path) -> Path:
+        """Where beets places the ALAC file converted from a FLAC file"""
+        output_location, _ = self.convert_config(self.service_for(flac_file))
+        parts = flac_file.parts
+        return output_location.joinpath(*parts[parts.index("FLAC"):]).with_suffix(".m4a")
+
+    def _cache_key(self, flac_file: Path) -> str:
+        if (key := self._cache_keys.get(flac_file)) is None:
+            _, convert_settings = self.convert_config(self.service_for(flac_file))
+            key = self._cache_keys[flac_file] = ConversionCache.key_for(flac_file, convert_settings)
+        return key
+
+    def fetch_cached(self, flac_file: Path) -> bool:
+        """Stage a previous conversion of the file from the cache, if there is one"""
+        if self.convert_cache.fetch(self._cache_key(flac_file), self.converted_path(flac_file)):
+            self.logger.info("Using cached conversion of %s", flac_file)
+            self._cached.add(str(flac_file))
+            return True
+        return False
+
+    def store_converted(self, flac_file: Path):
+        converted = self.converted_path(flac_file)
+        if converted.exists():
+            self.convert_cache.store(self._cache_key(flac_file), converted, flac_file)
+
+    def convert_in_batches(self, data):
+        """Convert the FLAC files of every row up front, with one `beet convert` per batch."""
+        batches = self.batch_files(data)
+        self.logger.info("Converting FLAC files in %s batches", len(batches))
+
+        def _convert(batch):
+            to_convert = batch
+            if self.convert_cache:
+                to_convert = [ff for ff in batch if not self.fetch_cached(Path(ff))]
+            if to_convert:
+                self.logger.info("Converting batch of %s files", len(to_convert))
+                self.service_for(to_convert[0]).convert_paths(
+                    to_convert, threads=self.convert_threads
+                )
+                if self.convert_cache:
+                    for flac_file in to_convert:
+                        self.store_converted(Path(flac_file))
+            return batch
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for converted in pool.map(_convert, batches):
+                self._converted.update(converted)
+
+    def prepare(self, rows):
+        if self.batch_by:
+            self.convert_in_batches(rows)
+
     def process_row(self, csv_row):
         """Process a row for copying the intended new file to the music library location.
 
         Copy the intended new file to the staging location. If the new file is a FLAC file,
         it will be converted to ALAC and this converted file will be used instead.
         """
+        # Rows that share a source file would otherwise write the same staged file at once
+        with self.lock_for(csv_row["new_file"]):
+            return self._stage_row(csv_row)
+
+    def _stage_row(self, csv_row):
         track_artist = csv_row["track_artist"]
         track_title = csv_row["track_name"]
         track_album = csv_row["album"]
 
         def _convert_track():
             """Convert a FLAC file to ALAC, which stages the file to a new location."""
-            self.logger.info("Converting... '%s' by %s from the album", track_title, track_artist, track_album)
-            self.service.convert_2(new_file_path)
-            self.logger.info("Conversion complete")
-            parts = new_file_path.parts
-            t = list(parts[parts.index("FLAC"):])
-            return self.output_location.joinpath(*t).with_suffix(".m4a")
+            if new_file_source in self._converted:
+                self.logger.info("Already converted as part of a batch")
+            elif not (self.convert_cache and self.fetch_cached(new_file_path)):
+                self.logger.info(
+                    "Converting... '%s' by %s from the album %s",
+                    track_title,
+                    track_artist,
+                    track_album,
+                )
+                self.service_for(new_file_path).convert_2(new_file_path)
+                self.logger.info("Conversion complete")
+                if self.convert_cache:
+                    self.store_converted(new_file_path)
+            converted = self.converted_path(new_file_path)
+            if new_file_source in self._cached:
+                # Cached conversions keep the tags beets had when they were converted
+                if changed := sync_tags(new_file_path, converted):
+                    self.logger.info("Updated tags from the FLAC file: %s", ", ".join(changed))
+            return converted
 
         self.logger.info("Processing %s by %s from the album %s", track_title, track_artist, track_album)
         row_cpy = csv_row.copy()
         new_file_source = csv_row["new_file"]
         new_file_path: Final[Path] = Path(new_file_source)
+        if csv_row.get("b_library"):
+            self._library_of[new_file_source] = csv_row["b_library"]
         if (
             new_file_path.suffix.lower() == ".flac"
         ):  # Could use Mutagen for this, but seems a bit overkill
@@ -355,7 +1085,7 @@ class ConvertFiles(BaseProcess):
             file_ext = new_file_name.split(".")[-1]
             dest_root_dir = self.output_location / file_ext.upper()
             if not dest_root_dir.exists():
-                dest_root_dir.mkdir(parents=True)
+                dest_root_dir.mkdir(parents=True, exist_ok=True)
                 self.logger.debug("Created %s Destination directory", file_ext.upper())
 
             _parts = new_file_path.parts
@@ -365,7 +1095,8 @@ class ConvertFiles(BaseProcess):
             if not track_path.parent.exists():
                 track_path.parent.mkdir(parents=True, exist_ok=True)
                 self.logger.debug("Created album directory")
-            track_path.write_bytes(new_file_path.read_bytes())
+            method = self.stager.copy(new_file_path, track_path)
+            self.logger.debug("Staged using %s", method)
 
             file_to_copy = track_path
 
@@ -393,6 +1124,8 @@ class ConvertFiles(BaseProcess):
                 new_track_year,
                 year_action
             )
+            if self.stager.break_link(file_to_copy):
+                self.logger.debug("Copied hard linked file before updating its tags")
             o = mutagen.File(file_to_copy, easy=True)
             # This could result in a loss of fidelity since this replaces a potential full date, e.g. 1999-01-01
             # with just a year value.
@@ -409,15 +1142,99 @@ class ApplyUpgrade(BaseProcess):
     reference with the new file, copied from the CopyFilesForUpgrade step.
     """
 
-    def __init__(self, data_file):
+    STAGE = "apply"
+
+    def __init__(self, data_file, batch_size: Optional[int] = None):
         super().__init__(data_file)
+        self.batch_size = batch_size
+        """Number of tracks to relocate with each AppleScript call. None relocates one at a time"""
+        self._positions: Optional[dict[str, int]] = None
+
+    def results(self, rows):
+        if not self.batch_size:
+            yield from super().results(rows)
+            return
+        while batch := list(islice(rows, self.batch_size)):
+            replayed = [self.replay(row) for row in batch]
+            to_process = [row for row, done in zip(batch, replayed) if done is None]
+            for row in to_process:
+                self.begin_row(row)
+            processed = iter(self.process_batch(to_process) if to_process else ())
+            for row, done in zip(batch, replayed):
+                if done is None:
+                    done = next(processed)
+                    self.complete_row(row, done)
+                yield done
+
+    def intent_for(self, csv_row) -> dict:
+        # Relocating a track again is harmless, so interrupted rows are simply processed again
+        return {"persistent_id": csv_row["persistent_id"], "new_file": csv_row["new_file"]}
+
+    @staticmethod
+    def remove_original(csv_row):
+        """Delete the file being replaced, unless it is the new file itself.
+
+        A track already points at its new file when the library was loaded again after an
+        earlier apply, which happens with a working database.
+        """
+        original = Path(csv_row["location"])
+        if original != Path(csv_row["new_file"]):
+            original.unlink(missing_ok=True)
+
+    def set_file_locations(self, locations):
+        """Relocate tracks by their position in the library, read once for every batch.
+
+        Tracks that moved since the positions were read, e.g. because tracks were removed in
+        Music meanwhile, are tried again with the positions read afresh.
+        """
+        if self._positions is None:
+            self._positions = tracks.file_track_positions()
+        outcomes = tracks.set_file_locations(locations, self._positions)
+        moved = [loc for loc in locations if outcomes[loc[0]] == apl.TRACK_MOVED_ERROR]
+        if moved:
+            self.logger.info("The library changed since it was read. Reading it again")
+            self._positions = tracks.file_track_positions()
+            outcomes.update(tracks.set_file_locations(moved, self._positions))
+        return outcomes
+
+    def process_batch(self, csv_rows):
+        """Relocate the tracks for several rows using a single AppleScript call."""
+        locations = []
+        for csv_row in csv_rows:
+            self.remove_original(csv_row)
+            new_file = apl.posix_path_to_hfs_path(csv_row["new_file"])
+            locations.append((csv_row["persistent_id"], new_file))
+
+        self.logger.info("Setting new file locations for %s tracks", len(locations))
+        try:
+            outcomes = self.set_file_locations(locations)
+        except subprocess.SubprocessError as e:
+            self.logger.exception("Could not update tracks")
+            outcomes = {persistent_id: str(e) for persistent_id, _ in locations}
+
+        results = []
+        for csv_row, (persistent_id, new_file) in zip(csv_rows, locations):
+            row_cpy = csv_row.copy()
+            outcome = outcomes[persistent_id]
+            row_cpy["success"] = outcome == "OK"
+            row_cpy["error"] = "" if row_cpy["success"] else outcome
+            if row_cpy["success"]:
+                row_cpy["new_file"] = new_file
+            else:
+                self.logger.error("Could not update track %s: %s", persistent_id, outcome)
+            results.append(row_cpy)
+        self.logger.info(
+            "Update complete. %s of %s tracks updated",
+            sum(row["success"] for row in results),
+            len(results),
+        )
+        return results
 
     def process_row(self, csv_row):
         row_cpy = csv_row.copy()
         persistent_id = csv_row["persistent_id"]
         new_file = apl.posix_path_to_hfs_path(csv_row["new_file"])
-        original_track_path = Path(csv_row["location"])
-        original_track_path.unlink(missing_ok=True)
+        self.remove_original(csv_row)
         try:
             self.logger.info("Setting new file location for track with persistent ID %s", persistent_id)
             # TODO - delete old file prior to calling applescript! Otherwise, Apple Music/iTunes will
@@ -0,0 +1,110 @@
+"""Ranks audio files by quality, whatever their format.
+
+Every file gets a single score from its probed details, so that any two files can be compared:
+
+* Lossless files score from 100 up. CD quality (16 bit, 44.1kHz) scores exactly 100, and each
+  doubling of the bits per second of a hi-res file adds 10, so 24 bit 96kHz scores about 117.
+  FLAC and ALAC of the same resolution score the same, since the audio is identical.
+* Lossy files score up to 95, from their bitrate. Codecs that do more with each bit, such as
+  AAC, have their bitrate scaled up first, so a 256kbps AAC file outscores a 256kbps MP3.
+* Files that cannot be identified score 0.
+"""
+import logging
+import math
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Optional
+
+import mutagen
+
+from .probes import AudioProbe, ProbeCache, probe_file
+
+LOG = logging.getLogger(__name__)
+
+LOSSLESS_CODECS = {"flac", "alac", "pcm", "wavpack", "ape"}
+"""Codecs that keep the audio exactly as it was"""
+
+CODEC_EFFICIENCY = {
+    "mp3": 1.0,
+    "mp4a.40.2": 1.3,
+    "mp4a.40.5": 1.6,
+    "mp4a.40.29": 1.8,
+    "vorbis": 1.2,
+    "opus": 1.5,
+}
+"""How much audio quality each codec gets from a bit, relative to MP3"""
+
+FORMAT_CODECS = {
+    "WAVE": "pcm",
+    "AIFF": "pcm",
+    "WavPack": "wavpack",
+    "MonkeysAudio": "ape",
+    "OggFLAC": "flac",
+    "OggVorbis": "vorbis",
+    "OggOpus": "opus",
+}
+"""The codec of the formats whose codec the probe does not report"""
+
+CD_BITS_PER_SECOND = 16 * 44100
+"""Resolution of CD audio, per channel, which lossless files are scored against"""
+
+LOSSLESS_BASE = 100.0
+"""Score of a CD quality lossless file"""
+
+LOSSY_CEILING = 95.0
+"""Highest score of a lossy file, however high its bitrate"""
+
+LOSSY_REFERENCE_KBPS = 320
+"""An MP3 at this bitrate scores 90"""
+
+
+@dataclass(frozen=True)
+class QualityScore:
+    path: str
+    score: float
+    codec: str
+    lossless: bool
+
+
+def codec_of(probe: AudioProbe) -> str:
+    codec = probe.codec or FORMAT_CODECS.get(probe.format, "")
+    # AAC files identified by their container alone are plain AAC-LC
+    return "mp4a.40.2" if codec == "mp4a" else codec
+
+
+def score_probe(probe: AudioProbe) -> QualityScore:
+    """Score the quality of a probed file"""
+    codec = codec_of(probe)
+    if codec in LOSSLESS_CODECS:
+        bits_per_second = (probe.bits_per_sample or 16) * (probe.sample_rate or 44100)
+        score = LOSSLESS_BASE + 10 * math.log2(bits_per_second / CD_BITS_PER_SECOND)
+        return QualityScore(probe.path, round(score, 3), codec, True)
+    if codec in CODEC_EFFICIENCY and probe.bitrate:
+        kbps = probe.bitrate / 1000 * CODEC_EFFICIENCY[codec]
+        score = min(kbps / LOSSY_REFERENCE_KBPS * 90, LOSSY_CEILING)
+        return QualityScore(probe.path, round(score, 3), codec, False)
+    return QualityScore(probe.path, 0.0, codec, False)
+
+
+def score_file(path: Path | str, cache: Optional[ProbeCache] = None) -> QualityScore:
+    probe = cache.get(path) if cache is not None else probe_file(path)
+    return score_probe(probe)
+
+
+def rank(paths: Iterable[Path | str], cache: Optional[ProbeCache] = None) -> list[QualityScore]:
+    """Score every file, best first. Files that cannot be read are left out.
+
+    Files with the same score keep their order, so the first one found wins a tie.
+    """
+    scores = []
+    for path in paths:
+        try:
+            scores.append(score_file(path, cache))
+        except (OSError, mutagen.MutagenError):
+            LOG.warning("Could not read %s to score it", path)
+    return sorted(scores, key=lambda ss: -ss.score)
+
+
+def is_better(new: QualityScore, old: QualityScore) -> bool:
+    """Whether replacing the old file with the new one would improve the quality"""
+    return new.score > old.score
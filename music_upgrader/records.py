@@ -0,0 +1,146 @@
+"""Compact records of the tracks read from the data files, shared by every stage.
+
+Each row of a data file used to be read into a dict, which every stage then copied to add its
+own columns. A `TrackRecord` keeps the library columns in slots instead, with only the columns
+added by the stages in a dict of their own. Values that repeat across many tracks, such as the
+artist and album, are interned, so all the records of an album share a single copy of each.
+
+Records behave like the dicts they replace: columns are read and set by name, and records can
+be copied, written with `csv.DictWriter` and turned back into dicts with `dict(record)`.
+"""
+import sys
+from collections.abc import Mapping, MutableMapping
+from datetime import datetime
+from typing import Iterator, Optional
+
+from dateutil.parser import ParserError, parse
+
+CSV_HEADER = (
+    "persistent_id",
+    "track_number",
+    "track_name",
+    "track_artist",
+    "album",
+    "album_artist",
+    "track_year",
+    "last_played",
+    "play_count",
+    "location",
+)
+"""Columns of the library data file, in order"""
+
+INTERNED_COLUMNS = frozenset(
+    ("track_number", "track_artist", "album", "album_artist", "track_year", "play_count")
+)
+"""Columns whose values are shared by many tracks"""
+
+PLAYED_DATE_FORMAT = "%A, %B %d, %Y at %I:%M:%S %p"
+"""How Music writes the played date of a track as text"""
+
+_SLOTTED = frozenset(CSV_HEADER)
+
+
+def intern_value(column: str, value):
+    if column in INTERNED_COLUMNS and type(value) is str:
+        return sys.intern(value)
+    return value
+
+
+def intern_values(values: tuple) -> tuple:
+    """Intern the values of a row of the library data file, given in the order of CSV_HEADER"""
+    interned = (intern_value(column, value) for column, value in zip(CSV_HEADER, values))
+    return (*interned, *values[len(CSV_HEADER):])
+
+
+def parse_played_date(value: str) -> Optional[datetime]:
+    """Parse a played date written by Music or by an earlier stage, or None if there is none.
+
+    The formats the data files hold are tried first, since the general purpose parser is about
+    ten times slower.
+    """
+    if not value or value == "missing value":
+        return None
+    for fast_parse in (datetime.fromisoformat, _strptime_played_date):
+        try:
+            return fast_parse(value)
+        except ValueError:
+            pass
+    try:
+        return parse(value)
+    except (ParserError, OverflowError):
+        return None
+
+
+def _strptime_played_date(value: str) -> datetime:
+    return datetime.strptime(value, PLAYED_DATE_FORMAT)
+
+
+class TrackRecord(MutableMapping):
+    """A row of a data file.
+
+    The library columns live in slots, and any other column in `extra`. A column that is
+    missing from the row is missing from the record too, just as it would be from a dict.
+    """
+
+    __slots__ = (*CSV_HEADER, "extra", "index")
+
+    def __init__(self, row: Optional[Mapping] = None, index: Optional[int] = None):
+        self.extra: Optional[dict] = None
+        """Columns that are not library columns, created when the first one is set"""
+        self.index = index
+        """Position of the row in its data file, if it was read from one"""
+        if row:
+            for column, value in row.items():
+                self[column] = value
+
+    def __getitem__(self, column):
+        if column in _SLOTTED:
+            try:
+                return getattr(self, column)
+            except AttributeError:
+                raise KeyError(column) from None
+        if self.extra is None:
+            raise KeyError(column)
+        return self.extra[column]
+
+    def __setitem__(self, column, value):
+        if column in _SLOTTED:
+            setattr(self, column, intern_value(column, value))
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[column] = value
+
+    def __delitem__(self, column):
+        if column in _SLOTTED:
+            try:
+                delattr(self, column)
+            except AttributeError:
+                raise KeyError(column) from None
+        elif self.extra is not None and column in self.extra:
+            del self.extra[column]
+        else:
+            raise KeyError(column)
+
+    def __iter__(self) -> Iterator[str]:
+        for column in CSV_HEADER:
+            if hasattr(self, column):
+                yield column
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"TrackRecord({dict(self)!r}, index={self.index!r})"
+
+    def copy(self) -> "TrackRecord":
+        """A copy whose columns can be changed without changing this record"""
+        clone = TrackRecord.__new__(TrackRecord)
+        for column in CSV_HEADER:
+            if hasattr(self, column):
+                setattr(clone, column, getattr(self, column))
+        clone.extra = dict(self.extra) if self.extra else None
+        clone.index = self.index
+        return clone
@@ -0,0 +1,261 @@
+"""Runs the external commands the stages depend on, `osascript` and `beet`, from one asyncio loop.
+
+Each kind of command is a backend, with its own limit on how many of its processes run at once,
+a timeout for each call, and how many times a call that failed for a passing reason is tried
+again. The loop runs in a background thread, so the worker threads of a stage call
+`CommandRunner.run` as they would `subprocess.run`, while `run_all` starts many commands from a
+single thread.
+
+A call that takes longer than its timeout has its process killed and raises
+`subprocess.TimeoutExpired`. Within `cancel_on_interrupt`, Ctrl-C kills every running process,
+and calls raise `CommandCancelled` instead of the stage waiting on a hung Music.app.
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import logging
+import os
+import re
+import signal
+import subprocess
+import threading
+from dataclasses import dataclass, replace
+from typing import Callable, Iterable, Optional
+
+LOG = logging.getLogger(__name__)
+
+TRANSIENT_APPLESCRIPT_ERRORS = re.compile(r"\((-600|-609|-1712)\)")
+"""Music.app not running, the connection to it lost, and an Apple event timing out"""
+
+
+class CommandCancelled(Exception):
+    """The command was cancelled, e.g. with Ctrl-C, before it finished"""
+
+
+def is_transient_applescript_error(resp: subprocess.CompletedProcess) -> bool:
+    """Whether `osascript` failed in a way that is worth another try"""
+    stderr = resp.stderr.decode("utf-8", "replace")
+    return resp.returncode != 0 and bool(TRANSIENT_APPLESCRIPT_ERRORS.search(stderr))
+
+
+def _never(resp: subprocess.CompletedProcess) -> bool:
+    return False
+
+
+@dataclass(frozen=True)
+class Backend:
+    concurrency: int
+    """The most processes of the backend running at once"""
+    timeout: Optional[float] = None
+    """Seconds a call may take before its process is killed. None waits for as long as it takes"""
+    retries: int = 0
+    """How many more times a call that failed for a transient reason is tried"""
+    backoff: float = 0.5
+    """Seconds before the first retry, doubling for each retry after it"""
+    is_transient: Callable[[subprocess.CompletedProcess], bool] = _never
+
+
+BACKENDS = {
+    "osascript": Backend(
+        concurrency=8, timeout=300, retries=2, is_transient=is_transient_applescript_error
+    ),
+    "beet": Backend(concurrency=os.cpu_count() or 4),
+}
+"""Default settings of each backend. Loading a large library can take minutes in Music.app"""
+
+
+class CommandRunner:
+    """Runs commands on an event loop in a background thread. Safe to share between threads."""
+
+    def __init__(self, backends: Optional[dict[str, Backend]] = None):
+        self.backends = dict(BACKENDS if backends is None else backends)
+        self.cancelled = False
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="command-runner", daemon=True
+        )
+        self._thread.start()
+
+    def configure(self, backend: str, **changes):
+        """Change the settings of a backend, e.g. its timeout, for the calls made from now on"""
+        self.backends[backend] = replace(self.backends[backend], **changes)
+        self._loop.call_soon_threadsafe(self._semaphores.pop, backend, None)
+
+    def _semaphore(self, backend: str) -> asyncio.Semaphore:
+        # Only used from the loop, so it needs no lock
+        if backend not in self._semaphores:
+            self._semaphores[backend] = asyncio.Semaphore(self.backends[backend].concurrency)
+        return self._semaphores[backend]
+
+    async def run_async(
+        self,
+        backend: str,
+        argv: list[str],
+        timeout: Optional[float] = None,
+        input: Optional[bytes] = None,
+    ) -> subprocess.CompletedProcess:
+        """Run a command once one of the backend's slots is free, retrying transient failures.
+
+        Args:
+            backend: The name of the backend whose limits apply
+            argv: The command and its arguments
+            timeout: Seconds the command may take, each time it is tried. Defaults to the
+                timeout of the backend
+            input: Written to the command's stdin
+
+        Returns:
+            The finished process, with its stdout and stderr as bytes
+        """
+        config = self.backends[backend]
+        timeout = config.timeout if timeout is None else timeout
+        attempt = 0
+        while True:
+            async with self._semaphore(backend):
+                resp = await self._execute(argv, timeout, input)
+            if attempt >= config.retries or not config.is_transient(resp):
+                return resp
+            delay = config.backoff * 2**attempt
+            attempt += 1
+            LOG.warning(
+                "%s failed, trying again in %.1fs: %s",
+                backend,
+                delay,
+                resp.stderr.decode("utf-8", "replace").strip(),
+            )
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    async def _execute(argv, timeout, input) -> subprocess.CompletedProcess:
+        proc = await asyncio.create_subprocess_exec(
+            *argv,
+            stdin=subprocess.DEVNULL if input is None else subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(input), timeout)
+        except asyncio.TimeoutError:
+            await _kill(proc)
+            raise subprocess.TimeoutExpired(argv, timeout) from None
+        except asyncio.CancelledError:
+            await _kill(proc)
+            raise
+        return subprocess.CompletedProcess(argv, proc.returncode, stdout, stderr)
+
+    async def _tracked(self, coro):
+        """Await a coroutine, keeping its task where `cancel_all` can find it"""
+        if self.cancelled:
+            coro.close()
+            raise asyncio.CancelledError
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            return await coro
+        finally:
+            self._tasks.discard(task)
+
+    def _wait(self, coro):
+        if self.cancelled:
+            coro.close()
+            raise CommandCancelled("Commands were cancelled")
+        future = asyncio.run_coroutine_threadsafe(self._tracked(coro), self._loop)
+        try:
+            return future.result()
+        except concurrent.futures.CancelledError:
+            raise CommandCancelled("Command was cancelled before it finished") from None
+        except KeyboardInterrupt:
+            future.cancel()
+            raise
+
+    def run(
+        self,
+        backend: str,
+        argv: list[str],
+        timeout: Optional[float] = None,
+        input: Optional[bytes] = None,
+    ) -> subprocess.CompletedProcess:
+        """Run a command and wait for it to finish. See `run_async`"""
+        return self._wait(self.run_async(backend, argv, timeout, input))
+
+    def run_all(
+        self, backend: str, argvs: Iterable[list[str]], timeout: Optional[float] = None
+    ) -> list[subprocess.CompletedProcess]:
+        """Run several commands, as many at once as the backend allows, in the order given"""
+
+        async def _gather():
+            return await asyncio.gather(*(self.run_async(backend, aa, timeout) for aa in argvs))
+
+        return self._wait(_gather())
+
+    def cancel_all(self):
+        """Kill every running command. Calls fail with `CommandCancelled` until `reset`"""
+        self.cancelled = True
+
+        def _cancel():
+            for task in list(self._tasks):
+                task.cancel()
+
+        self._loop.call_soon_threadsafe(_cancel)
+
+    def reset(self):
+        self.cancelled = False
+
+    def close(self):
+        self.cancel_all()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+async def _kill(proc: asyncio.subprocess.Process):
+    if proc.returncode is None:
+        with contextlib.suppress(ProcessLookupError):
+            proc.kill()
+        await proc.wait()
+
+
+_runner: Optional[CommandRunner] = None
+_runner_lock = threading.Lock()
+
+
+def get_runner() -> CommandRunner:
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = CommandRunner()
+        return _runner
+
+
+def set_runner(runner: Optional[CommandRunner]):
+    """Replace the runner used by the services. None goes back to the default"""
+    global _runner
+    with _runner_lock:
+        if _runner is not None:
+            _runner.close()
+        _runner = runner
+
+
+@contextlib.contextmanager
+def cancel_on_interrupt():
+    """Kill the running commands as soon as Ctrl-C is pressed, then raise KeyboardInterrupt.
+
+    Signal handlers can only be installed from the main thread, elsewhere this does nothing.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def _interrupted(signum, frame):
+        if _runner is not None:
+            _runner.cancel_all()
+        signal.default_int_handler(signum, frame)
+
+    previous = signal.signal(signal.SIGINT, _interrupted)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGINT, previous)
+        if _runner is not None:
+            _runner.reset()
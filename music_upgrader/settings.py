@@ -1,12 +1,17 @@
 import configparser
+import functools
 import json
 import logging.config
 import os
 from collections import defaultdict
 from pathlib import Path
 
-import yaml
-
+SNAPSHOT_LOCATION = (
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    / "music_upgrader"
+    / "settings.json"
+)
+"""Copy of the loaded library settings, used until one of the files they came from changes"""
 
 config = configparser.ConfigParser(delimiters=["="])
 
@@ -17,7 +22,7 @@ _conf_paths = map(lambda x: Path(x) / "config.ini", [
     Path(os.environ.get("MUSIC_UPGRADER_CONF", __file__)),  # Need a good default. Can't leave None or there'll be an error
 ])
 
-config.read(_conf_paths)
+_read_paths = config.read(_conf_paths)
 
 try:
     logging.config.dictConfig(json.loads(Path(config["DEFAULT"]["logging_config_loc"]).read_text()))
@@ -31,18 +36,76 @@ LOG = logging.getLogger(__name__)
 EXPECTED_KEYS = ["path", "directory", "path_formats"]
 
 
+def library_names() -> list[str]:
+    """The names of the configured libraries, without loading their settings"""
+    return [ll for ll in config.get("library", "names", fallback="").split(",") if ll]
+
+
+def _source_stamps(paths) -> dict[str, int]:
+    stamps = {}
+    for path in paths:
+        try:
+            stamps[str(path)] = Path(path).stat().st_mtime_ns
+        except OSError:
+            stamps[str(path)] = None
+    return stamps
+
+
+def _read_snapshot() -> tuple[dict, dict] | None:
+    try:
+        snapshot = json.loads(SNAPSHOT_LOCATION.read_text())
+    except (OSError, ValueError):
+        return None
+    sources = snapshot.get("sources", {})
+    if sources != _source_stamps(sources) or not set(map(str, _read_paths)) <= set(sources):
+        return None
+    if list(snapshot["dbs"]) != library_names():
+        return None
+    dbs = {
+        name: {**options, "path_formats": tuple(map(tuple, options["path_formats"]))}
+        for name, options in snapshot["dbs"].items()
+    }
+    return dbs, defaultdict(dict, snapshot["cmds"])
+
+
+def _write_snapshot(dbs, cmds, sources):
+    try:
+        SNAPSHOT_LOCATION.parent.mkdir(parents=True, exist_ok=True)
+        SNAPSHOT_LOCATION.write_text(
+            json.dumps({"sources": _source_stamps(sources), "dbs": dbs, "cmds": cmds})
+        )
+    except OSError:
+        LOG.debug("Could not write the settings snapshot to %s", SNAPSHOT_LOCATION)
+
+
+@functools.cache
 def load():
+    """Load the settings of every library, once per process.
+
+    The settings come from a snapshot when none of the files they were read from has changed
+    since it was written, which saves parsing the beets configuration of every library.
+    """
+    if loaded := _read_snapshot():
+        LOG.debug("Loaded %s databases from %s", len(loaded[0]), SNAPSHOT_LOCATION)
+        return loaded
+    dbs, cmds, sources = _load()
+    _write_snapshot(dbs, cmds, [*_read_paths, *sources])
+    return dbs, cmds
+
+
+def _load():
+    import yaml
+
+    sources = []
     dbs = {}
     cmds = defaultdict(dict)
-    avail = config.get("library", "names", fallback="").split(",")
-    for ll in avail:
-        if not ll:
-            continue
+    for ll in library_names():
         LOG.debug("Loading %s", ll)
         config_items = config[f"library.{ll}"]
         LOG.debug("Path: %s", config_items["path"])
         tmp = dict(config_items)
         if "config_file" in config_items:
+            sources.append(config_items["config_file"])
             with Path(config_items["config_file"]).open() as f:
                 yaml_config = yaml.safe_load(f)
             tmp["path_formats"] = tuple(yaml_config["paths"].items())
@@ -57,7 +120,7 @@ def load():
                 dbs[ll][k] = tmp[k]
 
     LOG.info("Loaded %s databases: %s", len(dbs.keys()), dbs.keys())
-    return dbs, cmds
+    return dbs, cmds, sources
 
 
 if __name__ == "__main__":
@@ -0,0 +1,179 @@
+"""Copies and moves audio files without reading them into Python.
+
+Copies are made with a reflink where the filesystem supports it (Btrfs, XFS), otherwise with
+``copy_file_range``, falling back to `shutil.copyfile`, which uses ``sendfile`` on Linux and
+``fcopyfile`` on macOS. Each copy is written to a temporary file next to the destination and
+only renamed into place once complete, so an interrupted copy never leaves a partial file.
+
+Moves are renames. When the source and destination are on different filesystems, the file is
+copied and the source removed afterwards.
+"""
+import errno
+import logging
+import os
+import shutil
+import sys
+import threading
+from pathlib import Path
+from typing import Optional
+
+from .metrics import timed
+
+LOG = logging.getLogger(__name__)
+
+FICLONE = 0x40049409
+"""Linux ioctl that makes the destination share the source's blocks"""
+
+DEFAULT_IO_BUDGET = 1 << 30
+"""Default number of bytes that may be in the middle of being copied at once"""
+
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY}
+"""Errors raised by the kernel-side primitives when they cannot be used for a pair of files"""
+
+
+class IOBudget:
+    """Limits the number of bytes being copied at once, across threads.
+
+    A file larger than the whole budget is still copied, once nothing else is in flight.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_IO_BUDGET):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.in_flight == 0 or self.in_flight + size <= self.max_bytes
+            )
+            self.in_flight += size
+
+    def release(self, size):
+        with self._condition:
+            self.in_flight -= size
+            self._condition.notify_all()
+
+
+def _reflink(src_fd, dst_fd) -> bool:
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError as e:
+        if e.errno in UNSUPPORTED_ERRNOS:
+            return False
+        raise
+    return True
+
+
+def _copy_file_range(src_fd, dst_fd, size) -> bool:
+    if not hasattr(os, "copy_file_range"):
+        return False
+    copied = 0
+    try:
+        while copied < size:
+            sent = os.copy_file_range(src_fd, dst_fd, size - copied)
+            if sent == 0:
+                break
+            copied += sent
+    except OSError as e:
+        if copied == 0 and e.errno in UNSUPPORTED_ERRNOS:
+            return False
+        raise
+    return True
+
+
+class FileStager:
+    """Stages files using kernel-side copies, with an optional hard link mode.
+
+    Safe to share between threads. The total size of the copies in progress is limited by
+    `budget`.
+    """
+
+    def __init__(self, link=False, budget: Optional[IOBudget] = None):
+        self.link = link
+        """Hard link files instead of copying them, when on the same filesystem"""
+        self.budget = budget or IOBudget()
+
+    @timed("stage_copy")
+    def copy(self, src: Path, dst: Path) -> str:
+        """Copy a file, replacing the destination if it exists.
+
+        Returns:
+            str: How the file was staged: 'link', 'reflink', 'copy_file_range' or 'copyfile'.
+        """
+        src, dst = Path(src), Path(dst)
+        if self.link and self._hard_link(src, dst):
+            return "link"
+        size = src.stat().st_size
+        partial = dst.with_name(f".{dst.name}.partial")
+        self.budget.acquire(size)
+        try:
+            method = self._copy_contents(src, partial, size)
+            shutil.copystat(src, partial)
+            os.replace(partial, dst)
+        except BaseException:
+            partial.unlink(missing_ok=True)
+            raise
+        finally:
+            self.budget.release(size)
+        LOG.debug("Staged %s to %s using %s", src, dst, method)
+        return method
+
+    @staticmethod
+    def _hard_link(src: Path, dst: Path) -> bool:
+        if src.stat().st_dev != dst.parent.stat().st_dev:
+            return False
+        partial = dst.with_name(f".{dst.name}.partial")
+        partial.unlink(missing_ok=True)
+        try:
+            os.link(src, partial)
+        except OSError as e:
+            if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                return False
+            raise
+        os.replace(partial, dst)
+        return True
+
+    @staticmethod
+    def _copy_contents(src: Path, dst: Path, size) -> str:
+        with src.open("rb") as src_file, dst.open("wb") as dst_file:
+            if _reflink(src_file.fileno(), dst_file.fileno()):
+                return "reflink"
+            if _copy_file_range(src_file.fileno(), dst_file.fileno(), size):
+                return "copy_file_range"
+        shutil.copyfile(src, dst)
+        return "copyfile"
+
+    @timed("stage_move")
+    def move(self, src: Path, dst: Path) -> str:
+        """Move a file, copying it when the destination is on another filesystem.
+
+        Returns:
+            str: 'rename', or how the file was copied.
+        """
+        src, dst = Path(src), Path(dst)
+        try:
+            os.rename(src, dst)
+            return "rename"
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        method = FileStager(budget=self.budget).copy(src, dst)
+        src.unlink()
+        return method
+
+    def break_link(self, path: Path) -> bool:
+        """Give a hard linked file its own copy, so that editing it leaves other links alone.
+
+        Returns:
+            bool: Whether the file had to be copied.
+        """
+        path = Path(path)
+        if path.stat().st_nlink < 2:
+            return False
+        FileStager(budget=self.budget).copy(path, path)
+        return True
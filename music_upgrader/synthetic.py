@@ -0,0 +1,349 @@
+"""Builds synthetic libraries for testing and benchmarking the upgrade stages without Music.
+
+A synthetic library is made up of:
+
+* an iTunes library CSV, in the same format `LoadLatestLibrary` writes, along with the JSON
+  library used by `fake_music`
+* a beets SQLite library, whose items are placed according to the path formats found in
+  ``config.ini.example``
+* tiny, but valid, MP3, FLAC and M4A files for both sides
+
+Every track is an MP3 in iTunes. Depending on its position, the beets library has a FLAC copy,
+a higher bitrate MP3, an MP3 of the same quality or no copy of the track at all.
+
+This module doubles as a stand-in for ``beet convert`` so that `ConvertFiles` can run against a
+synthetic library. Conversions write an ALAC file to the configured ``convert.dest``::
+
+    python -m music_upgrader.synthetic -c config.yaml convert -y path:/a.flac , path:/b.flac
+"""
+import configparser
+import csv
+import json
+import logging
+import struct
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+
+import mutagen
+import yaml
+
+LOG = logging.getLogger(__name__)
+
+CONFIG_EXAMPLE = Path(__file__).parent.parent / "config.ini.example"
+"""The example configuration holding the path formats used by synthetic beets libraries"""
+
+DEFAULT_PATH_FORMATS = (
+    ("default", "$format/$albumartist/$album%aunique{}/$track - $title"),
+    ("singleton", "$format/Non-Album/$artist/$title"),
+    ("comp", "$format/Compilations/$album%aunique{}/$track - $title"),
+)
+"""Used when the example configuration is not available, e.g. when installed as a package"""
+
+KINDS = ("FLAC", "MP3_320", "MP3_128", "MISSING")
+"""What the beets library holds for each track, cycling through the tracks in order"""
+
+MP3_FRAME_HEADERS = {128: b"\xff\xfb\x90\x00", 320: b"\xff\xfb\xe0\x00"}
+
+
+def _atom(name: bytes, *payload: bytes) -> bytes:
+    data = b"".join(payload)
+    return struct.pack(">I", len(data) + 8) + name + data
+
+
+def write_mp3(path: Path, bitrate=128, frames=20, **tags) -> Path:
+    """Write a few silent MPEG-1 Layer III frames at 44.1kHz"""
+    frame_length = 144 * bitrate * 1000 // 44100
+    path.write_bytes((MP3_FRAME_HEADERS[bitrate] + bytes(frame_length - 4)) * frames)
+    _tag(path, tags)
+    return path
+
+
+def write_flac(path: Path, sample_rate=44100, bits_per_sample=16, **tags) -> Path:
+    """Write a FLAC file that only has a STREAMINFO block"""
+    total_samples = sample_rate * 2
+    info = struct.pack(">HH", 4096, 4096) + bytes(6)
+    packed = (sample_rate << 44) | (1 << 41) | ((bits_per_sample - 1) << 36) | total_samples
+    info += packed.to_bytes(8, "big") + bytes(16)
+    path.write_bytes(b"fLaC" + b"\x80" + len(info).to_bytes(3, "big") + info)
+    _tag(path, tags)
+    return path
+
+
+def write_m4a(path: Path, sample_rate=44100, bits_per_sample=16, **tags) -> Path:
+    """Write an MP4 file describing a two second ALAC track, without any audio data"""
+    duration = sample_rate * 2
+    bitrate = sample_rate * bits_per_sample * 2
+    mvhd = struct.pack(">4xIIIIIH10x36x24xI", 0, 0, sample_rate, duration, 0x10000, 0x100, 2)
+    mdhd = struct.pack(">4xIIIIHH", 0, 0, sample_rate, duration, 0x55C4, 0)
+    hdlr = struct.pack(">4x4x4s12x", b"soun") + b"\x00"
+    cookie = struct.pack(
+        ">4xIBBBBBBHIII", 4096, 0, bits_per_sample, 40, 10, 14, 2, 255, 0, bitrate, sample_rate
+    )
+    # The sample entry only has 16 bits for the rate, the ALAC cookie holds the real value
+    entry = struct.pack(">6xH8xHH4xI", 1, 2, bits_per_sample, (sample_rate & 0xFFFF) << 16)
+    stsd = _atom(b"stsd", struct.pack(">4xI", 1), _atom(b"alac", entry, _atom(b"alac", cookie)))
+    stbl = _atom(b"stbl", stsd)
+    mdia = _atom(b"mdia", _atom(b"mdhd", mdhd), _atom(b"hdlr", hdlr), _atom(b"minf", stbl))
+    moov = _atom(b"moov", _atom(b"mvhd", mvhd), _atom(b"trak", mdia))
+    ftyp = _atom(b"ftyp", b"M4A ", struct.pack(">I", 0), b"M4A mp42isom")
+    path.write_bytes(ftyp + moov)
+    _tag(path, tags)
+    return path
+
+
+def _tag(path, tags):
+    if not tags:
+        return
+    audio = mutagen.File(path, easy=True)
+    if audio.tags is None:
+        audio.add_tags()
+    for key, value in tags.items():
+        audio[key] = value
+    audio.save()
+
+
+def load_path_formats(config_path: Path = CONFIG_EXAMPLE) -> tuple[tuple[str, str], ...]:
+    """Read the path formats of the first library in a music-upgrader configuration"""
+    if not config_path.exists():
+        return DEFAULT_PATH_FORMATS
+    config = configparser.ConfigParser(delimiters=["="])
+    config.read(config_path)
+    name = config.get("library", "names").split(",")[0]
+    return tuple(
+        (key, value)
+        for key, value in config.items(f"library.{name}.formats")
+        if key not in config.defaults()
+    )
+
+
+@dataclass
+class SyntheticLibrary:
+    root: Path
+    track_count: int
+    name: str = "synthetic"
+    """The name the beets library is registered under"""
+
+    @property
+    def library_csv(self) -> Path:
+        return self.root / "libraryFiles.csv"
+
+    @property
+    def music_library(self) -> Path:
+        """The JSON library used by `fake_music`"""
+        return self.root / "music.json"
+
+    @property
+    def itunes_directory(self) -> Path:
+        return self.root / "itunes"
+
+    @property
+    def beets_directory(self) -> Path:
+        return self.root / "beets"
+
+    @property
+    def beets_db(self) -> Path:
+        return self.beets_directory / "musiclibrary.db"
+
+    @property
+    def beets_config(self) -> Path:
+        return self.beets_directory / "config.yaml"
+
+    @property
+    def staging_directory(self) -> Path:
+        return self.root / "staging"
+
+    @property
+    def config_file(self) -> Path:
+        """A music-upgrader config.ini, for running ``mup`` with MUSIC_UPGRADER_CONF"""
+        return self.root / "config.ini"
+
+    @property
+    def exec(self) -> list[str]:
+        """The command used in place of ``beet``"""
+        return [sys.executable, "-m", __name__, "-c", str(self.beets_config)]
+
+    def register(self):
+        """Make the beets library available to `ApiDataService` and `CliDataService`"""
+        from .db import CMDS, DBS
+
+        DBS[self.name] = {
+            "path": str(self.beets_db),
+            "directory": str(self.beets_directory),
+            "path_formats": load_path_formats(),
+        }
+        CMDS[self.name]["exec"] = self.exec
+
+
+def _track_names(index: int, tracks_per_album: int, albums_per_artist: int) -> dict:
+    album_index = index // tracks_per_album
+    artist = f"Artist {album_index // albums_per_artist:05d}"
+    title = f"Song {index:06d}"
+    if index % 5 == 0:
+        # beets prefers typographic apostrophes, iTunes mostly has plain ones
+        title = f"Don't Stop {index:06d}"
+    return {
+        "track_number": index % tracks_per_album + 1,
+        "track_name": title,
+        "track_artist": artist,
+        "album": f"Album {album_index:05d}",
+        "album_artist": artist,
+        "track_year": 1970 + album_index % 50,
+    }
+
+
+def generate(
+    root: Path | str,
+    track_count: int,
+    tracks_per_album=10,
+    albums_per_artist=4,
+    name="synthetic",
+) -> SyntheticLibrary:
+    """Build a synthetic library of `track_count` tracks under `root`.
+
+    Rows are written as they are generated, so large libraries do not need to fit in memory.
+    """
+    library = SyntheticLibrary(Path(root), track_count, name)
+    for directory in (
+        library.itunes_directory,
+        library.beets_directory,
+        library.staging_directory,
+    ):
+        directory.mkdir(parents=True, exist_ok=True)
+
+    path_formats = load_path_formats()
+    library.beets_config.write_text(
+        yaml.safe_dump(
+            {
+                "directory": str(library.beets_directory),
+                "library": str(library.beets_db),
+                "paths": dict(path_formats),
+                "convert": {"dest": str(library.staging_directory), "format": "alac"},
+            }
+        )
+    )
+    _write_config_file(library)
+
+    # Imported here so that the ``beet convert`` stand-in starts without loading beets
+    from beets.library import Library
+
+    from .records import CSV_HEADER
+
+    beets = Library(str(library.beets_db), str(library.beets_directory))
+    beets.path_formats = path_formats
+    with (
+        library.library_csv.open("w") as csv_file,
+        library.music_library.open("w") as json_file,
+        beets.transaction(),
+    ):
+        writer = csv.DictWriter(csv_file, fieldnames=CSV_HEADER)
+        writer.writeheader()
+        json_file.write("[\n")
+        for index in range(track_count):
+            names = _track_names(index, tracks_per_album, albums_per_artist)
+            location = (
+                library.itunes_directory
+                / names["track_artist"]
+                / names["album"]
+                / f"{names['track_number']:02d} {names['track_name']}.mp3"
+            )
+            location.parent.mkdir(parents=True, exist_ok=True)
+            tags = {
+                "title": names["track_name"],
+                "artist": names["track_artist"],
+                "album": names["album"],
+            }
+            write_mp3(location, 128, frames=2, **tags)
+            row = {
+                "persistent_id": f"{index:016X}",
+                **names,
+                "last_played": "",
+                "play_count": index % 7,
+                "location": str(location),
+            }
+            writer.writerow(row)
+            json_file.write(("," if index else "") + json.dumps(row) + "\n")
+            _add_beets_item(beets, KINDS[index % len(KINDS)], names)
+        json_file.write("]\n")
+    LOG.info("Generated a synthetic library of %s tracks in %s", track_count, library.root)
+    return library
+
+
+def _add_beets_item(beets, kind: str, names: dict):
+    from beets.library import Item
+
+    if kind == "MISSING":
+        return
+    title = names["track_name"].replace("'", "’")
+    item = Item(
+        title=title,
+        artist=names["track_artist"],
+        album=names["album"],
+        albumartist=names["album_artist"],
+        track=names["track_number"],
+        year=names["track_year"],
+        original_year=names["track_year"],
+        format="FLAC" if kind == "FLAC" else "MP3",
+        bitrate=1411200 if kind == "FLAC" else int(kind[-3:]) * 1000,
+        samplerate=44100,
+        length=2.0,
+    )
+    item.path = b"placeholder.flac" if kind == "FLAC" else b"placeholder.mp3"
+    beets.add(item)
+    item.path = item.destination()
+    path = Path(item.path.decode("utf-8"))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tags = {"title": title, "artist": item.artist, "album": item.album}
+    if kind == "FLAC":
+        write_flac(path, **tags)
+    else:
+        write_mp3(path, item.bitrate // 1000, frames=2, **tags)
+    item.store()
+
+
+def _write_config_file(library: SyntheticLibrary):
+    config = configparser.ConfigParser(delimiters=["="], interpolation=None)
+    config["library"] = {"names": library.name}
+    config[f"library.{library.name}"] = {
+        "path": str(library.beets_db),
+        "directory": str(library.beets_directory),
+        "config_file": str(library.beets_config),
+        "exec": " ".join(library.exec),
+    }
+    with library.config_file.open("w") as config_file:
+        config.write(config_file)
+
+
+def convert(config_path: Path, queries: list[str]) -> list[Path]:
+    """Write an ALAC copy of each FLAC file matched by a ``path:`` query, as beets would"""
+    config = yaml.safe_load(config_path.read_text())
+    directory = Path(config["directory"])
+    dest = Path(config["convert"]["dest"])
+    converted = []
+    for query in queries:
+        if not query.startswith("path:"):
+            continue
+        source = Path(query.removeprefix("path:"))
+        target = dest.joinpath(source.relative_to(directory)).with_suffix(".m4a")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tags = {}
+        audio = mutagen.File(source, easy=True)
+        for tag in ("title", "artist", "album"):
+            if audio and tag in audio:
+                tags[tag] = audio[tag][0]
+        converted.append(write_m4a(target, **tags))
+    return converted
+
+
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else argv
+    if len(args) < 3 or args[0] != "-c" or args[2] != "convert":
+        print("Only '-c CONFIG convert' is supported by the synthetic beets", file=sys.stderr)
+        return 1
+    for converted in convert(Path(args[1]), args[3:]):
+        print(f"convert: {converted}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,28 +1,39 @@
 import ast
-import subprocess
+import functools
 from pathlib import Path
+from typing import Optional
 
 import mutagen
 from inflection import transliterate
-from mutagen.flac import FLAC
-from mutagen.mp3 import MP3
-from mutagen.mp4 import MP4
 
-from music_upgrader import applescript
+from music_upgrader import applescript, quality
 from music_upgrader.applescript import (
+    FIELD_SEPARATOR,
+    FILE_TRACK_PROPERTIES,
     GET_TRACK_FIELD,
     GET_TRACK_INFO,
     LOAD_ALL_FILE_IDS,
+    LOAD_ALL_FILE_TRACK_PROPERTIES,
+    RECORD_SEPARATOR,
     SELECT_TRACK_BY_ARTIST_TRACK_NAME_ALBUM,
     SELECT_TRACK_BY_ID,
     SET_TRACK_FILE_LOCATION,
+    SET_TRACK_FILE_LOCATIONS,
 )
+from music_upgrader.db import normalize
+from music_upgrader.probes import TAG_FIELDS, AudioProbe, ProbeCache, probe_file
+from music_upgrader.runner import get_runner
+
+BULK_LOAD_TIMEOUT = 1800.0
+"""Seconds the bulk property load may take. Music reads every track of the library for it"""
+
+FOLDED_TAG_CACHE_SIZE = 65536
+"""Tag values whose folded form is kept. Artists and albums are shared by many tracks"""
 
 
 def _run(command: str) -> str:
-    resp = subprocess.run(
-        ["beet", command],  # TODO - call specific alias, e.g. pbeet, dbeet
-        capture_output=True,
+    resp = get_runner().run(
+        "beet", ["beet", command]  # TODO - call specific alias, e.g. pbeet, dbeet
     )
 
     return resp.stdout.decode()
@@ -55,6 +66,37 @@ def load_all():
     return items
 
 
+def load_all_bulk(properties=FILE_TRACK_PROPERTIES, timeout=BULK_LOAD_TIMEOUT) -> list[tuple]:
+    """Load the given properties for every file track using a single AppleScript call.
+
+    Rather than selecting each track by its persistent ID, every property is fetched as a list
+    and the lists are zipped back together here.
+
+    Args:
+        properties: The AppleScript property names to load. Defaults to the properties that make
+            up the library CSV file.
+        timeout: Seconds the load may take. Far longer than other commands need, since Music
+            reads every track.
+
+    Returns:
+        list[tuple]: One tuple of text values per track, in the same order as ``properties``.
+    """
+    # Locations come back as POSIX paths, so files on other volumes keep their /Volumes prefix
+    location_column = properties.index("location") + 1 if "location" in properties else 0
+    resp = applescript.run(
+        LOAD_ALL_FILE_TRACK_PROPERTIES.format(
+            properties=", ".join(properties), location_column=location_column
+        ),
+        timeout,
+    )
+    columns = resp.rstrip("\n").split(RECORD_SEPARATOR)
+    if len(columns) != len(properties):
+        raise ValueError(f"Expected {len(properties)} property lists, received {len(columns)}")
+
+    values = [col.split(FIELD_SEPARATOR) if col else [] for col in columns]
+    return list(zip(*values))
+
+
 def get_year(track_id: str):
     return int(_get_data_by_id(track_id, GET_TRACK_FIELD.format("year")))
 
@@ -71,7 +113,82 @@ def set_file_location(track_id: str, hfs_file_path: str):
     return _get_data_by_id(track_id, SET_TRACK_FILE_LOCATION.format(hfs_file_path))
 
 
-def is_same_track(old_file: Path | str, new_file: Path | str) -> bool:
+def file_track_positions() -> dict[str, int]:
+    """The position of every file track in the library, from 1, by persistent ID"""
+    return {track_id: position for position, track_id in enumerate(load_all_ids(), start=1)}
+
+
+def set_file_locations(
+    locations: list[tuple[str, str]], positions: Optional[dict[str, int]] = None
+) -> dict[str, str]:
+    """Set the file location of several tracks with a single AppleScript call.
+
+    Args:
+        locations: Pairs of persistent ID and the HFS path of the track's new file.
+        positions: The `file_track_positions` of the library, fetched once and reused for every
+            batch. Only valid while the library does not change. Fetched when not given.
+
+    Returns:
+        dict[str, str]: The outcome for each persistent ID, either "OK" or the error message.
+            Tracks that could not be found are reported as such.
+    """
+    if positions is None:
+        positions = file_track_positions()
+    outcomes = {track_id: "Track not found" for track_id, _ in locations}
+    updates = ", ".join(
+        f"{{{positions[track_id]}, {applescript.quote(track_id)}, "
+        f"{applescript.quote(hfs_file_path)}}}"
+        for track_id, hfs_file_path in locations
+        if track_id in positions
+    )
+    if not updates:
+        return outcomes
+    resp = applescript.run(
+        SET_TRACK_FILE_LOCATIONS.format(
+            updates=f"{{{updates}}}", moved=applescript.TRACK_MOVED_ERROR
+        )
+    )
+    for line in filter(None, resp.splitlines()):
+        track_id, status, *message = line.split("\t", 2)
+        if track_id in outcomes:
+            outcomes[track_id] = "OK" if status == "OK" else "".join(message) or status
+    return outcomes
+
+
+def _probe(music_track: Path | str, cache: ProbeCache | None) -> AudioProbe:
+    if cache is None:
+        return probe_file(music_track)
+    return cache.get(music_track)
+
+
+@functools.lru_cache(maxsize=FOLDED_TAG_CACHE_SIZE)
+def fold_tag(value: str) -> str:
+    """Fold a tag value for comparison, transliterating accents and ignoring case.
+
+    Punctuation is dropped the way the matcher drops it, so the apostrophes and dashes beets
+    likes to use do not stop a track found by the matcher from being the same track.
+    """
+    return normalize(transliterate(value))
+
+
+def tags_match(old: AudioProbe, new: AudioProbe) -> bool:
+    """Whether two probed files have the same title, album and artist.
+
+    Tags that are exactly the same are not folded, and the comparison stops at the first tag
+    that differs. Files missing any of the tags cannot be compared, so they do not match.
+    """
+    for tag in TAG_FIELDS:
+        old_value, new_value = getattr(old, tag), getattr(new, tag)
+        if old_value is None or new_value is None:
+            return False
+        if old_value != new_value and fold_tag(old_value) != fold_tag(new_value):
+            return False
+    return True
+
+
+def is_same_track(
+    old_file: Path | str, new_file: Path | str, cache: ProbeCache | None = None
+) -> bool:
     """Verify whether two files represent the same track for a given artist's album.
 
     Given how this is expected to execute, this could be overkill, but is still an important
@@ -87,23 +204,12 @@ def is_same_track(old_file: Path | str, new_file: Path | str) -> bool:
     Args:
         old_file (Path | str): Path to the old, presumably already in use, file.
         new_file (Path | str): Path to the new file that could potentially replace the old one.
+        cache (ProbeCache | None): Cache to read the tags from, rather than opening the files.
 
     Returns:
         bool: Whether the two files represent the same track for the same album.
     """
-    o = mutagen.File(old_file, easy=True)
-    n = mutagen.File(new_file, easy=True)
-
-    # NOTE the use of the list index. If any of these items return nothing, then it'll break
-    try:
-        is_same = (
-            transliterate(o["title"][0]).lower() == transliterate(n["title"][0]).lower()
-            and transliterate(o["album"][0]).lower() == transliterate(n["album"][0]).lower()
-            and transliterate(o["artist"][0]).lower() == transliterate(n["artist"][0]).lower()
-        )
-    except KeyError:
-        return False
-    return is_same
+    return tags_match(_probe(old_file, cache), _probe(new_file, cache))
 
 
 def get_field_values_from_track(music_track: Path | str, fields: list):
@@ -111,18 +217,13 @@ def get_field_values_from_track(music_track: Path | str, fields: list):
     return [o[field][0] for field in fields]
 
 
-def is_upgradable(old_file: Path | str, new_file: Path | str) -> bool:
-    o = mutagen.File(old_file)
-    n = mutagen.File(new_file)
-    if isinstance(o, MP3) and isinstance(n, MP3):
-        if n.info.bitrate > o.info.bitrate:
-            return True
-    elif isinstance(o, MP3) and isinstance(n, FLAC):
-        return True
-    elif isinstance(o, MP3) and isinstance(n, MP4):
-        if n.info.codec.lower() == "alac":
-            return True
-    return False
+def is_upgradable(
+    old_file: Path | str, new_file: Path | str, cache: ProbeCache | None = None
+) -> bool:
+    """Whether the new file is of a higher quality than the old one, as scored by `quality`"""
+    old_score = quality.score_probe(_probe(old_file, cache))
+    new_score = quality.score_probe(_probe(new_file, cache))
+    return quality.is_better(new_score, old_score)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,432 @@
+"""A single SQLite database holding the library and the progress of every stage.
+
+Without it, each stage reads the CSV file written by the stage before it and writes new,
+timestamped CSV files of its own. With it, every track is a row of the `tracks` table, keyed by
+its persistent ID. Each stage reads the rows waiting for it, and saves its results back into the
+columns it owns, along with when it processed the row.
+
+A row waits for a stage when it is eligible, e.g. it can be upgraded, and the stage before
+changed it since the stage last processed it. These conditions have partial indexes, so finding
+the rows pending apply, or those whose `year_action` changed since they were converted, does not
+scan the table. Columns are typed, with `last_played` stored as a timestamp, and are handed to
+the stages as the strings they would have read from a CSV file.
+
+Any stage's rows can be exported to a CSV file and imported again after editing, e.g. to change
+the `year_action` of the tracks to upgrade.
+"""
+import csv
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+from typing import Iterable, Iterator, Mapping
+
+from .records import CSV_HEADER, TrackRecord, parse_played_date
+
+LOG = logging.getLogger(__name__)
+
+LIBRARY_COLUMNS = {
+    "persistent_id": "TEXT",
+    "track_number": "INTEGER",
+    "track_name": "TEXT",
+    "track_artist": "TEXT",
+    "album": "TEXT",
+    "album_artist": "TEXT",
+    "track_year": "INTEGER",
+    "last_played": "TIMESTAMP",
+    "play_count": "INTEGER",
+    "location": "TEXT",
+}
+"""Columns loaded from the Music library, in the order of CSV_HEADER"""
+
+CHECK_COLUMNS = {
+    "can_upgrade": "BOOLEAN",
+    "upgrade_reason": "TEXT",
+    "b_id": "INTEGER",
+    "b_original_year": "INTEGER",
+    "b_year": "INTEGER",
+    "year_action": "TEXT",
+    "b_library": "TEXT",
+    "b_score": "REAL",
+    "runner_up_file": "TEXT",
+    "runner_up_score": "REAL",
+    "match_score": "REAL",
+    "match_title": "TEXT",
+}
+"""Columns saved by the upgrade check under their own names, and read by every later stage"""
+
+COLUMN_TYPES = {
+    **LIBRARY_COLUMNS,
+    "loaded_at": "REAL",
+    **CHECK_COLUMNS,
+    "beets_file": "TEXT",
+    "checked_at": "REAL",
+    "staged_file": "TEXT",
+    "converted_year_action": "TEXT",
+    "converted_at": "REAL",
+    "library_file": "TEXT",
+    "target_existed": "BOOLEAN",
+    "copied_at": "REAL",
+    "applied_location": "TEXT",
+    "success": "BOOLEAN",
+    "error": "TEXT",
+    "applied_at": "REAL",
+}
+"""Every column of the tracks table, with its type"""
+
+CHECK_INPUTS = ("track_name", "track_artist", "album", "location")
+"""Library columns the upgrade check depends on. Loading new values makes a track wait for it"""
+
+COMMIT_EVERY = 500
+"""Rows saved between commits"""
+
+READ_CHUNK = 500
+"""Rows read with each query while iterating over the rows pending for a stage"""
+
+
+@dataclass(frozen=True)
+class Stage:
+    name: str
+    done: str
+    """Column holding when the stage last processed a row"""
+    outputs: dict[str, str]
+    """Columns of a processed row that are saved, and the table column each is saved in"""
+    eligible: str = "1"
+    """Condition of the rows the stage processes"""
+    pending: str = "1"
+    """Condition of the eligible rows changed since the stage last processed them"""
+
+
+def _same(columns: Iterable[str]) -> dict[str, str]:
+    return {column: column for column in columns}
+
+
+STAGES = {
+    stage.name: stage
+    for stage in (
+        Stage("load", "loaded_at", _same(LIBRARY_COLUMNS)),
+        Stage(
+            "check",
+            "checked_at",
+            {**_same(CHECK_COLUMNS), "new_file": "beets_file"},
+            pending="checked_at IS NULL OR checked_at < loaded_at",
+        ),
+        Stage(
+            "convert",
+            "converted_at",
+            {"new_file": "staged_file", "year_action": "converted_year_action"},
+            eligible="can_upgrade AND beets_file IS NOT NULL",
+            pending="converted_at IS NULL OR converted_at < checked_at "
+            "OR year_action IS NOT converted_year_action",
+        ),
+        Stage(
+            "copy",
+            "copied_at",
+            {"new_file": "library_file", "target_existed": "target_existed"},
+            eligible="can_upgrade AND staged_file IS NOT NULL",
+            pending="copied_at IS NULL OR copied_at < converted_at",
+        ),
+        Stage(
+            "apply",
+            "applied_at",
+            {"new_file": "applied_location", "success": "success", "error": "error"},
+            eligible="can_upgrade AND library_file IS NOT NULL",
+            pending="applied_at IS NULL OR applied_at < copied_at OR NOT success",
+        ),
+    )
+}
+"""The stages, in the order they run"""
+
+STAGE_NAMES = tuple(STAGES)
+
+
+def view(stage: str) -> dict[str, str]:
+    """The columns of the rows a stage produces, and the table column each is read from.
+
+    This is what the stage would have written to its CSV file, and what the next stage reads.
+    """
+    columns = _same(LIBRARY_COLUMNS)
+    if STAGE_NAMES.index(stage) > STAGE_NAMES.index("check"):
+        columns.update(_same(CHECK_COLUMNS))
+    columns.update(STAGES[stage].outputs)
+    return columns
+
+
+def input_view(stage: str) -> dict[str, str]:
+    """The columns of the rows a stage reads, produced by the stage before it"""
+    return view(STAGE_NAMES[STAGE_NAMES.index(stage) - 1])
+
+
+def to_db(kind: str, value):
+    """Convert a value read from a CSV file or set by a stage to the type of its column"""
+    if value is None or value == "":
+        return None
+    if kind == "BOOLEAN":
+        return int(value if not isinstance(value, str) else value.lower() in ("true", "1"))
+    if kind == "TIMESTAMP":
+        if isinstance(value, str) and (value := parse_played_date(value)) is None:
+            return None
+        return value.timestamp() if isinstance(value, datetime) else float(value)
+    try:
+        if kind == "INTEGER":
+            return int(value)
+        if kind == "REAL":
+            return float(value)
+    except ValueError:
+        # Kept as given, as SQLite does with values that do not fit the column's type
+        return str(value)
+    return str(value)
+
+
+def to_row(kind: str, value):
+    """Convert a column's value to what reading it from a CSV file gives the stages"""
+    if kind == "TIMESTAMP":
+        return None if value is None else datetime.fromtimestamp(value)
+    if value is None:
+        return ""
+    if kind == "BOOLEAN":
+        return str(bool(value))
+    return str(value)
+
+
+class WorkingDatabase:
+    """The tracks table, read and updated by each stage in turn.
+
+    Safe to share between threads. Saved rows are committed in batches, and by `commit`.
+    """
+
+    def __init__(self, path: Path | str):
+        self.path = Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            columns = ",\n".join(
+                f"{column} {kind}{' PRIMARY KEY' if column == 'persistent_id' else ''}"
+                for column, kind in COLUMN_TYPES.items()
+            )
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS tracks ({columns})")
+            for stage in STAGES.values():
+                if stage.eligible != "1":
+                    self._conn.execute(
+                        f"CREATE INDEX IF NOT EXISTS eligible_{stage.name} "
+                        f"ON tracks (persistent_id) WHERE {stage.eligible}"
+                    )
+                if stage.pending != "1":
+                    self._conn.execute(
+                        f"CREATE INDEX IF NOT EXISTS pending_{stage.name} "
+                        f"ON tracks (persistent_id) WHERE {self._condition(stage.name)}"
+                    )
+
+    @staticmethod
+    def _condition(stage: str, redo=False) -> str:
+        spec = STAGES[stage]
+        if redo:
+            return spec.eligible
+        return f"({spec.eligible}) AND ({spec.pending})"
+
+    def load_library(self, items: Iterable[tuple]) -> int:
+        """Replace the library with the tracks loaded from Music, keeping what the stages saved.
+
+        Tracks no longer in the library are removed. New tracks, and tracks whose title, artist,
+        album or location changed, wait for the upgrade check again.
+
+        Args:
+            items: The values of each track, in the order of CSV_HEADER
+
+        Returns:
+            The number of tracks loaded
+        """
+        loaded = []
+
+        def _remember(item):
+            loaded.append((item[0],))
+            return item
+
+        with self._lock, self._conn:
+            count = self._upsert(map(_remember, items))
+            self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS loaded (persistent_id TEXT)")
+            self._conn.execute("DELETE FROM temp.loaded")
+            self._conn.executemany("INSERT INTO temp.loaded VALUES (?)", loaded)
+            removed = self._conn.execute(
+                "DELETE FROM tracks "
+                "WHERE persistent_id NOT IN (SELECT persistent_id FROM temp.loaded)"
+            ).rowcount
+        LOG.info("Loaded %s tracks into %s, removed %s", count, self.path, removed)
+        return count
+
+    def _upsert(self, items: Iterable[tuple]) -> int:
+        """Insert or update tracks. Must be called holding the lock"""
+        columns = list(LIBRARY_COLUMNS)
+        updates = ", ".join(f"{cc} = excluded.{cc}" for cc in columns[1:])
+        changed = " OR ".join(f"excluded.{cc} IS NOT tracks.{cc}" for cc in CHECK_INPUTS)
+        sql = (
+            f"INSERT INTO tracks ({', '.join(columns)}, loaded_at) "
+            f"VALUES ({', '.join('?' for _ in columns)}, ?) "
+            f"ON CONFLICT (persistent_id) DO UPDATE SET {updates}, "
+            f"loaded_at = CASE WHEN {changed} THEN excluded.loaded_at ELSE tracks.loaded_at END"
+        )
+        kinds = list(LIBRARY_COLUMNS.values())
+        now = time.time()
+        rows = ((*(to_db(kk, vv) for kk, vv in zip(kinds, item)), now) for item in items)
+        return self._conn.executemany(sql, rows).rowcount
+
+    def library(self) -> dict[str, tuple]:
+        """The values of every track, by persistent ID, as they would be read from a CSV file"""
+        columns = ", ".join(LIBRARY_COLUMNS)
+        with self._lock:
+            rows = self._conn.execute(f"SELECT {columns} FROM tracks ORDER BY rowid").fetchall()
+        kinds = list(LIBRARY_COLUMNS.values())
+        return {
+            row[0]: tuple(
+                "" if value is None else str(to_row(kind, value))
+                for kind, value in zip(kinds, row)
+            )
+            for row in rows
+        }
+
+    def count_pending(self, stage: str, redo=False) -> int:
+        with self._lock:
+            (count,) = self._conn.execute(
+                f"SELECT count(*) FROM tracks WHERE {self._condition(stage, redo)}"
+            ).fetchone()
+        return count
+
+    def pending(self, stage: str, redo=False) -> Iterator[TrackRecord]:
+        """The rows waiting for a stage, in the order they were loaded.
+
+        Args:
+            stage: The name of the stage
+            redo: Every row the stage can process, even those it already processed
+
+        Returns:
+            Records with the columns the stage reads, whose index is the row's rowid
+        """
+        with self._lock:
+            rowids = [
+                rowid
+                for (rowid,) in self._conn.execute(
+                    f"SELECT rowid FROM tracks WHERE {self._condition(stage, redo)}"
+                )
+            ]
+        rowids.sort()
+        # Read in chunks, as rows are saved while the stage runs
+        yield from self._records(input_view(stage), rowids)
+
+    def _records(self, columns: dict[str, str], rowids: list[int]) -> Iterator[TrackRecord]:
+        kinds = [COLUMN_TYPES[column] for column in columns.values()]
+        selected = ", ".join(columns.values())
+        ids = iter(rowids)
+        while chunk := list(islice(ids, READ_CHUNK)):
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT rowid, {selected} FROM tracks "
+                    f"WHERE rowid IN ({', '.join('?' for _ in chunk)}) ORDER BY rowid",
+                    chunk,
+                ).fetchall()
+            for rowid, *values in rows:
+                record = TrackRecord(index=rowid)
+                for name, kind, value in zip(columns, kinds, values):
+                    record[name] = to_row(kind, value)
+                yield record
+
+    def save(self, stage: str, processed: Mapping):
+        """Save what a stage produced for a row, clearing the stage's columns it did not set"""
+        spec = STAGES[stage]
+        values = {
+            column: to_db(COLUMN_TYPES[column], processed.get(name))
+            for name, column in spec.outputs.items()
+        }
+        values[spec.done] = time.time()
+        assignments = ", ".join(f"{column} = ?" for column in values)
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE tracks SET {assignments} WHERE persistent_id = ?",
+                (*values.values(), processed["persistent_id"]),
+            )
+            self._unsaved += 1
+            if self._unsaved >= COMMIT_EVERY:
+                self._conn.commit()
+                self._unsaved = 0
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+            self._unsaved = 0
+
+    def export_csv(self, path: Path, stage: str, upgrades_only=False) -> int:
+        """Write the rows a stage processed to a CSV file, as the stage would have written them.
+
+        Args:
+            path: The CSV file to write
+            stage: The name of the stage
+            upgrades_only: Only the rows of tracks that can be upgraded
+
+        Returns:
+            The number of rows written
+        """
+        spec = STAGES[stage]
+        conditions = [f"{spec.done} IS NOT NULL"]
+        if upgrades_only:
+            conditions.append("can_upgrade")
+        with self._lock:
+            rowids = [
+                rowid
+                for (rowid,) in self._conn.execute(
+                    f"SELECT rowid FROM tracks WHERE {' AND '.join(conditions)} ORDER BY rowid"
+                )
+            ]
+        columns = view(stage)
+        with path.open("w", newline="") as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=list(columns))
+            writer.writeheader()
+            writer.writerows(self._records(columns, rowids))
+        return len(rowids)
+
+    def import_csv(self, path: Path, stage: str) -> int:
+        """Update the rows of a stage from a CSV file, e.g. one exported and edited by hand.
+
+        Only the columns found in the file are updated, matching rows by their persistent ID.
+        Importing the rows of the load stage adds the tracks that are missing.
+
+        Returns:
+            The number of rows updated or added
+        """
+        columns = view(stage)
+        with path.open(newline="") as csv_file:
+            reader = csv.DictReader(csv_file)
+            if stage == "load":
+                with self._lock, self._conn:
+                    return self._upsert(
+                        tuple(row.get(column, "") for column in CSV_HEADER) for row in reader
+                    )
+            found = [name for name in reader.fieldnames if name in columns]
+            done = STAGES[stage].done
+            assignments = ", ".join(f"{columns[name]} = ?" for name in found)
+            sql = (
+                f"UPDATE tracks SET {assignments}, {done} = coalesce({done}, ?) "
+                "WHERE persistent_id = ?"
+            )
+            now = time.time()
+            rows = (
+                (
+                    *(to_db(COLUMN_TYPES[columns[name]], row[name]) for name in found),
+                    now,
+                    row["persistent_id"],
+                )
+                for row in reader
+            )
+            with self._lock, self._conn:
+                return self._conn.executemany(sql, rows).rowcount
+
+    def close(self):
+        self.commit()
+        with self._lock:
+            self._conn.close()
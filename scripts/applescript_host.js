@@ -0,0 +1,75 @@
+// Long-running host for AppleScript commands, used by applescript.PersistentTransport.
+//
+// Run with: osascript -l JavaScript applescript_host.js
+//
+// Each request read from stdin is framed as "<length>\n<script>" and each response written to
+// stdout as "<OK|ERR> <length>\n<output>", with lengths counted in bytes of UTF-8. The output
+// is formatted the same way osascript prints a result, e.g. lists are joined with ", ".
+ObjC.import("Foundation");
+
+var TYPE_AE_LIST = 0x6c697374; // 'list'
+
+function readHeader(handle) {
+    var header = "";
+    while (true) {
+        var data = handle.readDataOfLength(1);
+        if (data.length == 0) {
+            return null;
+        }
+        var c = $.NSString.alloc.initWithDataEncoding(data, $.NSUTF8StringEncoding).js;
+        if (c === "\n") {
+            return header;
+        }
+        header += c;
+    }
+}
+
+function formatDescriptor(descriptor) {
+    if (descriptor.isNil()) {
+        return "";
+    }
+    var count = descriptor.numberOfItems;
+    if (descriptor.descriptorType == TYPE_AE_LIST) {
+        var items = [];
+        for (var ii = 1; ii <= count; ii++) {
+            items.push(formatDescriptor(descriptor.descriptorAtIndex(ii)));
+        }
+        return items.join(", ");
+    }
+    var text = descriptor.stringValue;
+    return text.isNil() ? "" : text.js;
+}
+
+function writeResponse(handle, status, output) {
+    var payload = $(output).dataUsingEncoding($.NSUTF8StringEncoding);
+    var header = $(status + " " + payload.length + "\n");
+    handle.writeData(header.dataUsingEncoding($.NSUTF8StringEncoding));
+    handle.writeData(payload);
+}
+
+function run() {
+    var stdin = $.NSFileHandle.fileHandleWithStandardInput;
+    var stdout = $.NSFileHandle.fileHandleWithStandardOutput;
+    while (true) {
+        var header = readHeader(stdin);
+        if (header === null) {
+            return;
+        }
+        var length = parseInt(header, 10);
+        var data = length > 0 ? stdin.readDataOfLength(length) : $.NSData.data;
+        var source = $.NSString.alloc.initWithDataEncoding(data, $.NSUTF8StringEncoding);
+
+        var error = Ref();
+        var script = $.NSAppleScript.alloc.initWithSource(source);
+        var result = script.executeAndReturnError(error);
+        if (result.isNil()) {
+            var message = error[0].objectForKey("NSAppleScriptErrorMessage");
+            var number = error[0].objectForKey("NSAppleScriptErrorNumber");
+            var text = message.isNil() ? "AppleScript error" : message.js;
+            var code = number.isNil() ? -2700 : number.js;
+            writeResponse(stdout, "ERR", "execution error: " + text + " (" + code + ")");
+        } else {
+            writeResponse(stdout, "OK", formatDescriptor(result));
+        }
+    }
+}
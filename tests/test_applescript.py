@@ -0,0 +1,229 @@
+import csv
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import call, patch
+
+from music_upgrader import applescript as apl
+from music_upgrader import tracks
+from music_upgrader.fake_music import (
+    FAKE_LIBRARY_ENV,
+    FakeMusic,
+    FakeMusicTransport,
+    write_library,
+)
+from music_upgrader.runner import get_runner
+
+FAKE_HOST = [sys.executable, "-m", "music_upgrader.fake_music", "-l", "JavaScript", "host.js"]
+
+TRACKS = [
+    {
+        "persistent_id": "61A578F3A06A1801",
+        "track_number": 13,
+        "track_name": "Bucket Head",
+        "track_artist": "Meat Puppets",
+        "album": "No Strings Attached",
+        "album_artist": "Meat Puppets",
+        "track_year": 1990,
+        "last_played": None,
+        "play_count": 1,
+        "location": "/Users/me/Music/13 Bucket Head.mp3",
+    }
+]
+
+SCRIPTS = Path(__file__).parent.parent / "scripts"
+
+GET_INFO = f"{apl.SELECT_TRACK_BY_ID.format('61A578F3A06A1801')}\n{apl.GET_TRACK_INFO}"
+
+
+class FramingTests(unittest.TestCase):
+    def test_lengths_are_counted_in_bytes(self):
+        self.assertEqual(b"7\n" + "Mötley".encode(), apl.encode_request("Mötley"))
+        self.assertEqual(b"ERR 3\nabc", apl.encode_response(False, "abc"))
+
+    def test_quote_escapes_applescript_strings(self):
+        self.assertEqual(r'"Say \"Hi\" C:\\"', apl.quote('Say "Hi" C:\\'))
+
+
+class PersistentTransportTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        library_file = Path(self.temp_dir.name) / "library.json"
+        library_file.write_text(json.dumps(TRACKS))
+        env = {
+            FAKE_LIBRARY_ENV: str(library_file),
+            "PYTHONPATH": str(Path(__file__).parent.parent),
+        }
+        patcher = patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.transport = apl.PersistentTransport(FAKE_HOST, timeout=10)
+        self.addCleanup(self.transport.close)
+
+    def test_commands_share_one_process(self):
+        for _ in range(3):
+            stdout, stderr = self.transport.execute(apl.LOAD_ALL_FILE_IDS)
+            self.assertEqual(("61A578F3A06A1801\n", ""), (stdout, stderr))
+        self.assertEqual(1, self.transport.starts)
+
+    def test_errors_are_returned_as_stderr(self):
+        stdout, stderr = self.transport.execute(apl.SELECT_TRACK_BY_ID.format("MISSING"))
+        self.assertEqual("", stdout)
+        self.assertIn("execution error", stderr)
+
+    def test_dead_process_is_restarted(self):
+        self.transport.execute(apl.LOAD_ALL_FILE_IDS)
+        self.transport._proc.kill()
+        self.transport._proc.wait()
+        stdout, _ = self.transport.execute(GET_INFO)
+        self.assertEqual("Bucket Head", stdout.splitlines()[1])
+        self.assertEqual(2, self.transport.starts)
+
+    def test_unresponsive_process_times_out_and_is_killed(self):
+        sleeper = [sys.executable, "-c", "import time; time.sleep(30)"]
+        transport = apl.PersistentTransport(sleeper)
+        self.addCleanup(transport.close)
+        with self.assertRaises(subprocess.TimeoutExpired):
+            transport.execute(apl.LOAD_ALL_FILE_IDS, timeout=0.2)
+        self.assertIsNone(transport._proc)
+
+    def test_timeout_defaults_to_the_runner_timeout(self):
+        sleeper = [sys.executable, "-c", "import time; time.sleep(30)"]
+        transport = apl.PersistentTransport(sleeper)
+        self.addCleanup(transport.close)
+        runner = get_runner()
+        self.addCleanup(
+            runner.configure, "osascript", timeout=runner.backends["osascript"].timeout
+        )
+        runner.configure("osascript", timeout=0.2)
+        with self.assertRaises(subprocess.TimeoutExpired) as raised:
+            transport.execute(apl.LOAD_ALL_FILE_IDS)
+        self.assertEqual(0.2, raised.exception.timeout)
+
+
+class FakeMusicTests(unittest.TestCase):
+    def setUp(self):
+        self.music = FakeMusic(
+            json.loads(json.dumps(TRACKS))
+            + [{**TRACKS[0], "persistent_id": "61A578F3A06A1802", "track_name": "Lake of Fire"}]
+        )
+        apl.set_transport(FakeMusicTransport(self.music))
+        self.addCleanup(apl.set_transport, None)
+
+    def test_every_template_is_understood(self):
+        self.assertEqual(
+            1990, tracks._get_year_alt("lake of fire", "Meat Puppets", "No Strings Attached")
+        )
+        select = apl.SELECT_TRACK_BY_ID.format("61A578F3A06A1802")
+        apl.run(f"{select}\n{apl.SET_TRACK_YEAR.format(1984)}")
+        apl.run(f"{select}\n{apl.SET_TRACK_PLAYED_COUNT.format(3)}")
+        tracks.set_file_location("61A578F3A06A1802", "Macintosh HD:Music:Lake of Fire.m4a")
+        self.assertEqual(
+            {"track_year": 1984, "play_count": 3, "location": "/Music/Lake of Fire.m4a"},
+            {kk: self.music.tracks[1][kk] for kk in ("track_year", "play_count", "location")},
+        )
+        self.assertEqual(
+            "61A578F3A06A1801, 61A578F3A06A1802, 1, 3\n", apl.run(apl.LOAD_ALL_PLAY_COUNTS)
+        )
+
+    def test_selecting_a_track_reads_the_tracks_before_it(self):
+        tracks.get_year("61A578F3A06A1802")
+        self.assertEqual(2, self.music.tracks_read)
+        tracks.load_all_bulk()
+        self.assertEqual(2 + 2 * len(apl.FILE_TRACK_PROPERTIES), self.music.tracks_read)
+        self.assertEqual(2, self.music.calls)
+
+    def test_bulk_load_keeps_the_volume_of_each_location(self):
+        location = "/Volumes/Ext/Music/AC:DC/Rock n Roll.m4a"
+        self.music.tracks[1]["location"] = location
+        with patch.object(apl, "run", wraps=apl.run) as mock_run:
+            loaded = tracks.load_all_bulk()
+        column = apl.FILE_TRACK_PROPERTIES.index("location")
+        self.assertEqual(location, loaded[1][column])
+        self.assertIn(f"if ii is {column + 1} then", mock_run.call_args.args[0])
+        self.assertEqual(tracks.BULK_LOAD_TIMEOUT, mock_run.call_args.args[1])
+
+    def test_scanned_tracks_and_latency_are_charged(self):
+        self.music.latency = 0.5
+        self.music.scan_cost = 0.1
+        with patch("music_upgrader.fake_music.time.sleep") as sleep:
+            tracks.get_year("61A578F3A06A1802")
+        self.assertEqual([call(0.5), call(0.2)], sleep.call_args_list)
+
+
+class FakeMusicProcessTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+        env = {
+            "HOME": str(self.root),
+            "PYTHONPATH": str(Path(__file__).parent.parent),
+        }
+        patcher = patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _use_library(self, name):
+        library_file = self.root / name
+        write_library(TRACKS, library_file)
+        os.environ[FAKE_LIBRARY_ENV] = str(library_file)
+        apl.set_transport(apl.SubprocessTransport(FAKE_HOST[:3]))
+        self.addCleanup(apl.set_transport, None)
+
+    def test_changes_are_seen_by_the_next_process(self):
+        for name in ("library.json", "library.db"):
+            with self.subTest(name):
+                self._use_library(name)
+                new_file = "Macintosh HD:Music:Bucket Head.m4a"
+                tracks.set_file_location("61A578F3A06A1801", new_file)
+                self.assertEqual("/Music/Bucket Head.m4a", tracks.load_all()[0][-1])
+                (track,) = FakeMusic.from_file(self.root / name).tracks
+                self.assertEqual(
+                    ("Bucket Head", "/Music/Bucket Head.m4a"),
+                    (track["track_name"], track["location"]),
+                )
+
+    def test_load_all_script_writes_the_library_file(self):
+        self._use_library("library.db")
+        data_file = self.root / "Code" / "Data" / "Music" / "Upgrader" / "libraryFiles.csv"
+        data_file.parent.mkdir(parents=True)
+        with patch.object(apl, "OSASCRIPT", FAKE_HOST[:3]):
+            self.assertTrue(apl.run_script(SCRIPTS / "load_all.applescript"))
+        with data_file.open() as csv_file:
+            (row,) = csv.DictReader(csv_file)
+        self.assertEqual("Bucket Head", row["track_name"])
+        self.assertEqual("missing value", row["last_played"])
+        self.assertEqual(apl.posix_path_to_hfs_path(TRACKS[0]["location"]), row["location"])
+
+
+class TransportSelectionTests(unittest.TestCase):
+    def tearDown(self):
+        apl.set_transport(None)
+
+    def test_run_uses_the_configured_transport(self):
+        apl.set_transport(FakeMusicTransport(FakeMusic(TRACKS)))
+        self.assertEqual(1990, tracks.get_year("61A578F3A06A1801"))
+        self.assertEqual(["61A578F3A06A1801"], tracks.load_all_ids())
+
+    def test_set_file_locations_round_trips_quoted_paths(self):
+        music = FakeMusic(json.loads(json.dumps(TRACKS)))
+        apl.set_transport(FakeMusicTransport(music))
+        new_file = apl.posix_path_to_hfs_path('/Users/me/Music/Say "Hi".m4a')
+        outcomes = tracks.set_file_locations([("61A578F3A06A1801", new_file)])
+        self.assertEqual({"61A578F3A06A1801": "OK"}, outcomes)
+        self.assertEqual('/Users/me/Music/Say "Hi".m4a', music.tracks[0]["location"])
+
+    def test_persistent_transport_is_chosen_from_the_environment(self):
+        apl.set_transport(None)
+        with patch.dict(os.environ, {apl.TRANSPORT_ENV: "persistent"}):
+            self.assertIsInstance(apl.get_transport(), apl.PersistentTransport)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,190 @@
+import csv
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import create_autospec
+
+import mutagen
+
+from music_upgrader.convert_cache import ConversionCache, audio_fingerprint, sync_tags
+from music_upgrader.db import CliDataService
+from music_upgrader.processors import ConvertFiles
+from music_upgrader.synthetic import write_flac, write_m4a
+
+
+def write_flac_with_audio(path: Path, audio: bytes, **tags) -> Path:
+    """Write a FLAC file whose frames are the given bytes, with an empty STREAMINFO MD5"""
+    write_flac(path)
+    with path.open("ab") as flac_file:
+        flac_file.write(audio)
+    if tags:
+        flac = mutagen.File(path, easy=True)
+        flac.add_tags()
+        for key, value in tags.items():
+            flac[key] = value
+        flac.save()
+    return path
+
+
+class AudioFingerprintTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+
+    def test_tags_do_not_change_the_fingerprint(self):
+        plain = write_flac_with_audio(self.root / "plain.flac", b"frames")
+        tagged = write_flac_with_audio(self.root / "tagged.flac", b"frames", title="Plateau")
+        other = write_flac_with_audio(self.root / "other.flac", b"other frames")
+        self.assertEqual(audio_fingerprint(plain), audio_fingerprint(tagged))
+        self.assertNotEqual(audio_fingerprint(plain), audio_fingerprint(other))
+        self.assertTrue(audio_fingerprint(plain).startswith("sha256:"))
+
+    def test_streaminfo_md5_is_used_when_present(self):
+        path = write_flac(self.root / "track.flac")
+        data = bytearray(path.read_bytes())
+        # The MD5 is the last 16 bytes of the STREAMINFO block
+        data[26:42] = bytes(range(1, 17))
+        path.write_bytes(bytes(data))
+        self.assertEqual(f"md5:{bytes(range(1, 17)).hex()}", audio_fingerprint(path))
+
+    def test_settings_are_part_of_the_key(self):
+        path = write_flac_with_audio(self.root / "track.flac", b"frames")
+        self.assertNotEqual(
+            ConversionCache.key_for(path, {"format": "alac"}),
+            ConversionCache.key_for(path, {"format": "aac"}),
+        )
+
+
+class ConversionCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+        self.cache = ConversionCache(self.root / "cache", max_bytes=3000)
+        self.addCleanup(self.cache.close)
+
+    def _converted(self, name, size=1000) -> Path:
+        path = self.root / f"{name}.m4a"
+        path.write_bytes(os.urandom(size))
+        return path
+
+    def test_stored_conversions_are_fetched(self):
+        converted = self._converted("a")
+        target = self.root / "staging" / "a.m4a"
+        self.assertFalse(self.cache.fetch("a", target))
+        self.cache.store("a", converted)
+        self.assertTrue(self.cache.fetch("a", target))
+        self.assertEqual(converted.read_bytes(), target.read_bytes())
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_least_recently_used_are_evicted(self):
+        for key in "abc":
+            self.cache.store(key, self._converted(key))
+        self.cache.fetch("a", self.root / "a_again.m4a")
+        self.cache.store("d", self._converted("d"))
+        self.assertEqual({"entries": 3, "size": 3000}, {
+            kk: vv for kk, vv in self.cache.stats().items() if kk in ("entries", "size")
+        })
+        self.assertFalse(self.cache.fetch("b", self.root / "b_again.m4a"))
+        self.assertTrue(self.cache.fetch("a", self.root / "a_again.m4a"))
+
+    def test_prune_to_zero_empties_the_cache(self):
+        for key in "ab":
+            self.cache.store(key, self._converted(key))
+        self.assertEqual((2, 2000), self.cache.prune(0))
+        self.assertEqual(0, self.cache.stats()["entries"])
+        self.assertEqual([], list(self.root.glob("cache/*/*.m4a")))
+
+
+class SyncTagsTests(unittest.TestCase):
+    def test_only_differing_tags_are_written(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            flac = write_flac(root / "a.flac", title="Plateau", artist="Meat Puppets", date="1984")
+            m4a = write_m4a(root / "a.m4a", title="Plateau", artist="Meat Puppets", date="1990")
+            self.assertEqual(["date"], sync_tags(flac, m4a))
+            self.assertEqual(["1984"], mutagen.File(m4a, easy=True)["date"])
+            self.assertEqual([], sync_tags(flac, m4a))
+
+    def test_track_and_disc_totals_are_kept(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            flac = write_flac(
+                root / "a.flac", tracknumber="3", tracktotal="12", discnumber="1", disctotal="2"
+            )
+            m4a = write_m4a(root / "a.m4a", tracknumber="3/12", discnumber="1/2")
+            self.assertEqual([], sync_tags(flac, m4a))
+            flac_tags = mutagen.File(flac, easy=True)
+            flac_tags["tracknumber"] = "4"
+            del flac_tags["tracktotal"]
+            flac_tags.save()
+            self.assertEqual(["tracknumber"], sync_tags(flac, m4a))
+            self.assertEqual([(4, 12)], mutagen.File(m4a)["trkn"])
+            self.assertEqual([(1, 2)], mutagen.File(m4a)["disk"])
+
+
+class ConvertFilesCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+        self.dest = self.root / "converted"
+        config_file = self.root / "config.yaml"
+        config_file.write_text(f"convert:\n  dest: {self.dest}\n  format: alac")
+        self.mock_svc = create_autospec(CliDataService)
+        self.mock_svc.config_loc = str(config_file)
+        self.mock_svc.convert_2.side_effect = self._fake_convert
+
+        album = self.root / "beets" / "FLAC" / "Meat Puppets" / "Up on the Sun"
+        album.mkdir(parents=True)
+        self.rows = [
+            {
+                "track_artist": "Meat Puppets",
+                "track_name": f"Track {ii}",
+                "album": "Up on the Sun",
+                "track_year": "1985",
+                "new_file": str(
+                    write_flac_with_audio(
+                        album / f"{ii:02} - Track {ii}.flac",
+                        f"frames {ii}".encode(),
+                        title=f"Track {ii}",
+                        date="1985",
+                    )
+                ),
+            }
+            for ii in range(3)
+        ]
+        self.data_file = self.root / "upgrade_checks.csv"
+        with self.data_file.open("w") as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=self.rows[0].keys())
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+    def _fake_convert(self, path):
+        parts = Path(path).parts
+        converted = self.dest.joinpath(*parts[parts.index("FLAC"):]).with_suffix(".m4a")
+        converted.parent.mkdir(parents=True, exist_ok=True)
+        flac = mutagen.File(path, easy=True)
+        write_m4a(converted, title=flac["title"], date=flac["date"])
+        return []
+
+    def _convert(self):
+        cache = ConversionCache(self.root / "cache")
+        self.addCleanup(cache.close)
+        convert = ConvertFiles(self.data_file, self.mock_svc, convert_cache=cache)
+        return convert.process_csv()
+
+    def test_second_run_reuses_conversions_and_updates_tags(self):
+        self._convert()
+        self.assertEqual(3, self.mock_svc.convert_2.call_count)
+        retagged = mutagen.File(self.rows[0]["new_file"], easy=True)
+        retagged["date"] = "1986"
+        retagged.save()
+
+        self.mock_svc.convert_2.reset_mock()
+        results = self._convert()
+        self.mock_svc.convert_2.assert_not_called()
+        self.assertEqual(["1986"], mutagen.File(results[0]["new_file"], easy=True)["date"])
+        self.assertEqual(["1985"], mutagen.File(results[1]["new_file"], easy=True)["date"])
@@ -1,6 +1,25 @@
 import re
 import string
+import tempfile
+import time
 import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from beets.library import Item, Library
+
+from music_upgrader.db import (
+    DBS,
+    ApiDataService,
+    FuzzyMatcher,
+    LibrarySet,
+    MatchIndex,
+    NormalizedKeyStore,
+    fuzzy_tokens,
+    normalize,
+    regexify,
+    similarity,
+)
 
 
 class StringReplacementTests(unittest.TestCase):
@@ -18,5 +37,229 @@ class StringReplacementTests(unittest.TestCase):
         self.assertEqual(expected, converted)
 
 
+class NormalizeTests(unittest.TestCase):
+    def test_punctuation_is_dropped(self):
+        self.assertEqual("heythatsright", normalize("Hey, That's Right!"))
+
+    def test_beets_apostrophes_and_dashes_match_plain_ones(self):
+        self.assertEqual(normalize("Static-X"), normalize("Static‐X"))
+        self.assertEqual(normalize("Hey, That's Right!"), normalize("Hey, That’s Right"))
+
+    def test_matches_the_same_values_as_regexify(self):
+        for token, candidate in [
+            ("Hey, That's Right!", "hey That’s Right"),
+            ("Static-X", "Static‐X"),
+            ("Rock-n-Roll", "Rock n Roll"),
+            ("AC/DC", "AC DC"),
+        ]:
+            self.assertRegex(candidate, f"^{regexify(token)}$")
+            self.assertEqual(normalize(token), normalize(candidate))
+
+    def test_missing_values_are_empty(self):
+        self.assertEqual("", normalize(None))
+
+
+class MatchIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.items = [
+            Item(id=1, artist="Powerman 5000", album="Transform", title="Hey, That’s Right"),
+            Item(id=2, artist="Static‐X", album="Wisconsin Death Trip", title="Push It"),
+            Item(id=3, artist="Static‐X", album="Wisconsin Death Trip", title="Push It"),
+        ]
+        self.index = MatchIndex(self.items)
+
+    def test_finds_track_using_normalized_values(self):
+        found = self.index.find_track("Hey, That's Right!", "Powerman 5000", "Transform")
+        self.assertEqual([1], [ff["id"] for ff in found])
+
+    def test_keeps_every_matching_item(self):
+        found = self.index.find_track("Push It", "Static-X", "Wisconsin Death Trip")
+        self.assertEqual([2, 3], [ff["id"] for ff in found])
+
+    def test_missing_track_returns_empty_list(self):
+        self.assertEqual([], self.index.find_track("Push It", "Static-X", "Machine"))
+
+
+class FuzzyTokensTests(unittest.TestCase):
+    def test_part_abbreviations_are_folded(self):
+        self.assertEqual(
+            fuzzy_tokens("Construction of the Masses, Part 1"),
+            fuzzy_tokens("Construction of the Masses Pt. 1"),
+        )
+
+    def test_punctuation_separates_words(self):
+        self.assertEqual(
+            fuzzy_tokens("Now That's Rock 'N Roll"), fuzzy_tokens("Now That’s Rock-n-Roll")
+        )
+
+    def test_numbers_ordinals_and_roman_numerals_are_folded(self):
+        self.assertEqual(("part", "2"), fuzzy_tokens("Part II"))
+        self.assertEqual(("part", "2"), fuzzy_tokens("Pt. Two"))
+        self.assertEqual(("2", "chance"), fuzzy_tokens("2nd Chance"))
+
+    def test_accents_and_ampersands_are_folded(self):
+        self.assertEqual(("beyonce", "and", "jay", "z"), fuzzy_tokens("Beyoncé & Jay-Z"))
+
+    def test_different_numbers_score_low(self):
+        self.assertLess(similarity(fuzzy_tokens("Part 1"), fuzzy_tokens("Part 2")), 0.5)
+
+
+class FuzzyMatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.items = [
+            Item(id=1, artist="Mudvayne", album="L.D. 50", title="Death Blooms"),
+            Item(id=2, artist="Mudvayne", album="L.D. 50", title="Dig"),
+            Item(id=3, artist="Mudvayne", album="The End of All Things to Come", title="Dig"),
+        ]
+        self.matcher = FuzzyMatcher(self.items)
+
+    def test_scores_close_titles_on_the_same_album(self):
+        (match,) = self.matcher.find_track("Death Bloom", "Mudvayne", "LD 50")
+        self.assertEqual(1, match.item["id"])
+        self.assertGreater(match.score, 0.9)
+        self.assertLess(match.score, 1.0)
+
+    def test_only_compares_titles_from_the_same_album(self):
+        matches = self.matcher.find_track("Dig", "Mudvayne", "L.D. 50")
+        self.assertEqual([2], [mm.item["id"] for mm in matches])
+        self.assertEqual(2, len(self.matcher))
+
+    def test_unrelated_titles_are_not_reported(self):
+        self.assertEqual([], self.matcher.find_track("Not Falling", "Mudvayne", "L.D. 50"))
+
+
+class LibrarySetTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+        options = {}
+        for name, title in (("main", "Push It"), ("vinyl", "Push It"), ("extra", "Bled for Days")):
+            library = Library(str(self.root / f"{name}.db"), str(self.root))
+            library.add(Item(artist="Static-X", album="Wisconsin Death Trip", title=title))
+            options[name] = {"path": str(self.root / f"{name}.db"), "directory": str(self.root)}
+        patcher = patch.dict(DBS, options)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.libraries = LibrarySet.open(["main", "vinyl", "extra"])
+        self.addCleanup(self.libraries.close)
+
+    def test_index_covers_every_library(self):
+        index = self.libraries.build_match_index()
+        found = index.find_track("Push It", "Static-X", "Wisconsin Death Trip")
+        self.assertEqual(["main", "vinyl"], [self.libraries.library_of(ii) for ii in found])
+
+    def test_queries_search_every_library(self):
+        found = self.libraries.find_album("Static-X", "Wisconsin Death Trip")
+        self.assertEqual(
+            ["main", "vinyl", "extra"], [self.libraries.library_of(ii) for ii in found]
+        )
+        self.assertEqual(
+            ["Bled for Days"],
+            [ii["title"] for ii in self.libraries.find_track("Bled for Days", "Static-X", "")],
+        )
+
+
+class NormalizedKeyStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+        self.library = Library(str(self.root / "library.db"), str(self.root))
+        self.items = [
+            Item(artist="Powerman 5000", album="Transform", title="Hey, That’s Right"),
+            Item(artist="Static‐X", album="Wisconsin Death Trip", title="Push It"),
+        ]
+        for item in self.items:
+            self.library.add(item)
+        self.store = NormalizedKeyStore(self.root / "keys.db", self.library.path)
+        self.addCleanup(self.store.close)
+
+    def test_finds_items_by_normalized_values(self):
+        self.assertEqual(2, self.store.refresh())
+        found = self.store.find_ids("Powerman 5000", "Transform", "Hey, That's Right!")
+        self.assertEqual([self.items[0].id], found)
+        found = self.store.find_ids("Static-X", "Wisconsin Death Trip", "Push-It")
+        self.assertEqual([self.items[1].id], found)
+
+    def test_refresh_only_updates_changed_items(self):
+        self.store.refresh()
+        self.items[1].title = "I'm With Stupid"
+        self.items[1].mtime = time.time()
+        self.items[1].store()
+        self.assertEqual(1, self.store.refresh())
+        self.assertEqual(0, self.store.refresh())
+        found = self.store.find_ids("Static-X", "Wisconsin Death Trip", "Im With Stupid")
+        self.assertEqual([self.items[1].id], found)
+
+    def test_refresh_finds_edits_made_to_the_database_only(self):
+        self.store.refresh()
+        # As `beet modify -W` does, neither mtime nor added change
+        with self.library.transaction() as tx:
+            tx.mutate("UPDATE items SET title = ? WHERE id = ?", ("Bled", self.items[1].id))
+        self.assertEqual(1, self.store.refresh(full=True))
+        found = self.store.find_ids("Static-X", "Wisconsin Death Trip", "Bled")
+        self.assertEqual([self.items[1].id], found)
+
+    def test_refresh_compares_items_stamped_at_the_watermark(self):
+        self.store.refresh()
+        # Stored in the same clock tick as the newest item of the last refresh
+        with self.library.transaction() as tx:
+            (stamp,) = tx.query("SELECT MAX(MAX(mtime, added)) FROM items")[0]
+            tx.mutate(
+                "UPDATE items SET title = ?, mtime = ? WHERE id = ?",
+                ("Bled", stamp, self.items[0].id),
+            )
+        self.assertEqual(1, self.store.refresh())
+        found = self.store.find_ids("Powerman 5000", "Transform", "Bled")
+        self.assertEqual([self.items[0].id], found)
+
+    def test_full_refresh_drops_removed_items(self):
+        self.store.refresh()
+        self.items[0].remove()
+        self.store.refresh(full=True)
+        self.assertEqual(
+            [], self.store.find_ids("Powerman 5000", "Transform", "Hey, That's Right!")
+        )
+
+    def test_keys_stored_by_an_older_version_are_rebuilt(self):
+        self.store.refresh()
+        with self.store._conn:
+            self.store._conn.execute("UPDATE keys SET title = 'push it'")
+            self.store._conn.execute("PRAGMA user_version = 1")
+        self.store.close()
+        self.store = NormalizedKeyStore(self.root / "keys.db", self.library.path)
+        self.addCleanup(self.store.close)
+        self.assertEqual(2, self.store.refresh())
+        found = self.store.find_ids("Static-X", "Wisconsin Death Trip", "Push It")
+        self.assertEqual([self.items[1].id], found)
+
+    def _service(self):
+        options = {"path": str(self.library.path), "directory": str(self.root)}
+        with patch.dict(DBS, {"keys": options}):
+            service = ApiDataService("keys", key_store_path=self.root / "service_keys.db")
+        self.addCleanup(service.key_store.close)
+        return service
+
+    def test_api_service_uses_store_for_regex_lookups_only(self):
+        service = self._service()
+        with patch.object(service, "_execute_query", return_value=[]) as mock_query:
+            found = service.find_track(
+                "Hey, That's Right!", "Powerman 5000", "Transform", use_regex=True
+            )
+            mock_query.assert_not_called()
+            service.find_album("Static-X", "Wisconsin Death Trip")
+            service.find_all_album_tracks("Static-X", "Wisconsin")
+        self.assertEqual(["Hey, That’s Right"], [ff.title for ff in found])
+        self.assertEqual(2, mock_query.call_count)
+
+    def test_store_matches_punctuation_against_spaces(self):
+        item = Item(artist="AC DC", album="Blow Up Your Video", title="Rock n Roll")
+        self.library.add(item)
+        service = self._service()
+        found = service.find_track("Rock-n-Roll", "AC/DC", "Blow Up Your Video", use_regex=True)
+        self.assertEqual([item.id], [ff.id for ff in found])
+
+
 if __name__ == "__main__":
     unittest.main()
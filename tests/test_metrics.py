@@ -0,0 +1,97 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from music_upgrader.metrics import (
+    SAMPLE_SIZE,
+    Metrics,
+    SpanStats,
+    format_comparison,
+    load_runs,
+    set_metrics,
+    span,
+    summarize,
+    timed,
+    to_prometheus,
+    write_summary,
+)
+
+
+@timed("double")
+def double(number):
+    return number * 2
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(set_metrics, None)
+
+    def test_spans_are_only_recorded_while_metrics_are_active(self):
+        with span("ignored"):
+            double(1)
+        recorded = Metrics("Test")
+        set_metrics(recorded)
+        for ii in range(3):
+            self.assertEqual(ii * 2, double(ii))
+        with span("block"):
+            pass
+        self.assertEqual({"double": 3, "block": 1}, {
+            name: stats.count for name, stats in recorded.spans.items()
+        })
+
+    def test_failed_calls_are_still_timed(self):
+        recorded = Metrics("Test")
+        set_metrics(recorded)
+        with self.assertRaises(TypeError):
+            double()
+        self.assertEqual(1, recorded.spans["double"].count)
+
+    def test_summary_uses_nearest_rank_percentiles(self):
+        summary = summarize([ii / 100 for ii in range(100, 0, -1)])
+        self.assertEqual(100, summary["count"])
+        self.assertAlmostEqual(50.5, summary["total"])
+        self.assertEqual((0.5, 0.95, 0.99), (summary["p50"], summary["p95"], summary["p99"]))
+
+    def test_span_memory_is_bounded_by_the_sample_size(self):
+        stats = SpanStats()
+        for ii in range(SAMPLE_SIZE * 4):
+            stats.add(1.0 if ii % 2 else 3.0)
+        self.assertEqual(SAMPLE_SIZE, len(stats.samples))
+        summary = stats.summary()
+        self.assertEqual(SAMPLE_SIZE * 4, summary["count"])
+        self.assertAlmostEqual(SAMPLE_SIZE * 8, summary["total"])
+        self.assertEqual(3.0, summary["p99"])
+
+    def test_prometheus_output_has_quantiles_and_run_gauges(self):
+        recorded = Metrics("CopyFiles")
+        recorded.record("stage_move", 0.25)
+        recorded.rows = 1
+        text = to_prometheus(recorded.summary())
+        self.assertIn(
+            'mup_span_seconds{stage="CopyFiles",span="stage_move",quantile="0.95"} 0.25', text
+        )
+        self.assertIn('mup_span_seconds_count{stage="CopyFiles",span="stage_move"} 1', text)
+        self.assertIn('mup_run_rows{stage="CopyFiles"} 1', text)
+        self.assertTrue(text.endswith("\n"))
+
+    def test_recent_runs_are_compared(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            directory = Path(temp_dir)
+            for ii, total in enumerate((2.0, 1.0, 3.0)):
+                summary = {
+                    "stage": "CopyFiles",
+                    "started": f"2024-01-0{ii + 1}T00:00:00+00:00",
+                    "seconds": total,
+                    "rows": 10,
+                    "rows_per_second": 10 / total,
+                    "spans": {"stage_move": summarize([total])},
+                }
+                write_summary(summary, directory, f"run_{ii}")
+            runs = load_runs(directory, limit=2)
+        self.assertEqual(["CopyFiles"], list(runs))
+        self.assertEqual([1.0, 3.0], [run["seconds"] for run in runs["CopyFiles"]])
+        self.assertRegex(format_comparison(runs["CopyFiles"]), r"stage_move\s+1\s+3\.00.*\+200%")
+
+
+if __name__ == "__main__":
+    unittest.main()
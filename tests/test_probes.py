@@ -0,0 +1,116 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import mutagen
+
+from music_upgrader import probes, tracks
+from music_upgrader.probes import ProbeCache, probe_file
+from music_upgrader.synthetic import write_flac, write_mp3
+
+
+class ProbeFileTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+
+    def test_reads_mp3_details_and_tags(self):
+        path = write_mp3(self.root / "a.mp3", 320, title="Lake of Fire", artist="Meat Puppets")
+        probe = probe_file(path)
+        self.assertEqual(
+            ("MP3", "mp3", 320000, 44100),
+            (probe.format, probe.codec, probe.bitrate, probe.sample_rate),
+        )
+        self.assertEqual(
+            ("Lake of Fire", None, "Meat Puppets"), (probe.title, probe.album, probe.artist)
+        )
+
+    def test_reads_flac_details(self):
+        probe = probe_file(write_flac(self.root / "a.flac", 96000, 24))
+        self.assertEqual(
+            ("FLAC", "flac", 96000, 24),
+            (probe.format, probe.codec, probe.sample_rate, probe.bits_per_sample),
+        )
+
+
+class ProbeCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+        self.cache = ProbeCache(self.root / "probes.db")
+        self.addCleanup(self.cache.close)
+        self.mp3 = write_mp3(self.root / "a.mp3", 128, title="Bucket Head")
+
+    def test_unchanged_file_is_only_read_once(self):
+        with patch.object(probes.mutagen, "File", wraps=mutagen.File) as mock_file:
+            first = self.cache.get(self.mp3)
+            second = self.cache.get(self.mp3)
+        self.assertEqual(first, second)
+        self.assertEqual(1, mock_file.call_count)
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_changed_file_is_read_again(self):
+        self.cache.get(self.mp3)
+        stat = self.mp3.stat()
+        os.utime(self.mp3, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        self.cache.get(self.mp3)
+        self.assertEqual(2, self.cache.misses)
+
+    def test_cache_survives_between_runs(self):
+        self.cache.get(self.mp3)
+        other = ProbeCache(self.root / "probes.db")
+        self.addCleanup(other.close)
+        with patch.object(probes.mutagen, "File") as mock_file:
+            self.assertEqual("Bucket Head", other.get(self.mp3).title)
+        mock_file.assert_not_called()
+
+    def test_warm_only_reads_uncached_files(self):
+        paths = [write_mp3(self.root / f"{ii}.mp3") for ii in range(5)]
+        self.cache.get(paths[0])
+        self.assertEqual(4, self.cache.warm([*paths, paths[1], self.root / "missing.mp3"]))
+        self.assertEqual(0, self.cache.warm(paths))
+
+
+class CachedTrackComparisonTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+        self.cache = ProbeCache(self.root / "probes.db")
+        self.addCleanup(self.cache.close)
+        tags = {"title": "Hey, That's Right!", "album": "Transform", "artist": "Powerman 5000"}
+        self.mp3_128 = write_mp3(self.root / "128.mp3", 128, **tags)
+        self.mp3_320 = write_mp3(self.root / "320.mp3", 320, **tags)
+        self.flac = write_flac(self.root / "a.flac", **tags)
+
+    def test_mp3_is_upgradable_to_higher_bitrate_and_flac(self):
+        self.assertTrue(tracks.is_upgradable(self.mp3_128, self.mp3_320, self.cache))
+        self.assertTrue(tracks.is_upgradable(self.mp3_128, self.flac, self.cache))
+        self.assertFalse(tracks.is_upgradable(self.mp3_320, self.mp3_128, self.cache))
+
+    def test_same_track_is_read_from_cache(self):
+        self.assertTrue(tracks.is_same_track(self.mp3_128, self.flac, self.cache))
+        self.assertTrue(tracks.is_upgradable(self.mp3_128, self.flac, self.cache))
+        self.assertEqual(2, self.cache.misses)
+
+    def test_missing_tags_are_not_the_same_track(self):
+        untagged = write_mp3(self.root / "untagged.mp3")
+        self.assertFalse(tracks.is_same_track(self.mp3_128, untagged, self.cache))
+
+    def test_only_differing_tags_are_folded_once(self):
+        tags = {"title": "Hey, That's Right!", "album": "Transform", "artist": "POWERMAN 5000"}
+        shouting = write_mp3(self.root / "shouting.mp3", **tags)
+        tracks.fold_tag.cache_clear()
+        self.addCleanup(tracks.fold_tag.cache_clear)
+        with patch.object(tracks, "transliterate", wraps=tracks.transliterate) as mock_fold:
+            for _ in range(3):
+                self.assertTrue(tracks.is_same_track(self.mp3_128, shouting, self.cache))
+        self.assertEqual(2, mock_fold.call_count)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,14 +1,196 @@
+import csv
+import json
+import os
+import sys
 import tempfile
+import threading
 import unittest
+from datetime import datetime
 from pathlib import Path
-from unittest.mock import MagicMock, create_autospec, mock_open, patch
+from unittest.mock import MagicMock, call, create_autospec, mock_open, patch
 
 from music_upgrader import applescript as apl
-from music_upgrader.db import CMDS, CliDataService
-from music_upgrader.processors import CopyFiles, ConvertFiles
+from music_upgrader import tracks
+from beets.library import Item, Library
+
+from music_upgrader.db import (
+    CMDS,
+    DBS,
+    ApiDataService,
+    CliDataService,
+    FuzzyMatcher,
+    LibrarySet,
+    MatchIndex,
+)
+from music_upgrader.fake_music import (
+    FAKE_LIBRARY_ENV,
+    TRACK_BY_ID_RE,
+    FakeMusic,
+    FakeMusicTransport,
+)
+from music_upgrader.probes import ProbeCache
+from music_upgrader.staging import FileStager
+from music_upgrader.synthetic import write_flac, write_mp3
+from music_upgrader.processors import (
+    CSV_HEADER,
+    ApplyUpgrade,
+    BaseProcess,
+    ConvertFiles,
+    CopyFiles,
+    LoadLatestLibrary,
+    UpgradeCheck,
+)
 
 TEST_CMDS = {"test": {"exe_name": "beet", "exec": ["beet", "-c", "/tmp/beets/config.yaml"]}}
 
+FAKE_OSASCRIPT = [sys.executable, "-m", "music_upgrader.fake_music"]
+
+FAKE_TRACKS = [
+    {
+        "persistent_id": "61A578F3A06A1801",
+        "track_number": 13,
+        "track_name": "Bucket Head",
+        "track_artist": "Meat Puppets",
+        "album": "No Strings Attached",
+        "album_artist": "Meat Puppets",
+        "track_year": 1990,
+        "last_played": "Saturday, January 6, 2024 at 10:15:00 PM",
+        "play_count": 12,
+        "location": "/Users/me/Music/Meat Puppets/No Strings Attached/13 Bucket Head.mp3",
+    },
+    {
+        "persistent_id": "61A578F3A06A1802",
+        "track_number": 2,
+        "track_name": "Hey, That's Right!",
+        "track_artist": "Powerman 5000",
+        "album": "Transform",
+        "album_artist": "Powerman 5000",
+        "track_year": 2003,
+        "last_played": None,
+        "play_count": 0,
+        "location": None,
+    },
+    {
+        "persistent_id": "61A578F3A06A1803",
+        "track_number": 1,
+        "track_name": "Lake of Fire",
+        "track_artist": "Meat Puppets",
+        "album": "No Strings Attached",
+        "album_artist": "Meat Puppets",
+        "track_year": 1990,
+        "last_played": "Sunday, January 7, 2024 at 9:00:00 AM",
+        "play_count": 3,
+        "location": "/Users/me/Music/Meat Puppets/No Strings Attached/01 Lake of Fire.mp3",
+    },
+]
+
+
+class LoadLatestLibraryTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        library_file = Path(self.temp_dir.name) / "library.json"
+        library_file.write_text(json.dumps(FAKE_TRACKS))
+        env = {
+            FAKE_LIBRARY_ENV: str(library_file),
+            "PYTHONPATH": str(Path(__file__).parent.parent),
+        }
+        patcher = patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(apl, "OSASCRIPT", FAKE_OSASCRIPT)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _load(self, bulk):
+        data_path = Path(self.temp_dir.name) / f"libraryFiles_{bulk}.csv"
+        loader = LoadLatestLibrary(Path("unused.applescript"), data_path, bulk=bulk)
+        loader.output_dir = Path(self.temp_dir.name)
+        loader.run()
+        with data_path.open() as csv_file:
+            return list(csv.reader(csv_file))
+
+    def test_bulk_load_writes_sorted_library_csv(self):
+        rows = self._load(bulk=True)
+        self.assertEqual(list(CSV_HEADER), rows[0])
+        self.assertEqual(
+            ["61A578F3A06A1803", "61A578F3A06A1801", "61A578F3A06A1802"],
+            [row[0] for row in rows[1:]],
+        )
+        self.assertEqual("Hey, That's Right!", rows[3][2])
+        self.assertEqual("missing value", rows[3][7])
+        self.assertEqual("", rows[3][9])
+        self.assertEqual(FAKE_TRACKS[0]["location"], rows[2][9])
+
+    def test_bulk_load_matches_per_track_load(self):
+        self.assertEqual(self._load(bulk=False), self._load(bulk=True))
+
+    def test_load_writes_metrics(self):
+        self._load(bulk=True)
+        (summary,) = Path(self.temp_dir.name).glob("metrics/*_LoadLatestLibrary_*.json")
+        summary = json.loads(summary.read_text())
+        self.assertEqual(3, summary["rows"])
+        self.assertEqual(1, summary["spans"]["applescript"]["count"])
+
+
+class IncrementalLoadTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.data_path = Path(self.temp_dir.name) / "libraryFiles.csv"
+        self.music = FakeMusic(
+            [{**track, "modification_date": "Monday, January 1, 2024"} for track in FAKE_TRACKS]
+        )
+        self.transport = FakeMusicTransport(self.music)
+        apl.set_transport(self.transport)
+        self.addCleanup(apl.set_transport, None)
+
+    def _load(self, incremental=True):
+        with patch.object(self.transport, "execute", wraps=self.transport.execute) as mock_exec:
+            loader = LoadLatestLibrary(Path("unused"), self.data_path, incremental=incremental)
+            loader.output_dir = Path(self.temp_dir.name)
+            items = loader.run()
+        selected = sorted(
+            TRACK_BY_ID_RE.search(call.args[0]).group(1)
+            for call in mock_exec.call_args_list
+            if TRACK_BY_ID_RE.search(call.args[0])
+        )
+        return items, selected
+
+    def test_first_load_is_a_full_load(self):
+        items, selected = self._load()
+        self.assertEqual(3, len(items))
+        self.assertEqual([], selected)
+        snapshot = self.data_path.with_name("libraryFiles_snapshot.json")
+        self.assertEqual(3, len(json.loads(snapshot.read_text())))
+
+    def _change_library(self):
+        self.music.tracks[0].update(track_name="Bucket Head (Live)", modification_date="Tuesday")
+        self.music.tracks[1]["play_count"] = 7
+        del self.music.tracks[2]
+        self.music.tracks.append({**FAKE_TRACKS[2], "persistent_id": "61A578F3A06A1804"})
+
+    @patch.object(LoadLatestLibrary, "FULL_RELOAD_RATIO", 1.0)
+    def test_only_new_and_modified_tracks_are_fetched(self):
+        self._load()
+        self._change_library()
+
+        items, selected = self._load()
+        self.assertEqual(["61A578F3A06A1801", "61A578F3A06A1804"], selected)
+        full_items, _ = self._load(incremental=False)
+        self.assertEqual(
+            [tuple(map(str, item)) for item in full_items],
+            [tuple(map(str, item)) for item in items],
+        )
+        self.assertEqual("7", next(item for item in items if item[0] == "61A578F3A06A1802")[8])
+
+    def test_many_changes_reload_the_full_library(self):
+        self._load()
+        self._change_library()
+        items, selected = self._load()
+        self.assertEqual([], selected)
+        self.assertIn("Bucket Head (Live)", [item[2] for item in items])
+
 
 class ConvertFilesTests(unittest.TestCase):
     def test_loads_convert_destination_from_yaml_config_file(self):
@@ -23,6 +205,569 @@ class ConvertFilesTests(unittest.TestCase):
             self.assertEqual(str(copy_files.output_location), temp_dir.name)
 
 
+class CliDataServiceTests(unittest.TestCase):
+    @patch.dict(CMDS, TEST_CMDS)
+    @patch("music_upgrader.db.get_runner")
+    def test_convert_paths_ors_path_queries_in_one_call(self, mock_get_runner):
+        mock_run = mock_get_runner.return_value.run
+        mock_run.return_value = MagicMock(stdout=b"", stderr=b"")
+        CliDataService("test").convert_paths(["/b/FLAC/a.flac", "/b/FLAC/b c.flac"], threads=4)
+        mock_run.assert_called_once()
+        self.assertEqual(
+            (
+                "beet",
+                [
+                    "beet", "-c", "/tmp/beets/config.yaml", "convert", "-y", "-t", "4",
+                    "path:/b/FLAC/a.flac", ",", "path:/b/FLAC/b c.flac",
+                ],
+            ),
+            mock_run.call_args.args,
+        )
+
+
+class ConvertFilesBatchTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+        self.dest = self.root / "converted"
+        config_file = self.root / "config.yaml"
+        config_file.write_text(f"convert:\n  dest: {self.dest}")
+        self.mock_svc = create_autospec(CliDataService)
+        self.mock_svc.config_loc = str(config_file)
+        self.mock_svc.convert_paths.side_effect = self._fake_convert
+        self.mock_svc.convert_2.side_effect = lambda path: self._fake_convert([path])
+
+        self.rows = [
+            {
+                "track_artist": "Meat Puppets",
+                "track_name": f"Track {ii}",
+                "album": album,
+                "track_year": "1990",
+                "new_file": f"/beets/FLAC/Meat Puppets/{album}/{ii:02} - Track {ii}.flac",
+            }
+            for album, count in (("No Strings Attached", 4), ("Up on the Sun", 2))
+            for ii in range(count)
+        ]
+        self.data_file = self.root / "upgrade_checks.csv"
+        with self.data_file.open("w") as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=self.rows[0].keys())
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+    def _fake_convert(self, paths, threads=None):
+        for path in paths:
+            parts = Path(path).parts
+            converted = self.dest.joinpath(*parts[parts.index("FLAC"):]).with_suffix(".m4a")
+            converted.parent.mkdir(parents=True, exist_ok=True)
+            converted.touch()
+        return []
+
+    def test_batches_by_album_are_split_by_size(self):
+        convert = ConvertFiles(self.data_file, self.mock_svc, batch_by="album", batch_size=3)
+        batches = convert.batch_files(self.rows)
+        self.assertEqual([3, 1, 2], [len(bb) for bb in batches])
+        self.assertEqual(
+            {Path(self.rows[4]["new_file"]).parent}, {Path(bb).parent for bb in batches[2]}
+        )
+
+    def test_batches_by_chunk_ignore_albums(self):
+        convert = ConvertFiles(self.data_file, self.mock_svc, batch_by="chunk", batch_size=4)
+        self.assertEqual([4, 2], [len(bb) for bb in convert.batch_files(self.rows)])
+
+    def test_batched_conversion_maps_outputs_back_to_rows(self):
+        convert = ConvertFiles(
+            self.data_file, self.mock_svc, batch_by="album", batch_size=20, convert_threads=4
+        )
+        results = convert.process_csv()
+        self.assertEqual(2, self.mock_svc.convert_paths.call_count)
+        self.mock_svc.convert_2.assert_not_called()
+        for row, result in zip(self.rows, results):
+            self.assertEqual(Path(row["new_file"]).stem, Path(result["new_file"]).stem)
+            self.assertTrue(Path(result["new_file"]).exists())
+        self.assertEqual({"threads": 4}, self.mock_svc.convert_paths.call_args.kwargs)
+
+    def test_files_are_converted_by_the_library_they_came_from(self):
+        for row in self.rows[:2]:
+            row["b_library"] = "archive"
+        with self.data_file.open("w") as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=["b_library", *self.rows[2]])
+            writer.writeheader()
+            writer.writerows(self.rows)
+        archive_svc = create_autospec(CliDataService)
+        archive_svc.config_loc = self.mock_svc.config_loc
+        archive_svc.convert_paths.side_effect = self._fake_convert
+        with patch("music_upgrader.processors.CliDataService", return_value=archive_svc) as cls:
+            convert = ConvertFiles(self.data_file, self.mock_svc, batch_by="album")
+            convert.process_csv()
+        cls.assert_called_once_with("archive")
+        self.assertEqual(2, len(archive_svc.convert_paths.call_args.args[0]))
+        self.assertEqual(2, self.mock_svc.convert_paths.call_count)
+
+    def test_unbatched_conversion_converts_each_file(self):
+        convert = ConvertFiles(self.data_file, self.mock_svc)
+        convert.process_csv()
+        self.assertEqual(6, self.mock_svc.convert_2.call_count)
+        self.mock_svc.convert_paths.assert_not_called()
+
+
+class UpgradeCheckTests(unittest.TestCase):
+    def setUp(self):
+        self.dummy_data_file = tempfile.NamedTemporaryFile()
+        self.addCleanup(self.dummy_data_file.close)
+        self.mock_db = create_autospec(ApiDataService)
+        self.mock_db.build_match_index.return_value = MatchIndex(
+            [Item(id=7, artist="Powerman 5000", album="Transform", title="Hey, That’s Right")]
+        )
+        self.mock_db.find_track.return_value = []
+
+    def test_index_match_skips_beets_queries(self):
+        check = UpgradeCheck(self.dummy_data_file.name, self.mock_db)
+        found = check.check_for_track("Hey, That's Right!", "Powerman 5000", "Transform")
+        self.assertEqual(7, found[0]["id"])
+        self.mock_db.find_track.assert_not_called()
+
+    def test_index_matches_punctuation_against_spaces(self):
+        self.mock_db.build_match_index.return_value = MatchIndex(
+            [Item(id=5, artist="AC DC", album="Blow Up Your Video", title="Rock n Roll")]
+        )
+        check = UpgradeCheck(self.dummy_data_file.name, self.mock_db)
+        found = check.check_for_track("Rock-n-Roll", "AC/DC", "Blow Up Your Video")
+        self.assertEqual(5, found[0]["id"])
+        self.mock_db.find_track.assert_not_called()
+
+    def test_index_is_built_once(self):
+        check = UpgradeCheck(self.dummy_data_file.name, self.mock_db)
+        check.check_for_track("Hey, That's Right!", "Powerman 5000", "Transform")
+        check.check_for_track("Transform", "Powerman 5000", "Transform")
+        self.mock_db.build_match_index.assert_called_once()
+
+    def test_index_miss_falls_back_to_plain_query_only(self):
+        check = UpgradeCheck(self.dummy_data_file.name, self.mock_db)
+        check.check_for_track("Transform", "Powerman 5000", "Transform")
+        self.mock_db.find_track.assert_called_once_with(
+            "Transform", "Powerman 5000", "Transform", use_regex=False
+        )
+
+    def _write_rows(self, titles):
+        with open(self.dummy_data_file.name, "w") as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=CSV_HEADER)
+            writer.writeheader()
+            for ii, title in enumerate(titles):
+                writer.writerow(
+                    {
+                        "persistent_id": f"ID{ii}",
+                        "track_number": ii,
+                        "track_name": title,
+                        "track_artist": "Artist",
+                        "album": "Album",
+                        "last_played": "Saturday, January 6, 2024 at 10:15:00 PM",
+                        "location": f"/i/{ii}.mp3",
+                    }
+                )
+
+    @patch("music_upgrader.processors.PROBE_WARM_CHUNK", 2)
+    def test_probe_cache_is_warmed_in_chunks_as_rows_stream(self):
+        self._write_rows([f"Track {ii}" for ii in range(5)])
+        probe_cache = create_autospec(ProbeCache)
+        check = UpgradeCheck(self.dummy_data_file.name, self.mock_db, probe_cache=probe_cache)
+        with patch.object(
+            UpgradeCheck, "determine_upgrade_status", return_value="BETTER_QUALITY"
+        ):
+            _, no_upgrade = check.process_csv()
+        self.assertEqual(
+            [["/i/0.mp3", "/i/1.mp3"], ["/i/2.mp3", "/i/3.mp3"], ["/i/4.mp3"]],
+            [list(warm.args[0]) for warm in probe_cache.warm.call_args_list],
+        )
+        self.assertEqual(datetime(2024, 1, 6, 22, 15), no_upgrade[0]["last_played"])
+
+    def test_workers_keep_input_order_and_split_results(self):
+        titles = [f"Track {ii}" for ii in range(20)]
+        self.mock_db.build_match_index.return_value = MatchIndex(
+            [
+                Item(id=ii, artist="Artist", album="Album", title=tt, path=b"/b/%d.flac" % ii)
+                for ii, tt in enumerate(titles)
+                if ii % 3
+            ]
+        )
+        self._write_rows(titles)
+
+        check = UpgradeCheck(self.dummy_data_file.name, self.mock_db, workers=4)
+        with patch.object(
+            UpgradeCheck, "determine_upgrade_status", return_value="BETTER_QUALITY"
+        ):
+            for_upgrade, no_upgrade = check.process_csv()
+        expected = [f"ID{ii}" for ii in range(20) if ii % 3]
+        self.assertEqual(expected, [row["persistent_id"] for row in for_upgrade])
+        expected = [f"ID{ii}" for ii in range(20) if not ii % 3]
+        self.assertEqual(expected, [row["persistent_id"] for row in no_upgrade])
+        self.mock_db.build_match_index.assert_called_once()
+
+    def _fuzzy_check(self, threshold):
+        self.mock_db.build_fuzzy_matcher.return_value = FuzzyMatcher(
+            [
+                Item(
+                    id=9,
+                    artist="Powerman 5000",
+                    album="Transform",
+                    title="Hey, That’s Right",
+                    path=b"/b/hey.flac",
+                )
+            ]
+        )
+        check = UpgradeCheck(self.dummy_data_file.name, self.mock_db, fuzzy_threshold=threshold)
+        row = {
+            "track_name": "Hey Thats Right (Live)",
+            "track_artist": "Powerman 5000",
+            "album": "Transform",
+            "location": "/i/hey.mp3",
+        }
+        with patch.object(
+            UpgradeCheck, "determine_upgrade_status", return_value="BETTER_QUALITY"
+        ):
+            return check.process_row(row)
+
+    def test_fuzzy_match_above_threshold_is_used(self):
+        processed = self._fuzzy_check(0.7)
+        self.assertTrue(processed["can_upgrade"])
+        self.assertEqual("/b/hey.flac", processed["new_file"])
+        self.assertEqual("Hey, That’s Right", processed["match_title"])
+        self.assertLess(processed["match_score"], 1.0)
+
+    def test_fuzzy_match_below_threshold_needs_review(self):
+        processed = self._fuzzy_check(0.95)
+        self.assertFalse(processed["can_upgrade"])
+        self.assertEqual("FUZZY_MATCH", processed["upgrade_reason"])
+        self.assertNotIn("new_file", processed)
+
+    def test_without_index_queries_beets(self):
+        check = UpgradeCheck(self.dummy_data_file.name, self.mock_db, use_index=False)
+        check.check_for_track("Transform", "Powerman 5000", "Transform")
+        self.assertEqual(2, self.mock_db.find_track.call_count)
+        self.mock_db.build_match_index.assert_not_called()
+
+    def test_by_album_queries_each_album_once(self):
+        self.mock_db.find_all_album_tracks.return_value = [
+            Item(id=7, artist="Powerman 5000", album="Transform", title="Hey, That’s Right"),
+            Item(id=8, artist="Powerman 5000", album="Transform", title="Transform"),
+        ]
+        check = UpgradeCheck(
+            self.dummy_data_file.name, self.mock_db, use_index=False, by_album=True
+        )
+        found = check.check_for_track("Hey, That's Right!", "Powerman 5000", "Transform")
+        self.assertEqual([7], [item["id"] for item in found])
+        found = check.check_for_track("transform", "Powerman 5000", "Transform")
+        self.assertEqual([8], [item["id"] for item in found])
+        self.mock_db.find_all_album_tracks.assert_called_once_with("Powerman 5000", "Transform")
+        self.mock_db.find_track.assert_not_called()
+
+    def test_by_album_queries_tracks_missing_from_the_album(self):
+        self.mock_db.find_all_album_tracks.return_value = []
+        check = UpgradeCheck(
+            self.dummy_data_file.name, self.mock_db, use_index=False, by_album=True
+        )
+        check.check_for_track("Transform", "Powerman 5000", "Transform")
+        check.check_for_track("Hey, That's Right!", "Powerman 5000", "Transform")
+        self.mock_db.find_all_album_tracks.assert_called_once()
+        self.assertEqual(
+            [
+                call("Transform", "Powerman 5000", "Transform", use_regex=True),
+                call("Hey, That's Right!", "Powerman 5000", "Transform", use_regex=True),
+            ],
+            self.mock_db.find_track.call_args_list,
+        )
+
+
+class MultiLibraryUpgradeCheckTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+        options = {}
+        for name, bitrate in (("main", 128), ("archive", 320)):
+            path = write_mp3(self.root / f"{name}.mp3", bitrate=bitrate)
+            library = Library(str(self.root / f"{name}.db"), str(self.root))
+            library.add(
+                Item(artist="Meat Puppets", album="Up on the Sun", title="Swimming Ground", path=path)
+            )
+            options[name] = {"path": str(self.root / f"{name}.db"), "directory": str(self.root)}
+        patcher = patch.dict(DBS, options)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.libraries = LibrarySet.open(["main", "archive"])
+        self.addCleanup(self.libraries.close)
+        self.itunes_file = write_mp3(self.root / "itunes.mp3", bitrate=128)
+
+    def _check(self, title):
+        check = UpgradeCheck(self.root / "library.csv", self.libraries)
+        return check.process_row(
+            {
+                "track_name": title,
+                "track_artist": "Meat Puppets",
+                "album": "Up on the Sun",
+                "location": str(self.itunes_file),
+            }
+        )
+
+    def test_best_file_across_libraries_is_used(self):
+        processed = self._check("Swimming Ground")
+        self.assertTrue(processed["can_upgrade"])
+        self.assertEqual("archive", processed["b_library"])
+        self.assertEqual(str(self.root / "archive.mp3"), processed["new_file"])
+
+    def test_rows_not_found_have_an_empty_library(self):
+        processed = self._check("Maiden's Milk")
+        self.assertEqual("NOT_FOUND", processed["upgrade_reason"])
+        self.assertEqual("", processed["b_library"])
+        self.assertEqual(("", "", ""), (
+            processed["b_score"], processed["runner_up_file"], processed["runner_up_score"]
+        ))
+
+    def test_score_and_runner_up_are_recorded(self):
+        processed = self._check("Swimming Ground")
+        self.assertEqual(90.0, processed["b_score"])
+        self.assertEqual(str(self.root / "main.mp3"), processed["runner_up_file"])
+        self.assertEqual(36.0, processed["runner_up_score"])
+
+
+class TagVerificationTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+        self.cache = ProbeCache(self.root / "probes.db")
+        self.addCleanup(self.cache.close)
+        tags = {"title": "Bucket Head", "album": "No Strings Attached", "artist": "Meat Puppets"}
+        self.mp3 = write_mp3(self.root / "a.mp3", 128, **tags)
+        self.flac = write_flac(self.root / "a.flac", **tags)
+        self.live = write_flac(self.root / "live.flac", **{**tags, "title": "Bucket Head (Live)"})
+
+    def test_each_file_is_read_once_to_verify_and_compare(self):
+        status = UpgradeCheck.determine_upgrade_status(self.mp3, self.flac, True, self.cache)
+        self.assertEqual("BETTER_QUALITY", status)
+        self.assertEqual((0, 2), (self.cache.hits, self.cache.misses))
+
+    def test_files_with_other_tags_do_not_match(self):
+        status = UpgradeCheck.determine_upgrade_status(self.mp3, self.live, True, self.cache)
+        self.assertEqual("DO_NOT_MATCH", status)
+        status = UpgradeCheck.determine_upgrade_status(self.mp3, self.live, False, None)
+        self.assertEqual("BETTER_QUALITY", status)
+
+
+class ApplyUpgradeTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+        self.music = FakeMusic(json.loads(json.dumps(FAKE_TRACKS)))
+        apl.set_transport(FakeMusicTransport(self.music))
+        self.addCleanup(apl.set_transport, None)
+
+        self.rows = []
+        for persistent_id in ("61A578F3A06A1801", "61A578F3A06A1803", "MISSING"):
+            original = self.root / f"{persistent_id}.mp3"
+            original.touch()
+            self.rows.append(
+                {
+                    "persistent_id": persistent_id,
+                    "location": str(original),
+                    "new_file": str(self.root / f"{persistent_id}.m4a"),
+                }
+            )
+        self.data_file = self.root / "copy_results.csv"
+        with self.data_file.open("w") as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=self.rows[0].keys())
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+    def test_batches_report_success_per_track(self):
+        results = ApplyUpgrade(self.data_file, batch_size=2).process_csv()
+        self.assertEqual([True, True, False], [row["success"] for row in results])
+        self.assertEqual(["", "", "Track not found"], [row["error"] for row in results])
+        self.assertEqual(
+            apl.posix_path_to_hfs_path(self.rows[0]["new_file"]), results[0]["new_file"]
+        )
+        self.assertEqual(self.rows[1]["new_file"], self.music.tracks[2]["location"])
+        self.assertFalse(any(Path(row["location"]).exists() for row in self.rows))
+
+    def test_positions_are_read_once_and_again_when_the_library_changes(self):
+        apply = ApplyUpgrade(self.data_file, batch_size=1)
+        with patch.object(
+            tracks, "file_track_positions", wraps=tracks.file_track_positions
+        ) as mock_positions:
+            apply.process_csv()
+            self.assertEqual(1, mock_positions.call_count)
+            del self.music.tracks[0]
+            results = apply.process_csv()
+        self.assertEqual(2, mock_positions.call_count)
+        self.assertEqual([False, True, False], [row["success"] for row in results])
+        self.assertEqual(self.rows[1]["new_file"], self.music.tracks[1]["location"])
+
+
+class Interrupted(Exception):
+    pass
+
+
+class NumberRows(BaseProcess):
+    """Doubles a number, failing once it reaches `fail_at`"""
+
+    def __init__(self, data_file, workers=1, fail_at=None):
+        super().__init__(data_file, workers=workers)
+        self.fail_at = fail_at
+        self.processed = []
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self._lock = threading.Lock()
+
+    def process_row(self, csv_row):
+        with self._lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        try:
+            number = int(csv_row["number"])
+            if number == self.fail_at:
+                raise Interrupted
+            self.processed.append(number)
+            return {**csv_row, "doubled": number * 2}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+class StreamingRunTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+        self.data_file = self.root / "numbers.csv"
+        with self.data_file.open("w") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(["number"])
+            writer.writerows([ii] for ii in range(50))
+
+    def _process(self, **kwargs) -> NumberRows:
+        process = NumberRows(self.data_file, **kwargs)
+        process.output_dir = self.root
+        return process
+
+    def _results(self):
+        (output,) = self.root.glob("numbers_results_*.csv")
+        with output.open() as csv_file:
+            return [int(row["doubled"]) for row in csv.DictReader(csv_file)]
+
+    def test_results_are_written_as_rows_finish(self):
+        with self.assertRaises(Interrupted):
+            self._process(fail_at=20).run()
+        self.assertEqual([ii * 2 for ii in range(20)], self._results())
+        self.assertTrue(self._process().checkpoint_path.exists())
+
+    def test_resume_skips_rows_already_written(self):
+        with self.assertRaises(Interrupted):
+            self._process(fail_at=20).run()
+        process = self._process()
+        process.run(resume=True)
+        self.assertEqual(list(range(20, 50)), process.processed)
+        self.assertEqual([ii * 2 for ii in range(50)], self._results())
+        self.assertFalse(process.checkpoint_path.exists())
+
+    def test_resume_replays_journaled_rows_missing_from_the_output(self):
+        with self.assertRaises(Interrupted):
+            self._process(fail_at=20).run()
+        # Lose the last rows written, as if the process died before they were flushed
+        (output,) = self.root.glob("numbers_results_*.csv")
+        output.write_text("".join(output.read_text().splitlines(keepends=True)[:11]))
+        process = self._process()
+        process.run(resume=True)
+        self.assertEqual(list(range(20, 50)), process.processed)
+        self.assertEqual([ii * 2 for ii in range(50)], self._results())
+
+    def test_run_writes_metrics(self):
+        self._process().run()
+        (summary,) = self.root.glob("metrics/numbers_NumberRows_*.json")
+        self.assertTrue(summary.with_suffix(".prom").exists())
+        summary = json.loads(summary.read_text())
+        self.assertEqual(50, summary["rows"])
+        self.assertEqual(50, summary["spans"]["row"]["count"])
+
+    def test_resume_refuses_a_changed_data_file(self):
+        with self.assertRaises(Interrupted):
+            self._process(fail_at=20).run()
+        with self.data_file.open("a") as csv_file:
+            csv_file.write("50\n")
+        with self.assertRaises(ValueError):
+            self._process().run(resume=True)
+
+    def test_workers_keep_order_with_few_rows_in_flight(self):
+        process = self._process(workers=4)
+        process.run()
+        self.assertEqual([ii * 2 for ii in range(50)], self._results())
+        self.assertLessEqual(process.most_in_flight, 4)
+
+
+class CopyFilesJournalTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+        (self.root / "staging").mkdir()
+        (self.root / "library").mkdir()
+        self.rows = []
+        for name in ("a", "b", "c"):
+            location = self.root / "library" / f"{name}.mp3"
+            location.write_text(f"old {name}")
+            new_file = self.root / "staging" / f"{name}.mp3"
+            new_file.write_text(f"new {name}")
+            self.rows.append({"location": str(location), "new_file": str(new_file)})
+        self.data_file = self.root / "converted.csv"
+        with self.data_file.open("w") as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=self.rows[0].keys())
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+    def _copy_files(self, move=None) -> CopyFiles:
+        stager = FileStager()
+        if move:
+            stager.move = move
+        copy_files = CopyFiles(self.data_file, create_autospec(CliDataService), stager=stager)
+        copy_files.output_dir = self.root
+        return copy_files
+
+    def _results(self):
+        (output,) = self.root.glob("converted_results_*.csv")
+        with output.open() as csv_file:
+            return list(csv.DictReader(csv_file))
+
+    def _interrupt_after_moving(self, src, dst):
+        FileStager().move(src, dst)
+        if Path(src).name == "b.mp3":
+            raise Interrupted
+        return "rename"
+
+    def _interrupt_before_moving(self, src, dst):
+        if Path(src).name == "b.mp3":
+            raise Interrupted
+        return FileStager().move(src, dst)
+
+    def test_resume_finishes_a_row_that_was_moved(self):
+        with self.assertRaises(Interrupted):
+            self._copy_files(move=self._interrupt_after_moving).run()
+        move = MagicMock(side_effect=FileStager().move)
+        self._copy_files(move=move).run(resume=True)
+        self.assertEqual(["c.mp3"], [Path(cc.args[0]).name for cc in move.call_args_list])
+        self.assertEqual(["True"] * 3, [row["target_existed"] for row in self._results()])
+        self.assertEqual("new b", (self.root / "library" / "b.mp3").read_text())
+        self.assertEqual("old b", (self.root / "library" / "b.bak").read_text())
+
+    def test_resume_restores_the_backup_of_a_row_that_was_not_moved(self):
+        with self.assertRaises(Interrupted):
+            self._copy_files(move=self._interrupt_before_moving).run()
+        self.assertFalse((self.root / "library" / "b.mp3").exists())
+        self._copy_files().run(resume=True)
+        self.assertEqual(["True"] * 3, [row["target_existed"] for row in self._results()])
+        self.assertEqual("new b", (self.root / "library" / "b.mp3").read_text())
+        self.assertEqual("old b", (self.root / "library" / "b.bak").read_text())
+
+
 class CopyFilesTests(unittest.TestCase):
 
     # @patch.dict(CMDS, TEST_CMDS)
@@ -0,0 +1,52 @@
+import tempfile
+import unittest
+from dataclasses import replace
+from pathlib import Path
+
+from music_upgrader import quality, tracks
+from music_upgrader.probes import AudioProbe, probe_file
+from music_upgrader.synthetic import write_flac, write_m4a, write_mp3
+
+
+class QualityTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+
+    def test_aac_outscores_mp3_at_the_same_bitrate(self):
+        mp3 = probe_file(write_mp3(self.root / "a.mp3", 320))
+        aac = replace(mp3, format="MP4", codec="mp4a.40.2")
+        self.assertTrue(quality.is_better(quality.score_probe(aac), quality.score_probe(mp3)))
+        self.assertFalse(quality.score_probe(aac).lossless)
+
+    def test_lossy_never_outscores_lossless(self):
+        aac = AudioProbe("a.m4a", 0, 0, "MP4", "mp4a.40.29", 10_000_000, 44100, 16, 2.0)
+        self.assertEqual(quality.LOSSY_CEILING, quality.score_probe(aac).score)
+        flac = quality.score_file(write_flac(self.root / "a.flac"))
+        self.assertEqual(quality.LOSSLESS_BASE, flac.score)
+
+    def test_flac_of_an_alac_file_is_not_an_upgrade(self):
+        alac = write_m4a(self.root / "a.m4a")
+        flac = write_flac(self.root / "a.flac")
+        self.assertEqual("alac", quality.score_file(alac).codec)
+        self.assertFalse(tracks.is_upgradable(str(alac), str(flac)))
+
+    def test_hi_res_flac_upgrades_cd_quality_alac(self):
+        alac = write_m4a(self.root / "a.m4a")
+        flac = write_flac(self.root / "a.flac", sample_rate=96000, bits_per_sample=24)
+        self.assertTrue(tracks.is_upgradable(str(alac), str(flac)))
+        self.assertAlmostEqual(117.0, quality.score_file(flac).score, places=0)
+
+    def test_rank_orders_best_first_and_skips_unreadable_files(self):
+        first = write_mp3(self.root / "first.mp3", 128)
+        second = write_mp3(self.root / "second.mp3", 128)
+        best = write_flac(self.root / "best.flac")
+        ranked = quality.rank([first, self.root / "missing.mp3", second, best])
+        self.assertEqual(
+            [str(best), str(first), str(second)], [score.path for score in ranked]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
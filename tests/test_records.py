@@ -0,0 +1,61 @@
+import csv
+import io
+import unittest
+
+from music_upgrader.records import CSV_HEADER, TrackRecord, intern_values
+
+ROW = {
+    "persistent_id": "61A578F3A06A1801",
+    "track_number": "13",
+    "track_name": "Bucket Head",
+    "track_artist": "Meat Puppets",
+    "album": "No Strings Attached",
+    "album_artist": "Meat Puppets",
+    "track_year": "1990",
+    "last_played": "",
+    "play_count": "1",
+    "location": "/Users/me/Music/13 Bucket Head.mp3",
+}
+
+
+class TrackRecordTests(unittest.TestCase):
+    def test_repeated_values_are_shared(self):
+        # Built at run time, so the strings are not shared constants of the test
+        first, second = (
+            TrackRecord({**ROW, "album": "".join(["No Strings ", "Attached"])}) for _ in range(2)
+        )
+        self.assertIs(first["album"], second["album"])
+        self.assertIs(first["track_artist"], first["album_artist"])
+        self.assertIs(first["album"], intern_values(tuple(ROW.values()))[4])
+
+    def test_behaves_like_the_row_it_was_read_from(self):
+        record = TrackRecord({**ROW, "new_file": "/b/a.m4a"}, index=3)
+        self.assertEqual({**ROW, "new_file": "/b/a.m4a"}, record)
+        self.assertEqual([*CSV_HEADER, "new_file"], list(record))
+        self.assertEqual("/b/a.m4a", record.get("new_file"))
+        self.assertIsNone(record.get("b_id"))
+        del record["location"]
+        self.assertNotIn("location", record)
+        with self.assertRaises(KeyError):
+            record["location"]
+
+    def test_copies_do_not_change_the_original(self):
+        record = TrackRecord(ROW, index=3)
+        row_cpy = record.copy()
+        row_cpy["track_name"] = "Plateau"
+        row_cpy["can_upgrade"] = False
+        self.assertEqual(ROW, record)
+        self.assertEqual(3, row_cpy.index)
+        self.assertEqual({**ROW, "track_name": "Plateau", "can_upgrade": False}, dict(row_cpy))
+
+    def test_written_with_the_csv_columns(self):
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=TrackRecord(ROW).keys())
+        writer.writeheader()
+        writer.writerow(TrackRecord(ROW))
+        output.seek(0)
+        self.assertEqual([ROW], list(csv.DictReader(output)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+
+from music_upgrader.runner import (
+    Backend,
+    CommandCancelled,
+    CommandRunner,
+    is_transient_applescript_error,
+)
+
+SLEEP = [sys.executable, "-c", "import time; time.sleep(30)"]
+
+FAIL_ONCE = """
+import pathlib, sys
+marker = pathlib.Path(sys.argv[1])
+if not marker.exists():
+    marker.touch()
+    sys.exit("execution error: Music got an error: AppleEvent timed out. (-1712)")
+print("done")
+"""
+
+
+def python(code: str, *args: str) -> list[str]:
+    return [sys.executable, "-c", code, *args]
+
+
+class CommandRunnerTests(unittest.TestCase):
+    def setUp(self):
+        self.runner = CommandRunner(
+            {
+                "test": Backend(concurrency=2),
+                "osascript": Backend(
+                    concurrency=1, retries=2, backoff=0, is_transient=is_transient_applescript_error
+                ),
+            }
+        )
+        self.addCleanup(self.runner.close)
+
+    def test_output_matches_subprocess_run(self):
+        resp = self.runner.run("test", python("import sys; print('out'); sys.exit('err')"))
+        self.assertEqual((b"out\n", b"err\n", 1), (resp.stdout, resp.stderr, resp.returncode))
+
+    def test_concurrency_is_limited_per_backend(self):
+        started = time.perf_counter()
+        results = self.runner.run_all(
+            "test", [python(f"import time; time.sleep(0.2); print({ii})") for ii in range(4)]
+        )
+        self.assertGreaterEqual(time.perf_counter() - started, 0.4)
+        self.assertEqual([b"0\n", b"1\n", b"2\n", b"3\n"], [resp.stdout for resp in results])
+
+    def test_timed_out_calls_are_killed(self):
+        started = time.perf_counter()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            self.runner.run("test", SLEEP, timeout=0.2)
+        self.assertLess(time.perf_counter() - started, 5)
+
+    def test_transient_applescript_errors_are_retried(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            marker = str(Path(temp_dir) / "failed")
+            resp = self.runner.run("osascript", python(FAIL_ONCE, marker))
+            self.assertEqual(b"done\n", resp.stdout)
+            # Other backends give up straight away
+            Path(marker).unlink()
+            resp = self.runner.run("test", python(FAIL_ONCE, marker))
+            self.assertEqual(1, resp.returncode)
+
+    def test_cancelling_kills_running_commands_and_refuses_new_ones(self):
+        errors = []
+
+        def _run():
+            try:
+                self.runner.run("test", SLEEP)
+            except CommandCancelled as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=_run)
+        thread.start()
+        time.sleep(0.2)
+        self.runner.cancel_all()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(1, len(errors))
+        with self.assertRaises(CommandCancelled):
+            self.runner.run("test", python("pass"))
+        self.runner.reset()
+        self.assertEqual(0, self.runner.run("test", python("pass")).returncode)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from music_upgrader import settings
+
+HEAVY_MODULES = ("beets", "mutagen", "yaml", "dateutil", "rich", "music_upgrader.processors")
+
+
+class StartupTests(unittest.TestCase):
+    def test_help_does_not_import_heavy_modules(self):
+        code = (
+            "import contextlib, io, json, sys\n"
+            "with contextlib.redirect_stdout(io.StringIO()):\n"
+            "    from music_upgrader.main import cli\n"
+            "    cli(['--help'], standalone_mode=False)\n"
+            f"print(json.dumps([mm for mm in {HEAVY_MODULES!r} if mm in sys.modules]))\n"
+        )
+        resp = subprocess.run(
+            [sys.executable, "-c", code],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent.parent,
+        )
+        self.assertEqual([], json.loads(resp.stdout.splitlines()[-1]))
+
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+        self.beets_config = self.root / "config.yaml"
+        self.beets_config.write_text("paths:\n  default: $albumartist/$album/$title\n")
+        self.dbs = {
+            "main": {
+                "path": "/music/library.db",
+                "directory": "/music",
+                "path_formats": (("default", "$albumartist/$album/$title"),),
+            }
+        }
+        self.cmds = {"main": {"exec": ["beet", "-c", str(self.beets_config)]}}
+        patches = (
+            patch.object(settings, "SNAPSHOT_LOCATION", self.root / "cache" / "settings.json"),
+            patch.object(settings, "_read_paths", []),
+            patch.object(settings, "library_names", return_value=["main"]),
+        )
+        for pp in patches:
+            pp.start()
+            self.addCleanup(pp.stop)
+
+    def test_snapshot_is_reused_until_a_source_changes(self):
+        settings._write_snapshot(self.dbs, self.cmds, [self.beets_config])
+        dbs, cmds = settings._read_snapshot()
+        self.assertEqual(self.dbs, dbs)
+        self.assertEqual(self.cmds, cmds)
+        stat = self.beets_config.stat()
+        os.utime(self.beets_config, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+        self.assertIsNone(settings._read_snapshot())
+
+    def test_snapshot_is_ignored_when_libraries_change(self):
+        settings._write_snapshot(self.dbs, self.cmds, [self.beets_config])
+        with patch.object(settings, "library_names", return_value=["main", "test"]):
+            self.assertIsNone(settings._read_snapshot())
+
+
+if __name__ == "__main__":
+    unittest.main()
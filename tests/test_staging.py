@@ -0,0 +1,83 @@
+import errno
+import os
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from music_upgrader import staging
+from music_upgrader.staging import FileStager, IOBudget
+
+
+class FileStagerTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+        self.source = self.root / "source.mp3"
+        self.source.write_bytes(os.urandom(256 * 1024))
+
+    def test_copy_uses_kernel_side_primitives(self):
+        target = self.root / "target.mp3"
+        with patch.object(Path, "read_bytes", side_effect=AssertionError):
+            method = FileStager().copy(self.source, target)
+        self.assertIn(method, ("reflink", "copy_file_range", "copyfile"))
+        self.assertEqual(self.source.read_bytes(), target.read_bytes())
+        staged = sorted(pp.name for pp in self.root.iterdir())
+        self.assertEqual(["source.mp3", "target.mp3"], staged)
+
+    def test_copy_falls_back_when_copy_file_range_is_unsupported(self):
+        target = self.root / "target.mp3"
+        unsupported = OSError(errno.EXDEV, "Invalid cross-device link")
+        with (
+            patch.object(staging, "_reflink", return_value=False),
+            patch.object(staging.os, "copy_file_range", side_effect=unsupported, create=True),
+        ):
+            self.assertEqual("copyfile", FileStager().copy(self.source, target))
+        self.assertEqual(self.source.read_bytes(), target.read_bytes())
+
+    def test_link_mode_hard_links_and_break_link_copies(self):
+        target = self.root / "target.mp3"
+        stager = FileStager(link=True)
+        self.assertEqual("link", stager.copy(self.source, target))
+        self.assertTrue(self.source.samefile(target))
+        self.assertTrue(stager.break_link(target))
+        self.assertFalse(self.source.samefile(target))
+        self.assertFalse(stager.break_link(target))
+
+    def test_move_copies_across_devices(self):
+        target = self.root / "moved.mp3"
+        contents = self.source.read_bytes()
+        cross_device = OSError(errno.EXDEV, "Invalid cross-device link")
+        with patch.object(staging.os, "rename", side_effect=cross_device):
+            self.assertNotEqual("rename", FileStager().move(self.source, target))
+        self.assertFalse(self.source.exists())
+        self.assertEqual(contents, target.read_bytes())
+
+
+class IOBudgetTests(unittest.TestCase):
+    def test_waits_until_bytes_are_released(self):
+        budget = IOBudget(100)
+        budget.acquire(60)
+        acquired = threading.Event()
+
+        def _acquire():
+            budget.acquire(60)
+            acquired.set()
+
+        thread = threading.Thread(target=_acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        budget.release(60)
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+
+    def test_oversized_file_proceeds_alone(self):
+        budget = IOBudget(100)
+        budget.acquire(500)
+        self.assertEqual(500, budget.in_flight)
+
+
+if __name__ == "__main__":
+    unittest.main()
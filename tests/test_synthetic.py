@@ -0,0 +1,119 @@
+import contextlib
+import csv
+import io
+import tempfile
+import unittest
+from pathlib import Path
+
+from music_upgrader import synthetic
+from music_upgrader.db import ApiDataService, CliDataService
+from music_upgrader.metrics import Metrics, set_metrics
+from music_upgrader.probes import probe_file
+from music_upgrader.processors import CSV_HEADER, UpgradeCheck
+
+
+class SyntheticLibraryTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        with contextlib.redirect_stdout(io.StringIO()):
+            cls.library = synthetic.generate(cls.temp_dir.name, 24)
+        cls.library.register()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.temp_dir.cleanup()
+
+    def test_library_csv_uses_loader_format(self):
+        with self.library.library_csv.open() as csv_file:
+            reader = csv.DictReader(csv_file)
+            rows = list(reader)
+        self.assertEqual(list(CSV_HEADER), reader.fieldnames)
+        self.assertEqual(24, len(rows))
+        self.assertEqual("MP3", probe_file(rows[0]["location"]).format)
+
+    def test_beets_paths_follow_path_formats(self):
+        items = list(ApiDataService(self.library.name).load_all())
+        self.assertEqual(18, len(items))
+        flac = next(item for item in items if item["format"] == "FLAC")
+        expected = (
+            self.library.beets_directory
+            / "FLAC"
+            / flac["albumartist"]
+            / flac["album"]
+            / f"{flac['track']:02d} - {flac['title']}.flac"
+        )
+        self.assertEqual(str(expected), flac["path"].decode("utf-8"))
+        self.assertEqual(("FLAC", "Don’t Stop 000000"), (probe_file(expected).format, flac.title))
+
+    def test_upgrade_check_finds_flac_and_better_mp3_files(self):
+        check = UpgradeCheck(self.library.library_csv, ApiDataService(self.library.name))
+        with contextlib.redirect_stdout(io.StringIO()):
+            for_upgrade, no_upgrade = check.process_csv()
+        self.assertEqual(12, len(for_upgrade))
+        self.assertEqual(
+            {"SAME_QUALITY", "NOT_FOUND"}, {row["upgrade_reason"] for row in no_upgrade}
+        )
+
+    def test_verified_tags_keep_every_upgrade(self):
+        check = UpgradeCheck(
+            self.library.library_csv,
+            ApiDataService(self.library.name),
+            enable_file_comparison=True,
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            for_upgrade, no_upgrade = check.process_csv()
+        # The beets titles use curly apostrophes where the iTunes tags do not
+        self.assertEqual(12, len(for_upgrade))
+        self.assertNotIn("DO_NOT_MATCH", {row["upgrade_reason"] for row in no_upgrade})
+
+    def test_matching_by_album_finds_the_same_files_with_fewer_queries(self):
+        for key_store in (None, Path(self.temp_dir.name) / "keys.db"):
+            results = {}
+            queries = {}
+            for by_album in (False, True):
+                check = UpgradeCheck(
+                    self.library.library_csv,
+                    ApiDataService(self.library.name, key_store),
+                    use_index=False,
+                    by_album=by_album,
+                )
+                metrics = Metrics("UpgradeCheck")
+                set_metrics(metrics)
+                self.addCleanup(set_metrics, None)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    for_upgrade, no_upgrade = check.process_csv()
+                set_metrics(None)
+                results[by_album] = [dict(row) for row in (*for_upgrade, *no_upgrade)]
+                queries[by_album] = metrics.spans["beets_query"].count
+            with self.subTest(key_store=key_store):
+                self.assertEqual(results[False], results[True])
+                self.assertLess(queries[True], queries[False])
+
+    def test_convert_stand_in_writes_alac_to_staging(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            library = synthetic.generate(temp_dir, 4, name="synthetic_convert")
+            library.register()
+            service = CliDataService(library.name)
+            flac = next(library.beets_directory.rglob("*.flac"))
+            service.convert_paths([str(flac)])
+            (converted,) = library.staging_directory.rglob("*.m4a")
+        self.assertEqual(
+            flac.relative_to(library.beets_directory).with_suffix(".m4a"),
+            converted.relative_to(library.staging_directory),
+        )
+
+
+class WriteM4aTests(unittest.TestCase):
+    def test_writes_tagged_alac(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = synthetic.write_m4a(Path(temp_dir) / "a.m4a", 96000, 24, title="Lake of Fire")
+            probe = probe_file(path)
+        self.assertEqual(
+            ("MP4", "alac", 96000, 24, "Lake of Fire"),
+            (probe.format, probe.codec, probe.sample_rate, probe.bits_per_sample, probe.title),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
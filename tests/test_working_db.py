@@ -0,0 +1,116 @@
+import csv
+import tempfile
+import unittest
+from datetime import datetime
+from pathlib import Path
+
+from music_upgrader import main
+from music_upgrader.processors import BaseProcess
+from music_upgrader.working_db import STAGE_NAMES, WorkingDatabase
+
+LIBRARY = [
+    ("61A578F3A06A1801", "13", "Bucket Head", "Meat Puppets", "No Strings Attached",
+     "Meat Puppets", "1990", "Saturday, January 1, 2022 at 10:00:00 AM", "1",
+     "/Music/Meat Puppets/13 Bucket Head.mp3"),
+    ("61A578F3A06A1802", "1", "Lake of Fire", "Meat Puppets", "No Strings Attached",
+     "Meat Puppets", "1990", "missing value", "0", "/Music/Meat Puppets/01 Lake of Fire.mp3"),
+]
+
+
+class Checker(BaseProcess):
+    """Finds a FLAC file for the first track only"""
+
+    STAGE = "check"
+
+    def process_row(self, csv_row):
+        row_cpy = csv_row.copy()
+        if csv_row["track_number"] == "13":
+            row_cpy["new_file"] = "/beets/FLAC/13 Bucket Head.flac"
+            row_cpy["b_year"] = "1984"
+            row_cpy["year_action"] = "itunes_year"
+        row_cpy["can_upgrade"] = csv_row["track_number"] == "13"
+        return row_cpy
+
+
+class WorkingDatabaseTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.root = Path(self.temp_dir.name)
+        self.db = WorkingDatabase(self.root / "working.db")
+        self.addCleanup(self.db.close)
+        self.db.load_library(LIBRARY)
+
+    def _check(self, redo=False):
+        checker = Checker(self.root / "unused.csv")
+        checker.output_dir = self.root
+        checker.use_working_db(self.db, redo=redo)
+        checker.run()
+
+    def test_stages_read_typed_columns_as_csv_values(self):
+        first, second = self.db.pending("check")
+        self.assertEqual(
+            ("13", datetime(2022, 1, 1, 10, 0)), (first["track_number"], first["last_played"])
+        )
+        self.assertIsNone(second["last_played"])
+
+    def test_each_stage_processes_what_the_stage_before_changed(self):
+        self._check()
+        self.assertEqual(0, self.db.count_pending("check"))
+        (row,) = self.db.pending("convert")
+        self.assertEqual(
+            ("/beets/FLAC/13 Bucket Head.flac", "True", "1984"),
+            (row["new_file"], row["can_upgrade"], row["b_year"]),
+        )
+        self.db.save("convert", {**row, "new_file": "/staging/13 Bucket Head.m4a"})
+        self.assertEqual(0, self.db.count_pending("convert"))
+        (row,) = self.db.pending("copy")
+        self.db.save("copy", {**row, "new_file": "/Music/13 Bucket Head.m4a"})
+        (row,) = self.db.pending("apply")
+        self.assertEqual("/Music/13 Bucket Head.m4a", row["new_file"])
+        self.db.save("apply", {**row, "success": False, "error": "-1728"})
+        self.assertEqual(1, self.db.count_pending("apply"))
+        self.db.save("apply", {**row, "success": True})
+        self.assertEqual(0, self.db.count_pending("apply"))
+
+    def test_reloading_only_rechecks_changed_tracks(self):
+        self._check()
+        changed = (*LIBRARY[1][:9], "/Music/Meat Puppets/01 Lake of Fire.m4a")
+        self.db.load_library([(*LIBRARY[0][:8], "7", LIBRARY[0][9]), changed])
+        pending = [row["persistent_id"] for row in self.db.pending("check")]
+        self.assertEqual(["61A578F3A06A1802"], pending)
+        self.db.load_library([changed])
+        self.assertEqual(1, len(self.db.library()))
+        self._check(redo=True)
+        self.assertEqual(0, self.db.count_pending("convert"))
+
+    def test_edited_year_actions_are_converted_again(self):
+        self._check()
+        (row,) = self.db.pending("convert")
+        self.db.save("convert", {**row, "new_file": "/staging/13 Bucket Head.m4a"})
+        exported = self.root / "upgrades.csv"
+        self.assertEqual(1, self.db.export_csv(exported, "check", upgrades_only=True))
+        with exported.open() as csv_file:
+            rows = list(csv.DictReader(csv_file))
+        self.assertEqual("/beets/FLAC/13 Bucket Head.flac", rows[0]["new_file"])
+        with exported.open("w") as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=["persistent_id", "year_action"])
+            writer.writeheader()
+            writer.writerow({"persistent_id": LIBRARY[0][0], "year_action": "b_year"})
+        self.assertEqual(1, self.db.import_csv(exported, "check"))
+        (row,) = self.db.pending("convert")
+        self.assertEqual("b_year", row["year_action"])
+
+    def test_pending_rows_are_found_with_partial_indexes(self):
+        for stage in STAGE_NAMES[1:]:
+            plan = self.db._conn.execute(
+                f"EXPLAIN QUERY PLAN SELECT rowid FROM tracks WHERE {self.db._condition(stage)}"
+            ).fetchall()
+            self.assertIn(f"USING INDEX pending_{stage}", plan[0][-1])
+
+    def test_command_line_knows_every_stage(self):
+        self.assertEqual(STAGE_NAMES, main.STAGE_NAMES)
+
+
+if __name__ == "__main__":
+    unittest.main()